@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import shutil
+import threading
+from fnmatch import fnmatch
+from os.path import exists, join, relpath
+from subprocess import PIPE, TimeoutExpired, run
+
+from build_helper.build_utils import BuildUtils
+
+suite_tag = "BuildCache"
+build_cache_filename = "build_cache.json"
+chart_cache_filename = "chart_cache.json"
+build_hash_label = "kaapana.build-hash"
+# Proxy build-args do not influence the image content (same behaviour as docker)
+ignored_build_args = ["http_proxy", "https_proxy", "no_proxy"]
+
+
+class BuildCache:
+    """
+    Content-hash build-cache for containers.
+
+    The hash of a container covers the build-context, the Dockerfile, the build-args
+    and the image-ids of all resolved base-images. If an image with the same hash has
+    been built before, the container is skipped (same tag) or retagged (new version)
+    instead of being rebuilt. The hash is also added as label to the image, so that
+    images present in the registry can be reused.
+    """
+
+    container_engine = None
+    index = None
+    index_path = None
+    semaphore_index = threading.Lock()
+
+    @staticmethod
+    def init(container_engine):
+        BuildCache.container_engine = container_engine
+        BuildCache.index_path = join(BuildUtils.build_cache_dir, build_cache_filename)
+        BuildCache.index = {}
+        if exists(BuildCache.index_path):
+            try:
+                with open(BuildCache.index_path, "r") as f:
+                    BuildCache.index = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                BuildUtils.logger.warning(
+                    f"Could not load build-cache index {BuildCache.index_path}: {e} -> starting empty"
+                )
+        BuildUtils.logger.debug(
+            f"Build-cache: {len(BuildCache.index)} entries @{BuildCache.index_path}"
+        )
+
+    @staticmethod
+    def save_index():
+        os.makedirs(BuildUtils.build_cache_dir, exist_ok=True)
+        tmp_index_path = f"{BuildCache.index_path}.tmp"
+        with open(tmp_index_path, "w") as f:
+            json.dump(BuildCache.index, f, indent=4, sort_keys=True)
+        os.replace(tmp_index_path, BuildCache.index_path)
+
+    @staticmethod
+    def get_dockerignore_patterns(container_dir):
+        dockerignore_path = join(container_dir, ".dockerignore")
+        if not exists(dockerignore_path):
+            return []
+        with open(dockerignore_path, "r") as f:
+            return [
+                x.strip().strip("/")
+                for x in f.readlines()
+                if x.strip() != "" and not x.strip().startswith("#")
+            ]
+
+    @staticmethod
+    def is_ignored(rel_path, ignore_patterns):
+        for ignore_pattern in ignore_patterns:
+            if ignore_pattern.startswith("!"):
+                continue
+            if fnmatch(rel_path, ignore_pattern) or rel_path.startswith(
+                f"{ignore_pattern}/"
+            ):
+                return True
+        return False
+
+    @staticmethod
+    def hash_build_context(container_dir, build_hash):
+        ignore_patterns = BuildCache.get_dockerignore_patterns(container_dir)
+        for root, dirs, files in os.walk(container_dir):
+            dirs.sort()
+            dirs[:] = [
+                x
+                for x in dirs
+                if not BuildCache.is_ignored(
+                    relpath(join(root, x), container_dir), ignore_patterns
+                )
+            ]
+            for file in sorted(files):
+                file_path = join(root, file)
+                rel_path = relpath(file_path, container_dir)
+                if BuildCache.is_ignored(rel_path, ignore_patterns):
+                    continue
+                build_hash.update(rel_path.encode())
+                if os.path.islink(file_path):
+                    build_hash.update(os.readlink(file_path).encode())
+                    continue
+                build_hash.update(str(os.stat(file_path).st_mode & 0o111).encode())
+                with open(file_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        build_hash.update(chunk)
+
+    @staticmethod
+    def get_image_id(image_tag):
+        output = run(
+            [
+                BuildCache.container_engine,
+                "image",
+                "inspect",
+                "--format",
+                "{{.Id}}",
+                image_tag,
+            ],
+            stdout=PIPE,
+            stderr=PIPE,
+            universal_newlines=True,
+            timeout=20,
+        )
+        if output.returncode != 0:
+            return None
+        return output.stdout.strip()
+
+    @staticmethod
+    def get_remote_image_label(image_tag, label):
+        """
+        Reads a label from the image config in the registry without pulling the layers
+        (docker: buildx imagetools, podman: skopeo). Returns None if it can not be read.
+        """
+        if os.path.basename(BuildCache.container_engine) == "podman":
+            command = ["skopeo", "inspect", "--config", f"docker://{image_tag}"]
+        else:
+            command = [
+                BuildCache.container_engine,
+                "buildx",
+                "imagetools",
+                "inspect",
+                "--format",
+                "{{ json .Image }}",
+                image_tag,
+            ]
+        try:
+            output = run(
+                command,
+                stdout=PIPE,
+                stderr=PIPE,
+                universal_newlines=True,
+                timeout=60,
+            )
+        except (OSError, TimeoutExpired) as e:
+            BuildUtils.logger.debug(f"{image_tag}: could not inspect remote image: {e}")
+            return None
+        if output.returncode != 0:
+            return None
+        try:
+            image_config = json.loads(output.stdout)
+        except json.JSONDecodeError:
+            return None
+        # multi-platform images: {platform: image config}
+        if "config" not in image_config:
+            image_config = next(
+                (x for x in image_config.values() if isinstance(x, dict)), {}
+            )
+        return ((image_config.get("config") or {}).get("Labels") or {}).get(label)
+
+    @staticmethod
+    def pull_image(image_tag):
+        """
+        Pulls a registry build-cache hit, which is needed locally for the microk8s push.
+        Returns False if the pull failed.
+        """
+        BuildUtils.logger.info(f"{image_tag}: pull for the microk8s push")
+        try:
+            output = run(
+                [BuildCache.container_engine, "pull", image_tag],
+                stdout=PIPE,
+                stderr=PIPE,
+                universal_newlines=True,
+                timeout=9000,
+            )
+        except (OSError, TimeoutExpired) as e:
+            BuildUtils.logger.warning(f"{image_tag}: pull failed -> build: {e}")
+            return False
+        if output.returncode != 0:
+            BuildUtils.logger.warning(
+                f"{image_tag}: pull failed -> build: {output.stderr}"
+            )
+            return False
+        return True
+
+    @staticmethod
+    def get_build_hash(container, build_args):
+        """
+        Returns the content-hash of the container or None if a base-image could not be
+        resolved locally (-> it would be pulled during the build).
+        """
+        build_hash = hashlib.sha256()
+        with open(container.path, "rb") as f:
+            build_hash.update(f.read())
+
+        for build_arg in sorted(build_args):
+            if build_arg.split("=")[0].lower() in ignored_build_args:
+                continue
+            build_hash.update(build_arg.encode())
+
+        for base_image in container.base_images:
+            base_image_id = BuildCache.get_image_id(base_image.tag)
+            if base_image_id is None:
+                BuildUtils.logger.debug(
+                    f"{container.build_tag}: base-image {base_image.tag} not present -> no build-hash"
+                )
+                return None
+            build_hash.update(f"{base_image.tag}@{base_image_id}".encode())
+
+        BuildCache.hash_build_context(container.container_dir, build_hash)
+        return build_hash.hexdigest()
+
+    @staticmethod
+    def reuse(container, build_hash):
+        """
+        Tries to reuse an image with the same build-hash.
+        Returns True if the container does not have to be built.
+        """
+        with BuildCache.semaphore_index:
+            cache_entry = BuildCache.index.get(build_hash)
+
+        if cache_entry is not None:
+            image_id = BuildCache.get_image_id(cache_entry["image_id"])
+            if image_id is not None:
+                if (
+                    cache_entry["build_tag"] == container.build_tag
+                    and BuildCache.get_image_id(container.build_tag) == image_id
+                ):
+                    BuildUtils.logger.info(
+                        f"{container.build_tag}: build-cache hit -> skip"
+                    )
+                    container.container_build_status = "nothing_changed"
+                    container.build_cache_hit = True
+                    return True
+
+                output = run(
+                    [
+                        BuildCache.container_engine,
+                        "tag",
+                        image_id,
+                        container.build_tag,
+                    ],
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    universal_newlines=True,
+                    timeout=20,
+                )
+                if output.returncode == 0:
+                    BuildUtils.logger.info(
+                        f"{container.build_tag}: build-cache hit -> retagged {cache_entry['build_tag']}"
+                    )
+                    container.container_build_status = "built"
+                    container.build_cache_hit = True
+                    BuildCache.add(container, build_hash)
+                    return True
+                BuildUtils.logger.warning(
+                    f"{container.build_tag}: retagging failed -> build: {output.stderr}"
+                )
+
+        if BuildUtils.build_cache_registry and not container.local_image:
+            # only the label is fetched, the image is pulled by the builds that need it
+            # (and here if it has to be pushed to microk8s)
+            if (
+                BuildCache.get_remote_image_label(container.build_tag, build_hash_label)
+                == build_hash
+            ):
+                if BuildUtils.push_to_microk8s and not BuildCache.pull_image(
+                    container.build_tag
+                ):
+                    return False
+                BuildUtils.logger.info(
+                    f"{container.build_tag}: registry build-cache hit -> skip build and push"
+                )
+                container.container_build_status = "nothing_changed"
+                container.container_push_status = "pushed"
+                container.build_cache_hit = True
+                return True
+
+        return False
+
+    @staticmethod
+    def add(container, build_hash):
+        image_id = BuildCache.get_image_id(container.build_tag)
+        if image_id is None:
+            return
+        with BuildCache.semaphore_index:
+            BuildCache.index[build_hash] = {
+                "build_tag": container.build_tag,
+                "image_id": image_id,
+            }
+            BuildCache.save_index()
+
+
+class HelmChartCache:
+    """
+    Content-hash cache for helm lint, kubeval and package results.
+
+    The hash of a chart covers its build-version directory, which already contains the
+    rendered Chart.yaml and all resolved dependency charts, plus the helm version.
+    Successful lint results and packages of unchanged charts are reused.
+    """
+
+    index = None
+    index_path = None
+    packages_dir = None
+    helm_version = None
+    semaphore_index = threading.Lock()
+
+    @staticmethod
+    def init():
+        HelmChartCache.packages_dir = join(BuildUtils.build_cache_dir, "charts")
+        HelmChartCache.index_path = join(
+            HelmChartCache.packages_dir, chart_cache_filename
+        )
+        HelmChartCache.index = {}
+        if exists(HelmChartCache.index_path):
+            try:
+                with open(HelmChartCache.index_path, "r") as f:
+                    HelmChartCache.index = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                BuildUtils.logger.warning(
+                    f"Could not load chart-cache index {HelmChartCache.index_path}: {e} -> starting empty"
+                )
+        output = run(
+            ["helm", "version", "--short"],
+            stdout=PIPE,
+            stderr=PIPE,
+            universal_newlines=True,
+            timeout=10,
+        )
+        HelmChartCache.helm_version = output.stdout.strip()
+
+    @staticmethod
+    def save_index():
+        os.makedirs(HelmChartCache.packages_dir, exist_ok=True)
+        tmp_index_path = f"{HelmChartCache.index_path}.tmp"
+        with open(tmp_index_path, "w") as f:
+            json.dump(HelmChartCache.index, f, indent=4, sort_keys=True)
+        os.replace(tmp_index_path, HelmChartCache.index_path)
+
+    @staticmethod
+    def get_chart_hash(chart):
+        if chart.build_hash is None:
+            build_hash = hashlib.sha256()
+            build_hash.update(HelmChartCache.helm_version.encode())
+            BuildCache.hash_build_context(chart.build_chart_dir, build_hash)
+            chart.build_hash = build_hash.hexdigest()
+        return chart.build_hash
+
+    @staticmethod
+    def is_done(chart, step):
+        chart_hash = HelmChartCache.get_chart_hash(chart)
+        with HelmChartCache.semaphore_index:
+            return HelmChartCache.index.get(chart_hash, {}).get(step, False)
+
+    @staticmethod
+    def set_done(chart, step):
+        chart_hash = HelmChartCache.get_chart_hash(chart)
+        with HelmChartCache.semaphore_index:
+            HelmChartCache.index.setdefault(chart_hash, {})[step] = True
+            HelmChartCache.save_index()
+
+    @staticmethod
+    def restore_package(chart, package_path):
+        cached_package_path = join(
+            HelmChartCache.packages_dir,
+            f"{HelmChartCache.get_chart_hash(chart)}.tgz",
+        )
+        if not HelmChartCache.is_done(chart, "package") or not exists(
+            cached_package_path
+        ):
+            return False
+        shutil.copyfile(cached_package_path, package_path)
+        return True
+
+    @staticmethod
+    def store_package(chart, package_path):
+        os.makedirs(HelmChartCache.packages_dir, exist_ok=True)
+        cached_package_path = join(
+            HelmChartCache.packages_dir,
+            f"{HelmChartCache.get_chart_hash(chart)}.tgz",
+        )
+        shutil.copyfile(package_path, cached_package_path)
+        HelmChartCache.set_done(chart, "package")
+
+
+if __name__ == "__main__":
+    print("Please use the 'start_build.py' script to launch the build-process.")
+    exit(1)
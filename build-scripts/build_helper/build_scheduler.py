@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+import heapq
+import json
+import os
+from multiprocessing.pool import ThreadPool
+from os.path import exists, join
+from queue import Queue
+from time import time
+
+import networkx as nx
+
+from build_helper.build_trace import BuildTrace
+from build_helper.build_utils import BuildUtils
+
+suite_tag = "Scheduler"
+build_durations_filename = "build_durations.json"
+default_duration = 120.0
+
+
+def format_duration(seconds):
+    hours, rem = divmod(seconds, 3600)
+    minutes, seconds = divmod(rem, 60)
+    return "{:0>2}:{:0>2}:{:05.2f}".format(int(hours), int(minutes), seconds)
+
+
+class BuildScheduler:
+    """
+    Event-driven container build scheduler.
+
+    Containers are released to the thread-pool as soon as all of their base images
+    have been built successfully. Ready containers are ordered by their critical-path
+    length (upward rank), estimated from the build durations of previous builds.
+    """
+
+    def __init__(self, build_graph, containers_to_build):
+        self.containers = {x.tag: x for x in containers_to_build}
+        self.durations = BuildScheduler.load_durations()
+        self.dag = self.generate_container_dag(build_graph=build_graph)
+        self.ranks = self.compute_ranks()
+
+    @staticmethod
+    def load_durations():
+        durations_path = join(BuildUtils.build_cache_dir, build_durations_filename)
+        if not exists(durations_path):
+            return {}
+        try:
+            with open(durations_path, "r") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            BuildUtils.logger.warning(
+                f"Could not load build durations from {durations_path}: {e}"
+            )
+            return {}
+
+    def save_durations(self):
+        os.makedirs(BuildUtils.build_cache_dir, exist_ok=True)
+        durations_path = join(BuildUtils.build_cache_dir, build_durations_filename)
+        with open(durations_path, "w") as f:
+            json.dump(self.durations, f, indent=4, sort_keys=True)
+
+    def generate_container_dag(self, build_graph):
+        # Only containers that have to be built are part of the dag.
+        # Edges point from the base image to the container using it.
+        dag = nx.DiGraph()
+        dag.add_nodes_from(self.containers.keys())
+        for container_tag, container in self.containers.items():
+            base_image_tags = set()
+            container_node_id = f"container:{container_tag}"
+            if build_graph.has_node(container_node_id):
+                base_image_tags.update(
+                    x.split(":", 1)[1]
+                    for x in build_graph.successors(container_node_id)
+                    if x.startswith("base-image:")
+                )
+            # base-images of base-images are not part of the chart build-graph
+            base_image_tags.update(x.tag for x in container.base_images)
+            for base_image_tag in base_image_tags:
+                if (
+                    base_image_tag in self.containers
+                    and base_image_tag != container_tag
+                ):
+                    dag.add_edge(base_image_tag, container_tag)
+
+        if not nx.is_directed_acyclic_graph(dag):
+            BuildUtils.generate_issue(
+                component=suite_tag,
+                name="container_build",
+                msg=f"Base-image cycle detected: {nx.find_cycle(dag)}",
+                level="FATAL",
+            )
+        return dag
+
+    def predicted_duration(self, container_tag):
+        image_name = self.containers[container_tag].image_name
+        if image_name in self.durations:
+            return (
+                self.durations[image_name]["build"] + self.durations[image_name]["push"]
+            )
+        known = [x["build"] + x["push"] for x in self.durations.values()]
+        return sum(known) / len(known) if len(known) > 0 else default_duration
+
+    def compute_ranks(self):
+        ranks = {}
+        for container_tag in reversed(list(nx.topological_sort(self.dag))):
+            ranks[container_tag] = self.predicted_duration(container_tag) + max(
+                [ranks[x] for x in self.dag.successors(container_tag)], default=0.0
+            )
+        return ranks
+
+    def critical_path(self):
+        path = []
+        candidates = [x for x in self.dag.nodes if self.dag.in_degree(x) == 0]
+        while len(candidates) > 0:
+            next_tag = max(candidates, key=lambda x: self.ranks[x])
+            path.append(next_tag)
+            candidates = list(self.dag.successors(next_tag))
+        return path
+
+    def simulate(self, workers):
+        """
+        List-scheduling simulation with the predicted durations.
+        Returns the predicted makespan in seconds and the start-time per container.
+        """
+        pending = {x: self.dag.in_degree(x) for x in self.dag.nodes}
+        ready = [
+            (-self.ranks[x], x) for x, dep_count in pending.items() if dep_count == 0
+        ]
+        heapq.heapify(ready)
+        running = []
+        start_times = {}
+        now = 0.0
+        while len(ready) > 0 or len(running) > 0:
+            while len(ready) > 0 and len(running) < workers:
+                _, container_tag = heapq.heappop(ready)
+                start_times[container_tag] = now
+                heapq.heappush(
+                    running,
+                    (now + self.predicted_duration(container_tag), container_tag),
+                )
+            now, container_tag = heapq.heappop(running)
+            for child_tag in self.dag.successors(container_tag):
+                pending[child_tag] -= 1
+                if pending[child_tag] == 0:
+                    heapq.heappush(ready, (-self.ranks[child_tag], child_tag))
+        return now, start_times
+
+    def dry_run(self):
+        makespan, start_times = self.simulate(workers=BuildUtils.parallel_processes)
+        total = sum(self.predicted_duration(x) for x in self.dag.nodes)
+        critical_path = self.critical_path()
+
+        BuildUtils.logger.info("")
+        BuildUtils.logger.info(
+            "-----------------------------------------------------------"
+        )
+        BuildUtils.logger.info(
+            "------------------ BUILD SCHEDULE DRY-RUN -----------------"
+        )
+        BuildUtils.logger.info(
+            "-----------------------------------------------------------"
+        )
+        BuildUtils.logger.info("")
+        for container_tag, start_time in sorted(
+            start_times.items(), key=lambda x: x[1]
+        ):
+            BuildUtils.logger.info(
+                f"{format_duration(start_time)} + {format_duration(self.predicted_duration(container_tag))}: {container_tag}"
+            )
+        BuildUtils.logger.info("")
+        BuildUtils.logger.info(f"Containers:         {len(start_times)}")
+        BuildUtils.logger.info(f"Parallel processes: {BuildUtils.parallel_processes}")
+        BuildUtils.logger.info(f"Sequential time:    {format_duration(total)}")
+        BuildUtils.logger.info(
+            f"Critical path:      {format_duration(self.ranks[critical_path[0]]) if len(critical_path) > 0 else format_duration(0)}"
+        )
+        BuildUtils.logger.info(f"Predicted makespan: {format_duration(makespan)}")
+        BuildUtils.logger.info("")
+        for container_tag in critical_path:
+            BuildUtils.logger.info(f"  -> {container_tag}")
+        BuildUtils.logger.info("")
+        return makespan
+
+    def execute_container(self, container_tag, events):
+        container = self.containers[container_tag]
+        start_time = time()
+        BuildTrace.add_wait(
+            container.build_tag,
+            "queue-wait",
+            self.ready_times[container_tag],
+            start_time,
+        )
+        issue, build_time_needed = container.build()
+        build_seconds = time() - start_time
+        events.put(("built", container_tag, issue, build_time_needed, build_seconds))
+        if issue is not None:
+            return
+
+        start_time = time()
+        issue, push_time_needed = container.push()
+        push_seconds = time() - start_time
+        events.put(("pushed", container_tag, issue, push_time_needed, push_seconds))
+
+    def run(self, successful_built_containers, lock, bar=None):
+        """
+        Builds all containers of the dag. Dependent containers are released as soon as
+        their base images have been built - pushing happens concurrently.
+        """
+        events = Queue()
+        pending = {x: self.dag.in_degree(x) for x in self.dag.nodes}
+        ready = [
+            (-self.ranks[x], x) for x, dep_count in pending.items() if dep_count == 0
+        ]
+        heapq.heapify(ready)
+        start_time = time()
+        self.ready_times = {x: start_time for _, x in ready}
+        running = 0
+        unfinished = set(self.dag.nodes)
+        build_times = {}
+        # first finished base image per container -> start of its base-image-wait
+        first_base_image_times = {}
+
+        def skip_dependents(container_tag):
+            for child_tag in nx.descendants(self.dag, container_tag):
+                if child_tag in unfinished:
+                    unfinished.discard(child_tag)
+                    BuildUtils.logger.error(
+                        f"{child_tag}: Base image {container_tag} failed -> skip"
+                    )
+                    if bar is not None:
+                        bar()
+
+        with ThreadPool(BuildUtils.parallel_processes) as threadpool:
+            while len(unfinished) > 0:
+                while len(ready) > 0 and running < BuildUtils.parallel_processes:
+                    _, container_tag = heapq.heappop(ready)
+                    if container_tag not in unfinished:
+                        continue
+                    running += 1
+                    threadpool.apply_async(
+                        self.execute_container,
+                        (container_tag, events),
+                        error_callback=lambda e, tag=container_tag: events.put(
+                            ("error", tag, e, "", 0.0)
+                        ),
+                    )
+
+                if running == 0:
+                    BuildUtils.generate_issue(
+                        component=suite_tag,
+                        name="container_build",
+                        msg=f"No container ready to build! Still missing: {sorted(unfinished)}",
+                        level="FATAL",
+                    )
+                    break
+
+                event, container_tag, issue, time_needed, seconds = events.get()
+                container = self.containers[container_tag]
+
+                if event == "error":
+                    running -= 1
+                    unfinished.discard(container_tag)
+                    skip_dependents(container_tag)
+                    threadpool.terminate()
+                    BuildUtils.generate_issue(
+                        component=suite_tag,
+                        name=f"{container.build_tag}",
+                        msg=f"Unexpected error: {issue}",
+                        level="FATAL",
+                    )
+                    break
+
+                if event == "built":
+                    build_times[container_tag] = (time_needed, seconds)
+                    if issue is None:
+                        with lock:
+                            successful_built_containers.append(container.build_tag)
+                        for child_tag in self.dag.successors(container_tag):
+                            pending[child_tag] -= 1
+                            first_base_image_times.setdefault(child_tag, time())
+                            if pending[child_tag] == 0:
+                                self.ready_times[child_tag] = time()
+                                BuildTrace.add_wait(
+                                    self.containers[child_tag].build_tag,
+                                    "base-image-wait",
+                                    first_base_image_times[child_tag],
+                                    self.ready_times[child_tag],
+                                )
+                                heapq.heappush(
+                                    ready, (-self.ranks[child_tag], child_tag)
+                                )
+                        continue
+                    skip_dependents(container_tag)
+
+                running -= 1
+                unfinished.discard(container_tag)
+                build_time_needed, build_seconds = build_times[container_tag]
+                if (
+                    issue is None
+                    and not container.build_cache_hit
+                    and container.container_build_status in ["built", "nothing_changed"]
+                ):
+                    self.durations[container.image_name] = {
+                        "build": round(build_seconds, 2),
+                        "push": round(seconds, 2),
+                    }
+
+                if bar is not None:
+                    bar()
+                BuildUtils.logger.info(
+                    f"{container.build_tag} - build: {build_time_needed} - push {time_needed if event == 'pushed' else ''} : DONE"
+                )
+                if issue is not None:
+                    if BuildUtils.exit_on_error or issue["level"] == "FATAL":
+                        threadpool.terminate()
+                    if bar is not None:
+                        bar.text(f"{container.tag}: ERROR")
+                    BuildUtils.logger.info("")
+                    BuildUtils.generate_issue(
+                        component=issue["component"],
+                        name=issue["name"],
+                        level=issue["level"],
+                        msg=issue["msg"],
+                        output=issue["output"] if "output" in issue else None,
+                        path=issue["path"] if "path" in issue else "",
+                    )
+                elif bar is not None:
+                    bar.text(f"{container.build_tag}: ok")
+
+        self.save_durations()
+
+
+if __name__ == "__main__":
+    print("Please use the 'start_build.py' script to launch the build-process.")
+    exit(1)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+import json
+import threading
+from contextlib import contextmanager
+from os.path import join
+from time import time
+
+from build_helper.build_utils import BuildUtils
+
+build_trace_filename = "build_trace.json"
+build_report_filename = "build_report.json"
+
+
+class BuildTrace:
+    """
+    Collects timing events of the build-process and writes them in the Chrome trace
+    event format (open with chrome://tracing or https://ui.perfetto.dev).
+
+    Work (build, push, lint, package ...) is recorded as complete events on the thread
+    that executed it. Waiting times (queue-wait, base-image-wait) are recorded as async
+    events per container.
+    """
+
+    start_time = None
+    events = []
+    thread_ids = {}
+    semaphore_events = threading.Lock()
+
+    @staticmethod
+    def init():
+        BuildTrace.start_time = time()
+        BuildTrace.events = []
+        BuildTrace.thread_ids = {}
+
+    @staticmethod
+    def to_us(timestamp):
+        return int((timestamp - BuildTrace.start_time) * 1e6)
+
+    @staticmethod
+    def get_thread_id():
+        thread_ident = threading.get_ident()
+        if thread_ident not in BuildTrace.thread_ids:
+            BuildTrace.thread_ids[thread_ident] = len(BuildTrace.thread_ids)
+        return BuildTrace.thread_ids[thread_ident]
+
+    @staticmethod
+    def add_span(name, category, start, end, **args):
+        if BuildTrace.start_time is None:
+            return
+        with BuildTrace.semaphore_events:
+            BuildTrace.events.append(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": BuildTrace.to_us(start),
+                    "dur": BuildTrace.to_us(end) - BuildTrace.to_us(start),
+                    "pid": 1,
+                    "tid": BuildTrace.get_thread_id(),
+                    "args": args,
+                }
+            )
+
+    @staticmethod
+    def add_wait(name, category, start, end, **args):
+        if BuildTrace.start_time is None:
+            return
+        with BuildTrace.semaphore_events:
+            for phase, timestamp in [("b", start), ("e", end)]:
+                BuildTrace.events.append(
+                    {
+                        "name": category,
+                        "cat": category,
+                        "ph": phase,
+                        "id": name,
+                        "ts": BuildTrace.to_us(timestamp),
+                        "pid": 1,
+                        "tid": 0,
+                        "args": dict(args, target=name) if phase == "b" else {},
+                    }
+                )
+
+    @staticmethod
+    @contextmanager
+    def span(name, category, **args):
+        start = time()
+        try:
+            yield
+        finally:
+            BuildTrace.add_span(name, category, start, time(), **args)
+
+    @staticmethod
+    def get_spans(category):
+        with BuildTrace.semaphore_events:
+            return [
+                x for x in BuildTrace.events if x["ph"] == "X" and x["cat"] == category
+            ]
+
+    @staticmethod
+    def save():
+        if BuildTrace.start_time is None:
+            return
+        build_trace_path = join(BuildUtils.build_dir, build_trace_filename)
+        with BuildTrace.semaphore_events:
+            trace = {
+                "traceEvents": sorted(BuildTrace.events, key=lambda x: x["ts"]),
+                "displayTimeUnit": "ms",
+            }
+        with open(build_trace_path, "w") as f:
+            json.dump(trace, f)
+        BuildUtils.logger.info(f"Build-trace: {build_trace_path}")
+
+    @staticmethod
+    def generate_report(build_order, containers):
+        """
+        Computes the critical path of the container build (base-image chains) from the
+        measured build and push times and the parallel efficiency of the thread-pool.
+        """
+        if BuildTrace.start_time is None:
+            return None
+
+        build_seconds = {}
+        push_seconds = {}
+        for event in BuildTrace.get_spans("container-build"):
+            build_seconds[event["name"]] = event["dur"] / 1e6
+        for event in BuildTrace.get_spans("container-push"):
+            push_seconds[event["name"]] = event["dur"] / 1e6
+
+        containers = {x.tag: x for x in containers}
+        # Containers which did not reach the build are ignored
+        build_order = [x for x in build_order if x in containers]
+
+        # build_order is bottom-up, but chains of local base-images are not part of the
+        # build-graph -> resolve the finish-times recursively.
+        finish_times = {}
+        predecessors = {}
+
+        def finish_time(container_tag, visiting=()):
+            if container_tag in finish_times:
+                return finish_times[container_tag]
+            container = containers[container_tag]
+            base_finish_times = [
+                (finish_time(x.tag, visiting + (container_tag,)), x.tag)
+                for x in container.base_images
+                if x.tag in containers and x.tag not in visiting
+            ]
+            base_finish_time, predecessor = max(base_finish_times, default=(0.0, None))
+            predecessors[container_tag] = predecessor
+            finish_times[container_tag] = base_finish_time + build_seconds.get(
+                containers[container_tag].build_tag, 0.0
+            )
+            return finish_times[container_tag]
+
+        critical_path_seconds = 0.0
+        critical_path_end = None
+        for container_tag in build_order:
+            total = finish_time(container_tag) + push_seconds.get(
+                containers[container_tag].build_tag, 0.0
+            )
+            if total > critical_path_seconds:
+                critical_path_seconds = total
+                critical_path_end = container_tag
+
+        critical_path = []
+        while critical_path_end is not None:
+            critical_path.insert(0, critical_path_end)
+            critical_path_end = predecessors.get(critical_path_end)
+
+        work_events = BuildTrace.get_spans("container-build") + BuildTrace.get_spans(
+            "container-push"
+        )
+        busy_seconds = sum(x["dur"] for x in work_events) / 1e6
+        if len(work_events) > 0:
+            wall_seconds = (
+                max(x["ts"] + x["dur"] for x in work_events)
+                - min(x["ts"] for x in work_events)
+            ) / 1e6
+        else:
+            wall_seconds = 0.0
+        parallel_efficiency = (
+            busy_seconds / (wall_seconds * BuildUtils.parallel_processes)
+            if wall_seconds > 0
+            else 0.0
+        )
+
+        report = {
+            "containers": len(build_order),
+            "parallel_processes": BuildUtils.parallel_processes,
+            "wall_seconds": round(wall_seconds, 2),
+            "busy_seconds": round(busy_seconds, 2),
+            "parallel_efficiency": round(parallel_efficiency, 3),
+            "critical_path_seconds": round(critical_path_seconds, 2),
+            "critical_path": [
+                {
+                    "container": x,
+                    "build_seconds": round(
+                        build_seconds.get(containers[x].build_tag, 0.0), 2
+                    ),
+                    "push_seconds": round(
+                        push_seconds.get(containers[x].build_tag, 0.0), 2
+                    ),
+                }
+                for x in critical_path
+            ],
+            "slowest_containers": [
+                {"container": x, "build_seconds": round(y, 2)}
+                for x, y in sorted(
+                    build_seconds.items(), key=lambda item: item[1], reverse=True
+                )[:20]
+            ],
+        }
+
+        build_report_path = join(BuildUtils.build_dir, build_report_filename)
+        with open(build_report_path, "w") as f:
+            json.dump(report, f, indent=4)
+
+        BuildUtils.logger.info("")
+        BuildUtils.logger.info(f"Build-report: {build_report_path}")
+        BuildUtils.logger.info(
+            f"Container wall-time: {report['wall_seconds']}s - busy: {report['busy_seconds']}s - parallel efficiency: {report['parallel_efficiency']}"
+        )
+        BuildUtils.logger.info(
+            f"Critical path: {report['critical_path_seconds']}s -> {' -> '.join(critical_path)}"
+        )
+        BuildUtils.logger.info("")
+        return report
+
+
+if __name__ == "__main__":
+    print("Please use the 'start_build.py' script to launch the build-process.")
+    exit(1)
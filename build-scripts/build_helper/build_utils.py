@@ -1,5 +1,6 @@
 from time import time
 import json
+import threading
 import semver
 import networkx as nx
 from os.path import join, dirname, basename, exists
@@ -41,6 +42,13 @@ class BuildUtils:
     enable_image_stats = None
     trivy_utils = None
     check_expired_vulnerabilities_database = None
+    build_scheduler = None
+    build_dry_run = False
+    build_cache_dir = None
+    build_cache = None
+    build_cache_registry = None
+    repo_info_cache = {}
+    semaphore_repo_info = threading.Lock()
 
     @staticmethod
     def add_container_images_available(container_images_available):
@@ -73,6 +81,17 @@ class BuildUtils:
             repo_dir = dirname(repo_dir)
         assert repo_dir != "/"
 
+        # All containers and charts of a repository share the same repo-info
+        # -> only run git once per repository (collect_containers is threaded)
+        with BuildUtils.semaphore_repo_info:
+            if repo_dir not in BuildUtils.repo_info_cache:
+                BuildUtils.repo_info_cache[repo_dir] = BuildUtils.read_repo_info(
+                    repo_dir
+                )
+            return BuildUtils.repo_info_cache[repo_dir]
+
+    @staticmethod
+    def read_repo_info(repo_dir):
         requested_repo = Repo(repo_dir)
         assert not requested_repo.bare
 
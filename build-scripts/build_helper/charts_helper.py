@@ -14,11 +14,15 @@ from multiprocessing.pool import ThreadPool
 import networkx as nx
 from alive_progress import alive_bar
 from build_helper.container_helper import get_image_stats
+from build_helper.build_scheduler import BuildScheduler
+from build_helper.build_cache import HelmChartCache
+from build_helper.build_trace import BuildTrace
 from build_helper.offline_installer_helper import OfflineInstallerHelper
 import threading
 import signal
 from datetime import datetime
 from timeit import default_timer as timer
+from time import time
 
 suite_tag = "Charts"
 os.environ["HELM_EXPERIMENTAL_OCI"] = "1"
@@ -72,6 +76,17 @@ def parallel_execute(container_object):
     )
 
 
+def parallel_lint_and_package(chart_object):
+    # generate_issue() exits on errors -> hand the exit over to the main thread
+    try:
+        chart_object.lint_chart(build_version=True)
+        chart_object.lint_kubeval(build_version=True)
+        chart_object.make_package()
+    except SystemExit as e:
+        return chart_object, e.code
+    return chart_object, None
+
+
 def generate_deployment_script(platform_chart):
     BuildUtils.logger.info(
         f"-> Generate platform deployment script for {platform_chart.name} ..."
@@ -376,6 +391,7 @@ class HelmChart:
         self.build_chart_dir = None
         self.kubeval_done = False
         self.helmlint_done = False
+        self.build_hash = None
         self.is_dag = False
 
         assert isfile(chartfile)
@@ -862,6 +878,14 @@ class HelmChart:
             BuildUtils.logger.debug(f"{self.chart_id}: lint_chart already done - skip")
             return
         if HelmChart.enable_lint:
+            if (
+                build_version
+                and BuildUtils.build_cache
+                and HelmChartCache.is_done(self, "lint")
+            ):
+                BuildUtils.logger.debug(f"{self.chart_id}: lint_chart cached -> skip")
+                self.helmlint_done = True
+                return
             BuildUtils.logger.info(f"{self.chart_id}: lint_chart")
             if build_version:
                 cwd = self.build_chart_dir
@@ -869,14 +893,15 @@ class HelmChart:
                 cwd = self.chart_dir
 
             command = ["helm", "lint"]
-            output = run(
-                command,
-                stdout=PIPE,
-                stderr=PIPE,
-                universal_newlines=True,
-                timeout=20,
-                cwd=cwd,
-            )
+            with BuildTrace.span(self.chart_id, "chart-lint"):
+                output = run(
+                    command,
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    universal_newlines=True,
+                    timeout=20,
+                    cwd=cwd,
+                )
             if output.returncode != 0:
                 BuildUtils.logger.error(f"{self.chart_id}: lint_chart failed!")
                 BuildUtils.generate_issue(
@@ -890,6 +915,8 @@ class HelmChart:
             else:
                 BuildUtils.logger.debug(f"{self.chart_id}: lint_chart ok")
                 self.helmlint_done = True
+                if build_version and BuildUtils.build_cache:
+                    HelmChartCache.set_done(self, "lint")
         else:
             BuildUtils.logger.debug(f"{self.chart_id}: lint_chart disabled")
 
@@ -904,6 +931,16 @@ class HelmChart:
             return
 
         if HelmChart.enable_kubeval:
+            if (
+                build_version
+                and BuildUtils.build_cache
+                and HelmChartCache.is_done(self, "kubeval")
+            ):
+                BuildUtils.logger.debug(
+                    f"{self.chart_id}: lint_kubeval cached -> skip"
+                )
+                self.kubeval_done = True
+                return
             BuildUtils.logger.info(f"{self.chart_id}: lint_kubeval")
             if build_version:
                 cwd = self.build_chart_dir
@@ -911,14 +948,15 @@ class HelmChart:
                 cwd = self.chart_dir
 
             command = ["helm", "kubeval", "--ignore-missing-schemas", "."]
-            output = run(
-                command,
-                stdout=PIPE,
-                stderr=PIPE,
-                universal_newlines=True,
-                timeout=20,
-                cwd=cwd,
-            )
+            with BuildTrace.span(self.chart_id, "chart-kubeval"):
+                output = run(
+                    command,
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    universal_newlines=True,
+                    timeout=20,
+                    cwd=cwd,
+                )
             if output.returncode != 0 and "A valid hostname" not in output.stderr:
                 BuildUtils.logger.error(f"{self.chart_id}: lint_kubeval failed")
                 BuildUtils.generate_issue(
@@ -932,22 +970,36 @@ class HelmChart:
             else:
                 BuildUtils.logger.debug(f"{self.chart_id}: lint_kubeval ok")
                 self.kubeval_done = True
+                if build_version and BuildUtils.build_cache:
+                    HelmChartCache.set_done(self, "kubeval")
         else:
             BuildUtils.logger.debug(f"{self.chart_id}: kubeval disabled")
 
     def make_package(self):
+        package_path = join(
+            dirname(self.build_chart_dir),
+            f"{self.name}-{BuildUtils.platform_build_version}.tgz",
+        )
+        if BuildUtils.build_cache and HelmChartCache.restore_package(
+            self, package_path
+        ):
+            BuildUtils.logger.debug(f"{self.chart_id}: package cached -> skip")
+            return
         BuildUtils.logger.info(f"{self.chart_id}: make_package")
         command = ["helm", "package", self.name]
-        output = run(
-            command,
-            stdout=PIPE,
-            stderr=PIPE,
-            universal_newlines=True,
-            timeout=60,
-            cwd=dirname(self.build_chart_dir),
-        )
+        with BuildTrace.span(self.chart_id, "chart-package"):
+            output = run(
+                command,
+                stdout=PIPE,
+                stderr=PIPE,
+                universal_newlines=True,
+                timeout=60,
+                cwd=dirname(self.build_chart_dir),
+            )
         if output.returncode == 0 and "Successfully" in output.stdout:
             BuildUtils.logger.debug(f"{self.chart_id}: package ok")
+            if BuildUtils.build_cache and exists(package_path):
+                HelmChartCache.store_package(self, package_path)
         else:
             BuildUtils.logger.error(f"{self.chart_id}: make_package failed!")
             BuildUtils.generate_issue(
@@ -962,6 +1014,7 @@ class HelmChart:
     def push(self):
         if HelmChart.enable_push:
             BuildUtils.logger.info(f"{self.chart_id}: push")
+            push_start_time = time()
             try_count = 0
             command = [
                 "helm",
@@ -988,6 +1041,14 @@ class HelmChart:
                     timeout=60,
                 )
                 try_count += 1
+            BuildTrace.add_span(
+                self.chart_id,
+                "chart-push",
+                push_start_time,
+                time(),
+                returncode=output.returncode,
+                retries=try_count,
+            )
 
             if (
                 output.returncode != 0
@@ -1093,7 +1154,7 @@ class HelmChart:
             spinner="crab",
             dual_line=False,
             title="Generate Build-Version",
-        ) as bar:
+        ) as bar, BuildTrace.span(platform_chart.chart_id, "chart-build-version"):
             HelmChart.create_chart_build_version(
                 src_chart=platform_chart,
                 target_build_dir=platform_build_files_target_dir,
@@ -1129,7 +1190,7 @@ class HelmChart:
             spinner="crab",
             dual_line=False,
             title="Generate Build-Version",
-        ) as bar:
+        ) as bar, BuildTrace.span(collections_chart.chart_id, "chart-build-version"):
             HelmChart.create_chart_build_version(
                 src_chart=collections_chart,
                 target_build_dir=collection_build_target_dir,
@@ -1140,17 +1201,20 @@ class HelmChart:
             dual_line=True,
             title="Generate Build-Version",
         ) as bar:
-            for collection_chart_index, (
-                collection_chart_name,
-                collection_chart,
-            ) in enumerate(collections_chart.dependencies.items()):
-                BuildUtils.logger.info(
-                    f"Collection chart {collection_chart_index+1}/{collections_chart.dependencies_count_all}: {collection_chart_name}:"
-                )
-                collection_chart.lint_chart(build_version=True)
-                collection_chart.lint_kubeval(build_version=True)
-                collection_chart.make_package()
-                bar()
+            with ThreadPool(BuildUtils.parallel_processes) as threadpool:
+                for collection_chart_index, (collection_chart, exit_code) in enumerate(
+                    threadpool.imap_unordered(
+                        parallel_lint_and_package,
+                        collections_chart.dependencies.values(),
+                    )
+                ):
+                    BuildUtils.logger.info(
+                        f"Collection chart {collection_chart_index+1}/{collections_chart.dependencies_count_all}: {collection_chart.name}: DONE"
+                    )
+                    if exit_code is not None:
+                        threadpool.terminate()
+                        exit(exit_code)
+                    bar()
         collection_container = [
             x
             for x in BuildUtils.container_images_available
@@ -1289,16 +1353,6 @@ class HelmChart:
         nx_graph = generate_build_graph(platform_chart=platform_chart)
         build_order = BuildUtils.get_build_order(build_graph=nx_graph)
 
-        assert exists(platform_chart.build_chartfile)
-        BuildUtils.logger.debug(f"creating chart package ...")
-        platform_chart.make_package()
-        platform_chart.push()
-        BuildUtils.logger.info(f"{platform_chart.chart_id}: DONE")
-
-        generate_deployment_script(platform_chart)
-
-        BuildUtils.logger.info("")
-        BuildUtils.logger.info("Start container build...")
         containers_to_built = []
         container_count = len(build_order)
         for i in range(0, container_count):
@@ -1327,105 +1381,143 @@ class HelmChart:
                     msg=f"{container_id} could not be found in available containers!",
                     level="FATAL",
                 )
-        containers_to_built_tmp = containers_to_built.copy()
-        list_mid_index = len(containers_to_built) // 2
-        for idx, container in enumerate(containers_to_built_tmp):
-            org_list_idx = containers_to_built.index(container)
-            local_base_image = False
-            for base_image in container.base_images:
-                if base_image.local_image:
-                    local_base_image = True
 
-            if container.local_image and not local_base_image:
-                containers_to_built.insert(0, containers_to_built.pop(org_list_idx))
+        if BuildUtils.build_dry_run:
+            BuildScheduler(
+                build_graph=nx_graph, containers_to_build=containers_to_built
+            ).dry_run()
+            return
 
-            elif container.local_image and local_base_image:
-                containers_to_built.insert(
-                    list_mid_index, containers_to_built.pop(org_list_idx)
-                )
+        assert exists(platform_chart.build_chartfile)
+        BuildUtils.logger.debug(f"creating chart package ...")
+        platform_chart.make_package()
+        platform_chart.push()
+        BuildUtils.logger.info(f"{platform_chart.chart_id}: DONE")
 
-            elif not container.local_image and local_base_image:
-                containers_to_built += [containers_to_built.pop(org_list_idx)]
+        generate_deployment_script(platform_chart)
 
         BuildUtils.logger.info("")
-        BuildUtils.logger.info("")
-        build_rounds = 0
-
-        containers_to_built = [
-            (x, containers_to_built[x]) for x in range(0, len(containers_to_built))
-        ]
-        waiting_containers_to_built = sorted(containers_to_built).copy()
-        with alive_bar(container_count, dual_line=True, title="Container-Build") as bar:
-            with ThreadPool(BuildUtils.parallel_processes) as threadpool:
-                while (
-                    len(waiting_containers_to_built) != 0
-                    and build_rounds <= BuildUtils.max_build_rounds
-                ):
-                    build_rounds += 1
-                    BuildUtils.logger.info("")
-                    BuildUtils.logger.info(f"Build round: {build_rounds}")
-                    BuildUtils.logger.info("")
-                    tmp_waiting_containers_to_built = []
-                    result_containers = threadpool.imap_unordered(
-                        parallel_execute, waiting_containers_to_built
+        BuildUtils.logger.info("Start container build...")
+        if BuildUtils.build_scheduler == "dag":
+            with alive_bar(
+                container_count, dual_line=True, title="Container-Build"
+            ) as bar:
+                BuildScheduler(
+                    build_graph=nx_graph, containers_to_build=containers_to_built
+                ).run(
+                    successful_built_containers=successful_built_containers,
+                    lock=semaphore_successful_built_containers,
+                    bar=bar,
+                )
+        else:
+            containers_to_built_tmp = containers_to_built.copy()
+            list_mid_index = len(containers_to_built) // 2
+            for idx, container in enumerate(containers_to_built_tmp):
+                org_list_idx = containers_to_built.index(container)
+                local_base_image = False
+                for base_image in container.base_images:
+                    if base_image.local_image:
+                        local_base_image = True
+
+                if container.local_image and not local_base_image:
+                    containers_to_built.insert(0, containers_to_built.pop(org_list_idx))
+
+                elif container.local_image and local_base_image:
+                    containers_to_built.insert(
+                        list_mid_index, containers_to_built.pop(org_list_idx)
                     )
-                    for (
-                        queue_id,
-                        result_container,
-                        issue,
-                        waiting,
-                        build_time_needed,
-                        push_time_needed,
-                    ) in result_containers:
-                        if waiting != None:
-                            BuildUtils.logger.info(
-                                f"{result_container.build_tag}: Base image {waiting} not ready yet -> waiting list"
-                            )
-                            tmp_waiting_containers_to_built.append(result_container)
-                        else:
-                            bar()
-                            BuildUtils.logger.info(
-                                f"{result_container.build_tag} - build: {build_time_needed} - push {push_time_needed} : DONE"
-                            )
-                            if issue != None:
-                                # Close threadpool if error is fatal
-                                if (
-                                    BuildUtils.exit_on_error
-                                    or issue["level"] == "FATAL"
-                                ):
-                                    threadpool.terminate()
-
-                                bar.text(f"{result_container.tag}: ERROR")
-                                BuildUtils.logger.info("")
-                                BuildUtils.generate_issue(
-                                    component=issue["component"],
-                                    name=issue["name"],
-                                    level=issue["level"],
-                                    msg=issue["msg"],
-                                    output=(
-                                        issue["output"] if "output" in issue else None
-                                    ),
-                                    path=issue["path"] if "path" in issue else "",
+
+                elif not container.local_image and local_base_image:
+                    containers_to_built += [containers_to_built.pop(org_list_idx)]
+
+            BuildUtils.logger.info("")
+            BuildUtils.logger.info("")
+            build_rounds = 0
+
+            containers_to_built = [
+                (x, containers_to_built[x]) for x in range(0, len(containers_to_built))
+            ]
+            waiting_containers_to_built = sorted(containers_to_built).copy()
+            with alive_bar(container_count, dual_line=True, title="Container-Build") as bar:
+                with ThreadPool(BuildUtils.parallel_processes) as threadpool:
+                    while (
+                        len(waiting_containers_to_built) != 0
+                        and build_rounds <= BuildUtils.max_build_rounds
+                    ):
+                        build_rounds += 1
+                        BuildUtils.logger.info("")
+                        BuildUtils.logger.info(f"Build round: {build_rounds}")
+                        BuildUtils.logger.info("")
+                        tmp_waiting_containers_to_built = []
+                        result_containers = threadpool.imap_unordered(
+                            parallel_execute, waiting_containers_to_built
+                        )
+                        for (
+                            queue_id,
+                            result_container,
+                            issue,
+                            waiting,
+                            build_time_needed,
+                            push_time_needed,
+                        ) in result_containers:
+                            if waiting != None:
+                                BuildUtils.logger.info(
+                                    f"{result_container.build_tag}: Base image {waiting} not ready yet -> waiting list"
                                 )
+                                tmp_waiting_containers_to_built.append(result_container)
                             else:
-                                bar.text(f"{result_container.build_tag}: ok")
+                                bar()
+                                BuildUtils.logger.info(
+                                    f"{result_container.build_tag} - build: {build_time_needed} - push {push_time_needed} : DONE"
+                                )
+                                if issue != None:
+                                    # Close threadpool if error is fatal
+                                    if (
+                                        BuildUtils.exit_on_error
+                                        or issue["level"] == "FATAL"
+                                    ):
+                                        threadpool.terminate()
+
+                                    bar.text(f"{result_container.tag}: ERROR")
+                                    BuildUtils.logger.info("")
+                                    BuildUtils.generate_issue(
+                                        component=issue["component"],
+                                        name=issue["name"],
+                                        level=issue["level"],
+                                        msg=issue["msg"],
+                                        output=(
+                                            issue["output"] if "output" in issue else None
+                                        ),
+                                        path=issue["path"] if "path" in issue else "",
+                                    )
+                                else:
+                                    bar.text(f"{result_container.build_tag}: ok")
+
+                        tmp_waiting_containers_to_built = [
+                            (x, tmp_waiting_containers_to_built[x])
+                            for x in range(0, len(tmp_waiting_containers_to_built))
+                        ]
+                        waiting_containers_to_built = tmp_waiting_containers_to_built.copy()
 
-                    tmp_waiting_containers_to_built = [
-                        (x, tmp_waiting_containers_to_built[x])
-                        for x in range(0, len(tmp_waiting_containers_to_built))
-                    ]
-                    waiting_containers_to_built = tmp_waiting_containers_to_built.copy()
+            if (
+                build_rounds == BuildUtils.max_build_rounds
+                and len(waiting_containers_to_built) > 0
+            ):
+                BuildUtils.generate_issue(
+                    component=suite_tag,
+                    name="container_build",
+                    msg=f"There were too many build-rounds! Still missing: {waiting_containers_to_built}",
+                    level="FATAL",
+                )
 
-        if (
-            build_rounds == BuildUtils.max_build_rounds
-            and len(waiting_containers_to_built) > 0
-        ):
-            BuildUtils.generate_issue(
-                component=suite_tag,
-                name="container_build",
-                msg=f"There were too many build-rounds! Still missing: {waiting_containers_to_built}",
-                level="FATAL",
-            )
+        BuildTrace.generate_report(
+            build_order=build_order,
+            containers=[
+                x
+                for x in BuildUtils.container_images_available
+                if x.tag in build_order
+            ],
+        )
 
         BuildUtils.logger.info("")
         BuildUtils.logger.info("")
@@ -1516,6 +1608,7 @@ class HelmChart:
                 )
 
         BuildUtils.generate_component_usage_info()
+        BuildTrace.save()
 
 
 ############################################################
@@ -1534,6 +1627,9 @@ def init_helm_charts(
 
     check_helm_installed()
 
+    if BuildUtils.build_cache:
+        HelmChartCache.init()
+
 
 if __name__ == "__main__":
     print("Please use the 'start_build.py' script to launch the build-process.")
@@ -4,12 +4,18 @@ import os
 from subprocess import PIPE, run
 from time import time
 from shutil import which
+from multiprocessing.pool import ThreadPool
+import threading
 from build_helper.build_utils import BuildUtils
+from build_helper.build_cache import BuildCache, build_hash_label
+from build_helper.build_trace import BuildTrace
 from alive_progress import alive_bar
 import json
 
 suite_tag = "Container"
 max_retries = 30
+dockerfile_cache_filename = "dockerfile_cache.json"
+ignored_dir_names = ["node_modules", "__pycache__"]
 
 
 def container_registry_login(username, password):
@@ -156,6 +162,23 @@ def get_image_stats(version):
     return images_stats
 
 
+def parallel_collect_container(dockerfile):
+    # generate_issue() exits on errors -> hand the exit over to the main thread
+    try:
+        return Container(dockerfile), None
+    except SystemExit as e:
+        return None, e.code
+
+
+def parallel_check_dockerfile(dockerfile):
+    # generate_issue() exits on errors -> hand the exit over to the main thread
+    try:
+        BuildUtils.trivy_utils.check_dockerfile(dockerfile)
+    except SystemExit as e:
+        return e.code
+    return None
+
+
 class BaseImage:
     registry = None
     project = None
@@ -226,6 +249,8 @@ class Container:
     container_push_status = None
     local_image = None
     image_size = None
+    dockerfile_cache = {}
+    semaphore_dockerfile_cache = threading.Lock()
 
     def __eq__(self, other):
         if isinstance(self, str):
@@ -276,6 +301,7 @@ class Container:
         self.container_push_status = "None"
         self.local_image = False
         self.build_tag = None
+        self.build_cache_hit = False
         self.operator_containers = None
 
         if not os.path.isfile(dockerfile):
@@ -283,6 +309,77 @@ class Container:
             if BuildUtils.exit_on_error:
                 exit(1)
 
+        dockerfile_info = Container.parse_dockerfile(dockerfile)
+        self.registry = dockerfile_info["registry"]
+        self.image_name = dockerfile_info["image_name"]
+        self.repo_version = dockerfile_info["repo_version"]
+        self.build_ignore = dockerfile_info["build_ignore"]
+        for base_img_tag in dockerfile_info["base_images"]:
+            base_img_obj = BaseImage(tag=base_img_tag)
+            if base_img_obj not in self.base_images:
+                self.base_images.append(base_img_obj)
+                BuildUtils.base_images_used.setdefault(base_img_obj.tag, []).append(
+                    self
+                )
+
+        if (
+            self.repo_version == None
+            and self.repo_version == ""
+            or self.image_name == None
+            or self.image_name == ""
+        ):
+            BuildUtils.logger.debug(
+                f"{self.container_dir}: could not extract container infos!"
+            )
+            BuildUtils.generate_issue(
+                component=suite_tag,
+                name=f"{self.container_dir}",
+                msg="could not extract container infos!",
+                level="ERROR",
+            )
+            return
+
+        else:
+            self.registry = (
+                self.registry
+                if self.registry != None
+                else BuildUtils.default_registry
+            )
+            if "local-only" in self.registry:
+                self.local_image = True
+                self.repo_version = "latest"
+
+            else:
+                (
+                    build_version,
+                    build_branch,
+                    last_commit,
+                    last_commit_timestamp,
+                ) = BuildUtils.get_repo_info(self.container_dir)
+                self.repo_version = build_version
+
+            self.tag = (
+                self.registry + "/" + self.image_name + ":" + self.repo_version
+            )
+
+        self.check_if_dag()
+
+    @staticmethod
+    def parse_dockerfile(dockerfile):
+        dockerfile_mtime = os.stat(dockerfile).st_mtime
+        with Container.semaphore_dockerfile_cache:
+            cache_entry = Container.dockerfile_cache.get(dockerfile)
+        if cache_entry is not None and cache_entry["mtime"] == dockerfile_mtime:
+            return cache_entry
+
+        dockerfile_info = {
+            "mtime": dockerfile_mtime,
+            "registry": None,
+            "image_name": None,
+            "repo_version": None,
+            "build_ignore": False,
+            "base_images": [],
+        }
         with open(dockerfile, "rt") as f:
             lines = f.readlines()
             for line in lines:
@@ -292,7 +389,7 @@ class Container:
                     continue
 
                 if line.__contains__("LABEL REGISTRY="):
-                    self.registry = (
+                    dockerfile_info["registry"] = (
                         line.split("#")[0]
                         .split("=")[1]
                         .rstrip()
@@ -300,7 +397,7 @@ class Container:
                         .replace('"', "")
                     )
                 elif line.__contains__("LABEL IMAGE="):
-                    self.image_name = (
+                    dockerfile_info["image_name"] = (
                         line.split("#")[0]
                         .split("=")[1]
                         .rstrip()
@@ -308,7 +405,7 @@ class Container:
                         .replace('"', "")
                     )
                 elif line.__contains__("LABEL VERSION="):
-                    self.repo_version = (
+                    dockerfile_info["repo_version"] = (
                         line.split("#")[0]
                         .split("=")[1]
                         .rstrip()
@@ -326,18 +423,11 @@ class Container:
                         .strip()
                         .replace('"', "")
                     )
-                    base_img_obj = BaseImage(tag=base_img_tag)
-                    if base_img_obj not in self.base_images:
-                        self.base_images.append(base_img_obj)
-                        if base_img_obj.tag not in BuildUtils.base_images_used:
-                            BuildUtils.base_images_used[base_img_obj.tag] = []
-
-                        BuildUtils.base_images_used[base_img_obj.tag].append(
-                            self
-                        )
+                    if base_img_tag not in dockerfile_info["base_images"]:
+                        dockerfile_info["base_images"].append(base_img_tag)
 
                 elif line.__contains__("LABEL BUILD_IGNORE="):
-                    self.build_ignore = (
+                    dockerfile_info["build_ignore"] = (
                         True
                         if line.split("#")[0]
                         .split("=")[1]
@@ -349,47 +439,9 @@ class Container:
                         else False
                     )
 
-        if (
-            self.repo_version == None
-            and self.repo_version == ""
-            or self.image_name == None
-            or self.image_name == ""
-        ):
-            BuildUtils.logger.debug(
-                f"{self.container_dir}: could not extract container infos!"
-            )
-            BuildUtils.generate_issue(
-                component=suite_tag,
-                name=f"{self.container_dir}",
-                msg="could not extract container infos!",
-                level="ERROR",
-            )
-            return
-
-        else:
-            self.registry = (
-                self.registry
-                if self.registry != None
-                else BuildUtils.default_registry
-            )
-            if "local-only" in self.registry:
-                self.local_image = True
-                self.repo_version = "latest"
-
-            else:
-                (
-                    build_version,
-                    build_branch,
-                    last_commit,
-                    last_commit_timestamp,
-                ) = BuildUtils.get_repo_info(self.container_dir)
-                self.repo_version = build_version
-
-            self.tag = (
-                self.registry + "/" + self.image_name + ":" + self.repo_version
-            )
-
-        self.check_if_dag()
+        with Container.semaphore_dockerfile_cache:
+            Container.dockerfile_cache[dockerfile] = dockerfile_info
+        return dockerfile_info
 
     def check_prebuild(self):
         BuildUtils.logger.debug(f"{self.build_tag}: check_prebuild")
@@ -441,31 +493,26 @@ class Container:
                 return issue, duration_time_text
 
             startTime = time()
+            build_args = []
             if BuildUtils.http_proxy is not None:
-                command = [
-                    Container.container_engine,
-                    "build",
-                    "--build-arg",
+                build_args = [
                     f"http_proxy={BuildUtils.http_proxy}",
-                    "--build-arg",
                     f"https_proxy={BuildUtils.http_proxy}",
-                    "-t",
-                    self.build_tag,
-                    "-f",
-                    self.path,
-                    ".",
-                ]
-            else:
-                command = [
-                    Container.container_engine,
-                    "build",
-                    "-t",
-                    self.build_tag,
-                    "-f",
-                    self.path,
-                    ".",
                 ]
 
+            build_hash = None
+            if BuildUtils.build_cache:
+                build_hash = BuildCache.get_build_hash(self, build_args=build_args)
+                if build_hash is not None and BuildCache.reuse(self, build_hash):
+                    return issue, duration_time_text
+
+            command = [Container.container_engine, "build"]
+            for build_arg in build_args:
+                command += ["--build-arg", build_arg]
+            if build_hash is not None:
+                command += ["--label", f"{build_hash_label}={build_hash}"]
+            command += ["-t", self.build_tag, "-f", self.path, "."]
+
             output = run(
                 command,
                 stdout=PIPE,
@@ -479,6 +526,13 @@ class Container:
                 ),
             )
 
+            BuildTrace.add_span(
+                self.build_tag,
+                "container-build",
+                startTime,
+                time(),
+                returncode=output.returncode,
+            )
             if output.returncode == 0:
                 if "---> Running in" in output.stdout:
                     self.container_build_status = "built"
@@ -491,6 +545,9 @@ class Container:
                         f"{self.build_tag}: Build sucessful - no changes."
                     )
 
+                if build_hash is not None:
+                    BuildCache.add(self, build_hash)
+
                 hours, rem = divmod(time() - startTime, 3600)
                 minutes, seconds = divmod(rem, 60)
                 duration_time_text = "{:0>2}:{:0>2}:{:05.2f}".format(
@@ -631,6 +688,7 @@ class Container:
             BuildUtils.logger.debug(f"{self.build_tag}: start pushing! ")
             retries = 0
             command = [Container.container_engine, "push", self.build_tag]
+            push_start_time = time()
             while retries < max_retries:
                 startTime = time()
                 retries += 1
@@ -651,6 +709,14 @@ class Container:
                     or "configured as immutable" in output.stderr
                 ):
                     break
+            BuildTrace.add_span(
+                self.build_tag,
+                "container-push",
+                push_start_time,
+                time(),
+                returncode=output.returncode,
+                retries=retries,
+            )
             if output.returncode == 0:
                 self.container_push_status = "pushed"
 
@@ -758,6 +824,9 @@ class Container:
         Container.enable_build = enable_build
         Container.enable_push = enable_push
 
+        if BuildUtils.build_cache:
+            BuildCache.init(container_engine=container_engine)
+
         BuildUtils.logger.debug("")
         BuildUtils.logger.debug(" -> Container Init")
         BuildUtils.logger.debug(
@@ -773,6 +842,68 @@ class Container:
             if BuildUtils.exit_on_error:
                 exit(1)
 
+    @staticmethod
+    def is_build_ignored(path):
+        return (
+            BuildUtils.build_ignore_patterns != None
+            and len(BuildUtils.build_ignore_patterns) > 0
+            and sum(
+                [
+                    ignore_pattern in path
+                    for ignore_pattern in BuildUtils.build_ignore_patterns
+                ]
+            )
+            != 0
+        )
+
+    @staticmethod
+    def find_dockerfiles(source_dir, exact_name=False):
+        # Prune ignored, hidden and node_modules dirs during the traversal
+        # -> all files below an ignored dir would be ignored anyway.
+        dockerfiles_found = []
+        for root, dirs, files in os.walk(source_dir):
+            dirs[:] = [
+                x
+                for x in dirs
+                if not x.startswith(".")
+                and x not in ignored_dir_names
+                and not Container.is_build_ignored(os.path.join(root, x))
+            ]
+            for file in files:
+                if (exact_name and file == "Dockerfile") or (
+                    not exact_name and file.startswith("Dockerfile")
+                ):
+                    dockerfiles_found.append(os.path.join(root, file))
+        return dockerfiles_found
+
+    @staticmethod
+    def load_dockerfile_cache():
+        Container.dockerfile_cache = {}
+        if BuildUtils.build_cache_dir is None:
+            return
+        dockerfile_cache_path = os.path.join(
+            BuildUtils.build_cache_dir, dockerfile_cache_filename
+        )
+        if os.path.exists(dockerfile_cache_path):
+            try:
+                with open(dockerfile_cache_path, "r") as f:
+                    Container.dockerfile_cache = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                BuildUtils.logger.warning(
+                    f"Could not load Dockerfile cache {dockerfile_cache_path}: {e}"
+                )
+
+    @staticmethod
+    def save_dockerfile_cache():
+        if BuildUtils.build_cache_dir is None:
+            return
+        os.makedirs(BuildUtils.build_cache_dir, exist_ok=True)
+        dockerfile_cache_path = os.path.join(
+            BuildUtils.build_cache_dir, dockerfile_cache_filename
+        )
+        with open(dockerfile_cache_path, "w") as f:
+            json.dump(Container.dockerfile_cache, f)
+
     @staticmethod
     def collect_containers():
         BuildUtils.logger.debug("")
@@ -780,9 +911,7 @@ class Container:
         Container.container_object_list = []
         Container.used_tags_list = []
 
-        dockerfiles_found = glob(
-            BuildUtils.kaapana_dir + "/**/Dockerfile*", recursive=True
-        )
+        dockerfiles_found = Container.find_dockerfiles(BuildUtils.kaapana_dir)
         BuildUtils.logger.info("")
         BuildUtils.logger.info(
             f"-> Found {len(dockerfiles_found)} Dockerfiles @Kaapana"
@@ -797,8 +926,8 @@ class Container:
                 BuildUtils.logger.info(
                     f"-> adding external sources: {external_source}"
                 )
-                external_dockerfiles_found = glob(
-                    external_source + "/**/Dockerfile", recursive=True
+                external_dockerfiles_found = Container.find_dockerfiles(
+                    external_source, exact_name=True
                 )
                 external_dockerfiles_found = [
                     x
@@ -825,49 +954,49 @@ class Container:
                 BuildUtils.logger.warning(duplicate)
             BuildUtils.logger.warning("")
 
-        # Init Trivy if configuration check is enabled
+        dockerfiles_found = sorted(set(dockerfiles_found))
+        for dockerfile in dockerfiles_found:
+            if Container.is_build_ignored(dockerfile):
+                BuildUtils.logger.debug(f"Ignoring Dockerfile {dockerfile}")
+        dockerfiles_found = [
+            x for x in dockerfiles_found if not Container.is_build_ignored(x)
+        ]
+
+        # Check Dockerfiles for configuration errors using Trivy
+        # -> runs in the Trivy threadpool while the Dockerfiles are parsed
+        trivy_results = None
         if BuildUtils.configuration_check:
             trivy_utils = BuildUtils.trivy_utils
             trivy_utils.dockerfile_report_path = os.path.join(
                 trivy_utils.reports_path, "dockerfile_reports"
             )
             os.makedirs(trivy_utils.dockerfile_report_path, exist_ok=True)
+            trivy_results = trivy_utils.threadpool.map_async(
+                parallel_check_dockerfile, dockerfiles_found
+            )
 
-        dockerfiles_found = sorted(set(dockerfiles_found))
-
-        if BuildUtils.configuration_check:
-            bar_title = "Collect container and check configuration"
-        else:
-            bar_title = "Collect container"
-
+        Container.load_dockerfile_cache()
         with alive_bar(
-            len(dockerfiles_found), dual_line=True, title=bar_title
+            len(dockerfiles_found), dual_line=True, title="Collect container"
         ) as bar:
-            for dockerfile in dockerfiles_found:
-                bar()
-                if (
-                    BuildUtils.build_ignore_patterns != None
-                    and len(BuildUtils.build_ignore_patterns) > 0
-                    and sum(
-                        [
-                            ignore_pattern in dockerfile
-                            for ignore_pattern in BuildUtils.build_ignore_patterns
-                        ]
-                    )
-                    != 0
+            with ThreadPool(os.cpu_count()) as threadpool:
+                # imap keeps the (sorted) order of the Dockerfiles
+                for container, exit_code in threadpool.imap(
+                    parallel_collect_container, dockerfiles_found
                 ):
-                    BuildUtils.logger.debug(
-                        f"Ignoring Dockerfile {dockerfile}"
-                    )
-                    continue
-
-                # Check Dockerfiles for configuration errors using Trivy
-                if BuildUtils.configuration_check:
-                    trivy_utils.check_dockerfile(dockerfile)
-
-                container = Container(dockerfile)
-                bar.text(container.image_name)
-                Container.container_object_list.append(container)
+                    if exit_code is not None:
+                        threadpool.terminate()
+                        exit(exit_code)
+                    bar()
+                    bar.text(container.image_name)
+                    Container.container_object_list.append(container)
+        Container.save_dockerfile_cache()
+
+        if trivy_results is not None:
+            BuildUtils.logger.info("Waiting for Dockerfile configuration checks ...")
+            for exit_code in trivy_results.get():
+                if exit_code is not None:
+                    exit(exit_code)
 
         Container.container_object_list = Container.check_base_containers(
             Container.container_object_list
@@ -575,7 +575,9 @@ class TrivyUtils:
     # Function to check Dockerfile for configuration errors
     def check_dockerfile(self, path_to_dockerfile):
 
-        module = "_".join(path_to_dockerfile.split("/")[-4:-1])
+        # the Dockerfile name is part of the report name: Dockerfiles of the same
+        # directory are checked in parallel
+        module = "_".join(path_to_dockerfile.split("/")[-4:])
 
         command = [
             "trivy",
@@ -10,9 +10,11 @@ from build_helper.charts_helper import HelmChart, init_helm_charts, helm_registr
 from build_helper.container_helper import Container, container_registry_login
 from build_helper.build_utils import BuildUtils
 from build_helper.security_utils import TrivyUtils
+from build_helper.build_trace import BuildTrace
 
 
 supported_log_levels = ["DEBUG", "INFO", "WARN", "ERROR"]
+supported_build_schedulers = ["dag", "rounds"]
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -119,6 +121,29 @@ if __name__ == "__main__":
         default=2,
         help="Parallel process count for container build + push.",
     )
+    parser.add_argument(
+        "-bs",
+        "--build-scheduler",
+        dest="build_scheduler",
+        default=None,
+        help="Container build scheduler: 'dag' or 'rounds'.",
+    )
+    parser.add_argument(
+        "-dry",
+        "--dry-run",
+        dest="build_dry_run",
+        default=False,
+        action="store_true",
+        help="Only print the predicted container build schedule and makespan -> no build or push.",
+    )
+    parser.add_argument(
+        "-bc",
+        "--build-cache",
+        dest="build_cache",
+        default=None,
+        action="store_true",
+        help="Skip containers which did not change since the last build (content-hash build-cache).",
+    )
     parser.add_argument(
         "-ic",
         "--include-credentials",
@@ -378,6 +403,26 @@ if __name__ == "__main__":
         if "parallel_processes" in configuration
         else template_configuration["parallel_processes"]
     )
+    conf_build_scheduler = (
+        configuration["build_scheduler"]
+        if "build_scheduler" in configuration
+        else template_configuration["build_scheduler"]
+    )
+    conf_build_cache_dir = (
+        configuration["build_cache_dir"]
+        if "build_cache_dir" in configuration
+        else template_configuration["build_cache_dir"]
+    )
+    conf_build_cache = (
+        configuration["build_cache"]
+        if "build_cache" in configuration
+        else template_configuration["build_cache"]
+    )
+    conf_build_cache_registry = (
+        configuration["build_cache_registry"]
+        if "build_cache_registry" in configuration
+        else template_configuration["build_cache_registry"]
+    )
     conf_registry_username = (
         configuration["registry_username"]
         if "registry_username" in configuration
@@ -486,6 +531,17 @@ if __name__ == "__main__":
         if args.parallel_processes != 2
         else conf_parallel_processes
     )
+    build_scheduler = (
+        args.build_scheduler if args.build_scheduler != None else conf_build_scheduler
+    )
+    build_dry_run = args.build_dry_run
+    build_cache_dir = (
+        conf_build_cache_dir
+        if conf_build_cache_dir != ""
+        else join(os.path.expanduser("~"), ".cache", "kaapana-build")
+    )
+    build_cache = args.build_cache if args.build_cache != None else conf_build_cache
+    build_cache_registry = conf_build_cache_registry
     include_credentials = (
         args.include_credentials
         if args.include_credentials != None
@@ -590,6 +646,11 @@ if __name__ == "__main__":
     logger.info(f"{build_installer_scripts=}")
     logger.info(f"{push_to_microk8s=}")
     logger.info(f"{build_dir=}")
+    logger.info(f"{build_scheduler=}")
+    logger.info(f"{build_dry_run=}")
+    logger.info(f"{build_cache_dir=}")
+    logger.info(f"{build_cache=}")
+    logger.info(f"{build_cache_registry=}")
     logger.info(f"{kaapana_dir=}")
     logger.info(f"{no_login=}")
     logger.info(f"{version_latest=}")
@@ -600,7 +661,7 @@ if __name__ == "__main__":
     logger.info("")
     logger.info("-----------------------------------------------------------")
 
-    if not build_only and not no_login:
+    if not build_only and not no_login and not build_dry_run:
         if registry_user is None:
             registry_user = os.getenv("REGISTRY_USER", None)
         if registry_pwd is None:
@@ -615,6 +676,13 @@ if __name__ == "__main__":
             logger.error("Or use the ENVs: 'REGISTRY_USER' & 'REGISTRY_PW' !")
             exit(1)
 
+    if build_scheduler not in supported_build_schedulers:
+        logger.error(f"Build scheduler {build_scheduler} not supported.")
+        logger.error(
+            "Please use 'dag' or 'rounds' for build_scheduler in build-config.yaml"
+        )
+        exit(1)
+
     if log_level not in supported_log_levels:
         logger.error(f"Log level {log_level} not supported.")
         logger.error(
@@ -636,6 +704,7 @@ if __name__ == "__main__":
         exit(1)
 
     BuildUtils.init()
+    BuildTrace.init()
     BuildUtils.kaapana_dir = kaapana_dir
     BuildUtils.build_dir = build_dir
     BuildUtils.external_source_dirs = external_source_dirs
@@ -649,6 +718,11 @@ if __name__ == "__main__":
     BuildUtils.create_offline_installation = create_offline_installation
     BuildUtils.skip_push_no_changes = skip_push_no_changes
     BuildUtils.parallel_processes = parallel_processes
+    BuildUtils.build_scheduler = build_scheduler
+    BuildUtils.build_dry_run = build_dry_run
+    BuildUtils.build_cache_dir = build_cache_dir
+    BuildUtils.build_cache = build_cache
+    BuildUtils.build_cache_registry = build_cache_registry
     BuildUtils.include_credentials = include_credentials
     BuildUtils.registry_user = registry_user
     BuildUtils.registry_pwd = registry_pwd
@@ -677,7 +751,7 @@ if __name__ == "__main__":
         enable_push=containers_push,
     )
 
-    if not build_only and not no_login:
+    if not build_only and not no_login and not build_dry_run:
         container_registry_login(username=registry_user, password=registry_pwd)
         helm_registry_login(username=registry_user, password=registry_pwd)
 
@@ -11,6 +11,7 @@ import torch
 import random
 import tarfile
 import functools
+from pathlib import Path
 from minio import Minio
 from abc import ABC, abstractmethod
 from requests.adapters import HTTPAdapter
@@ -113,6 +114,97 @@ def minio_rmtree(minioClient, bucket_name, object_name):
         raise NameError("Error occured when deleting object", error)
 
 
+class StreamingFedAvg(object):
+    """
+    Sample-weighted FedAvg as running sum: the model_weights of a site are folded into the sum
+    as soon as they are available and can be released afterwards, so at most one site's
+    model_weights and the sum are in memory (instead of the model_weights of all sites).
+
+    Note:
+    * the floating point tensors are summed in one flat buffer per dtype, the state dict of the
+      result consists of views into these buffers
+    * keys pointing to the same data (same .data_ptr(), see https://github.com/MIC-DKFZ/nnUNet/issues/2553)
+      are summed once and point to the same view in the result
+    * tensors which are not floating point (e.g. counters) are taken from the first site
+    """
+
+    def __init__(self):
+        self.site_names = []
+        self.num_all_samples = 0
+        self.averaged = False
+        self.model_weights = None
+        self.keys = []
+        self.buffers = {}
+
+    def _init_buffers(self, model_weights):
+        offsets = {}
+        numels = collections.defaultdict(int)
+        address_key_dict = {}
+        for k, v in model_weights.items():
+            if not torch.is_tensor(v) or not v.is_floating_point():
+                continue
+            address = (v.data_ptr(), v.dtype, tuple(v.shape), tuple(v.stride()))
+            if address in address_key_dict:
+                continue
+            address_key_dict[address] = k
+            offsets[k] = numels[v.dtype]
+            numels[v.dtype] += v.numel()
+            self.keys.append(k)
+
+        self.buffers = {
+            dtype: torch.zeros(numel, dtype=dtype) for dtype, numel in numels.items()
+        }
+        self.model_weights = collections.OrderedDict()
+        for k, v in model_weights.items():
+            if not torch.is_tensor(v) or not v.is_floating_point():
+                self.model_weights[k] = v.clone() if torch.is_tensor(v) else v
+                continue
+            first_key = address_key_dict[
+                (v.data_ptr(), v.dtype, tuple(v.shape), tuple(v.stride()))
+            ]
+            if first_key != k:
+                self.model_weights[k] = self.model_weights[first_key]
+                continue
+            self.model_weights[k] = self.buffers[v.dtype][
+                offsets[k] : offsets[k] + v.numel()
+            ].view(v.shape)
+
+    def add(self, site_name, model_weights, num_samples):
+        """
+        Adds model_weights * num_samples of a site to the sum.
+        """
+        if self.averaged:
+            raise ValueError("model_weights were already averaged!")
+        if site_name in self.site_names:
+            raise ValueError(f"model_weights of {site_name} were already added!")
+        if self.model_weights is None:
+            self._init_buffers(model_weights)
+        elif model_weights.keys() != self.model_weights.keys():
+            raise ValueError(
+                f"model_weights of {site_name} do not match the model_weights of {self.site_names[0]}!"
+            )
+        summed_weights = [self.model_weights[k] for k in self.keys]
+        torch._foreach_add_(
+            summed_weights,
+            [model_weights[k].to(v.dtype) for k, v in zip(self.keys, summed_weights)],
+            alpha=num_samples,
+        )
+        self.site_names.append(site_name)
+        self.num_all_samples += num_samples
+
+    def get_averaged_model_weights(self):
+        """
+        Divides the sum by the number of all samples and returns the averaged model_weights.
+        """
+        if self.num_all_samples == 0:
+            raise ValueError("No samples to average the model_weights with!")
+        if not self.averaged:
+            for buffer in self.buffers.values():
+                buffer /= self.num_all_samples
+            self.averaged = True
+        return self.model_weights
+
+
 class KaapanaFederatedTrainingBase(ABC):
     # Todo move in Jonas library as normal function
     @staticmethod
@@ -194,6 +286,7 @@ class KaapanaFederatedTrainingBase(ABC):
         workflow_dir=None,
     ):
         self.run_in_parallel = False
+        self.streaming_fed_avg = None
         self.federated_dir = os.getenv("RUN_ID", str(uuid.uuid4()))
         self.workflow_dir = workflow_dir or os.getenv("WORKFLOW_DIR")
         print("working directory", self.workflow_dir)
@@ -441,6 +534,13 @@ class KaapanaFederatedTrainingBase(ABC):
                             current_federated_round_dir, next_federated_round_dir
                         )
                     )
+            self.on_site_downloaded(
+                federated_round=federated_round,
+                instance_name=instance_name,
+                site_dir=os.path.join(
+                    self.fl_working_dir, str(federated_round), instance_name
+                ),
+            )
             print("Removing objects from previous federated_round_dir on Minio")
 
             if previous_federated_round_dir is not None:
@@ -450,6 +550,12 @@ class KaapanaFederatedTrainingBase(ABC):
                     os.path.join(previous_federated_round_dir, instance_name),
                 )
 
+    def on_site_downloaded(self, federated_round, instance_name, site_dir):
+        """
+        Called as soon as the files of a site are downloaded, decrypted and extracted to site_dir.
+        """
+        pass
+
     @abstractmethod
     @timeit
     def update_data(self, federated_round, tmp_central_site_info):
@@ -475,29 +581,16 @@ class KaapanaFederatedTrainingBase(ABC):
             site_model_weights_dict[site_name] = checkpoint["network_weights"]
         return site_model_weights_dict
 
-    # @timeit
-    def fed_avg(self, site_model_weights_dict=None):
+    def get_num_samples_per_client(self):
         """
-        FedAvg: Communication-efficient Learning of Deep networks from Decentralized Data (https://arxiv.org/abs/1602.05629)
-        Sum model_weights up.
-        Divide summed model_weights by num_sites.
-        Return a site_model_weights_dict with always the same model_weights per site.
-
-        Note:
-        * perform averaging based on pointers on the dict keys obtained with .data_ptr()
-        * solution from https://github.com/MIC-DKFZ/nnUNet/issues/2553
-        * btw site_model_weights_dict looks like that: site_model_weights_dict = {"<siteA>": <model_weights_0> , "<siteB>": <model_weights_1>, ...}
+        Number of samples per client_instance_name for sample-weighted aggregation.
         """
-
-        # for sample-weighted aggregation, get number of samples per client and list of client_instance_names
         num_samples_per_client = dict()
-        client_instance_names = []
 
         dataset_limit = self.remote_conf_data.get("data_form", {}).get(
             "dataset_limit", None
         )
         for site_idx, _ in enumerate(self.remote_sites):
-            client_instance_names.append(self.remote_sites[site_idx]["instance_name"])
             dataset_name = self.remote_conf_data["data_form"]["dataset_name"]
             allowed_datasets = self.remote_sites[site_idx]["allowed_datasets"]
             identifiers = next(
@@ -523,39 +616,41 @@ class KaapanaFederatedTrainingBase(ABC):
             f"Averaging model weights with client's dataset sizes: {num_samples_per_client} \
             and total number of samples of {num_all_samples}!"
         )
+        return num_samples_per_client
 
-        # initialize network_weights with those of first client_instance
-        list_of_network_parameters = list(site_model_weights_dict.values())
-        network_weights = site_model_weights_dict[client_instance_names[0]]
-        # get addresses of keys
-        keys = list(network_weights.keys())
-        address_key_dict = {}
-        for k in keys:
-            address = network_weights[k].data_ptr()
-            if address not in address_key_dict.keys():
-                address_key_dict[address] = [k]
-            else:
-                address_key_dict[address].append(k)
-
-        # perform the fedavg
-        for a in address_key_dict.keys():
-            for client_instance_name, net in site_model_weights_dict.items():
-                if client_instance_name == client_instance_names[0]:
-                    # network weights of client_instance_names [0] are already in network_weights
-                    # we still need to weight client 0's model params with it's dataset size
-                    network_weights[address_key_dict[a][0]] = (
-                        network_weights[address_key_dict[a][0]]
-                        * num_samples_per_client[client_instance_name]
-                    )
-                else:
-                    # weighted sum
-                    network_weights[address_key_dict[a][0]] += (
-                        net[address_key_dict[a][0]]
-                        * num_samples_per_client[client_instance_name]
-                    )
-            # divided by num_all_samples
-            network_weights[address_key_dict[a][0]] /= num_all_samples
-            # modifying the 0th keys is sufficient as the other keys point to the same data
+    def is_fed_avg_round(self, federated_round):
+        """
+        True if the model_weights of federated_round are averaged (FedAvg or aggregation round of FedDC).
+        """
+        aggregation_strategy = getattr(self, "aggregation_strategy", None)
+        if aggregation_strategy == "fedavg":
+            return True
+        if aggregation_strategy == "feddc":
+            # average in fl_round=-1 to initialize everywhere w/ same model
+            return federated_round == -1 or (federated_round % self.agg_rate) == (
+                self.agg_rate - 1
+            )
+        return False
+
+    # @timeit
+    def fed_avg(self, site_model_weights_dict=None):
+        """
+        FedAvg: Communication-efficient Learning of Deep networks from Decentralized Data (https://arxiv.org/abs/1602.05629)
+        Sum model_weights weighted by the client's dataset size up.
+        Divide summed model_weights by the number of all samples.
+        Return a site_model_weights_dict with always the same model_weights per site.
+
+        Note:
+        * btw site_model_weights_dict looks like that: site_model_weights_dict = {"<siteA>": <model_weights_0> , "<siteB>": <model_weights_1>, ...}
+        * see StreamingFedAvg, fed_avg_streaming averages without loading all model_weights at once
+        """
+        num_samples_per_client = self.get_num_samples_per_client()
+        streaming_fed_avg = StreamingFedAvg()
+        for site_name, model_weights in site_model_weights_dict.items():
+            streaming_fed_avg.add(
+                site_name, model_weights, num_samples_per_client[site_name]
+            )
+        network_weights = streaming_fed_avg.get_averaged_model_weights()
 
         # reformat to return
         return_model_weights_dict = collections.OrderedDict()
@@ -563,6 +658,63 @@ class KaapanaFederatedTrainingBase(ABC):
             return_model_weights_dict[site] = network_weights
         return return_model_weights_dict
 
+    def add_site_to_fed_avg(self, site_name, site_dir):
+        """
+        Adds the model_weights of a site (checkpoint below site_dir) to the streaming FedAvg
+        of the current round. The checkpoint is memory-mapped and released afterwards.
+        If a site has several checkpoints, the last one in sorted path order is used
+        (load_model_weights kept the last one as well).
+        """
+        if self.streaming_fed_avg is None:
+            self.streaming_fed_avg = StreamingFedAvg()
+            self.num_samples_per_client = self.get_num_samples_per_client()
+        fnames = sorted(Path(site_dir).rglob("checkpoint_final.pth"))
+        if len(fnames) == 0:
+            return
+        if len(fnames) > 1:
+            print(
+                f"WARNING: {len(fnames)} checkpoints found for {site_name}: {[str(x) for x in fnames]} "
+                f"-> using {fnames[-1]}"
+            )
+        fname = fnames[-1]
+        print(f"Adding model_weights from: {fname}")
+        checkpoint = torch.load(fname, map_location=torch.device("cpu"), mmap=True)
+        self.streaming_fed_avg.add(
+            site_name,
+            checkpoint["network_weights"],
+            self.num_samples_per_client[site_name],
+        )
+        del checkpoint
+
+    # @timeit
+    def fed_avg_streaming(self, current_federated_round_dir=None):
+        """
+        Same as fed_avg(load_model_weights(current_federated_round_dir)), but only the running
+        sum and the model_weights of one site are in memory.
+        Sites which were not added during the download (add_site_to_fed_avg) are added now.
+        """
+        for site_dir in sorted(Path(current_federated_round_dir).iterdir()):
+            if (
+                self.streaming_fed_avg is not None
+                and site_dir.name in self.streaming_fed_avg.site_names
+            ):
+                continue
+            if site_dir.is_dir() and any(site_dir.rglob("checkpoint_final.pth")):
+                self.add_site_to_fed_avg(site_dir.name, site_dir)
+
+        streaming_fed_avg, self.streaming_fed_avg = self.streaming_fed_avg, None
+        if streaming_fed_avg is None:
+            raise ValueError(
+                f"No model_weights found in {current_federated_round_dir}!"
+            )
+        network_weights = streaming_fed_avg.get_averaged_model_weights()
+
+        # reformat to return
+        return_model_weights_dict = collections.OrderedDict()
+        for site in streaming_fed_avg.site_names:
+            return_model_weights_dict[site] = network_weights
+        return return_model_weights_dict
+
     # @timeit
     def fed_dc(
         self,
@@ -16,7 +16,7 @@ class ConnectedComponentAnalysisOperator(KaapanaBaseOperator):
     * 3D connectivity connectivity (6, 18, 26)
 
     **Outputs:**
-    * CCA info w/ number of CC and number of voxels per CC
+    * CCA info w/ number of CC and number of voxels, bounding box and centroid per CC
     """
 
     def __init__(
@@ -25,6 +25,7 @@ class ConnectedComponentAnalysisOperator(KaapanaBaseOperator):
         env_vars=None,
         json_operator=None,
         connectivity=26,
+        threads=None,
         execution_timeout=timedelta(days=5),
         **kwargs,
     ):
@@ -38,6 +39,7 @@ class ConnectedComponentAnalysisOperator(KaapanaBaseOperator):
             "CONNECTIVITY": str(connectivity)
             if connectivity is not None
             else str(None),
+            "THREADS": str(threads),
         }
 
         env_vars.update(envs)
@@ -22,6 +22,7 @@ class DcmQueryOperator(KaapanaBaseOperator):
         start_date: date = None,
         end_date: date = None,
         max_query_size: str = None,
+        num_associations: int = 4,
         env_vars=None,
         level="study",
         execution_timeout=timedelta(minutes=20),
@@ -43,16 +44,17 @@ class DcmQueryOperator(KaapanaBaseOperator):
             "LOCAL_AE_TITLE": str(local_ae_title),
             "AE_TITLE": str(ae_title),
             "LEVEL": str(level),
+            "NUM_ASSOCIATIONS": str(num_associations),
         }
 
         if start_date:
-            env["START_DATE"] = start_date.strftime("%Y-%m-%d")
+            envs["START_DATE"] = start_date.strftime("%Y-%m-%d")
 
         if end_date:
-            env["END_DATE"] = end_date.strftime("%Y-%m-%d")
+            envs["END_DATE"] = end_date.strftime("%Y-%m-%d")
 
         if max_query_size:
-            env["MAX_QUERY_SIZE"] = int(max_query_size)
+            envs["MAX_QUERY_SIZE"] = str(int(max_query_size))
 
         env_vars.update(envs)
 
@@ -13,7 +13,7 @@ class DcmSendOperator(KaapanaBaseOperator):
     Operator sends data to the platform.
 
     This operator is used for sending data to the platform.
-    For dcmsend documentation please have a look at https://support.dcmtk.org/docs/dcmsend.html.
+    The instances are sent with C-STORE (pynetdicom) over parallel associations, failed instances are retried.
     """
 
     def __init__(
@@ -25,6 +25,7 @@ class DcmSendOperator(KaapanaBaseOperator):
         pacs_port: str = "11112",
         env_vars=None,
         level: str = "element",
+        num_associations: int = 4,
         execution_timeout: datetime = timedelta(minutes=60),
         **kwargs,
     ):
@@ -36,6 +37,7 @@ class DcmSendOperator(KaapanaBaseOperator):
         :param level: 'element' or batch'
             If batch, an operator folder next to the batch folder with .dcm files is expected.
             If element, \*.dcm are expected in the corresponding operator with .dcm files is expected.
+        :param num_associations: number of parallel associations to the PACS
         :param execution_timeout: timeout for connection requests
         """
 
@@ -54,6 +56,7 @@ class DcmSendOperator(KaapanaBaseOperator):
             "PACS_PORT": str(pacs_port),
             "AETITLE": str(ae_title),
             "LEVEL": str(level),
+            "NUM_ASSOCIATIONS": str(num_associations),
         }
 
         env_vars.update(envs)
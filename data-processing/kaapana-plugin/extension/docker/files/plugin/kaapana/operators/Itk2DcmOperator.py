@@ -32,14 +32,48 @@ class Itk2DcmOperator(KaapanaBaseOperator):
     """
 
     def __init__(
-        self, dag, name=None, execution_timeout=timedelta(minutes=90), *args, **kwargs
+        self,
+        dag,
+        name=None,
+        output_mode="slices",
+        use_compression=True,
+        parallel_processes=3,
+        parallel_cases=1,
+        env_vars=None,
+        execution_timeout=timedelta(minutes=90),
+        *args,
+        **kwargs,
     ) -> None:
+        """
+        :param output_mode: "slices" (default): one DICOM file per slice, "multiframe": one multi-frame DICOM file per series
+        :param use_compression: Write JPEG 2000 lossless compressed slices (default: True)
+        :param parallel_processes: Number of slices which are written in parallel (default: 3)
+        :param parallel_cases: Number of cases which are converted in parallel processes (default: 1)
+        """
         name = name if name is not None else "itk2dcm-converter"
 
+        if env_vars is None:
+            env_vars = {}
+
+        envs = {
+            "OUTPUT_MODE": output_mode,
+            "USE_COMPRESSION": str(use_compression),
+            "THREADS": str(parallel_processes),
+            "PARALLEL_CASES": str(parallel_cases),
+        }
+
+        env_vars.update(envs)
+
+        if output_mode not in ["slices", "multiframe"]:
+            raise ValueError(
+                f"Output mode not supported: {output_mode}. Supported modes: slices, multiframe"
+            )
+
         super().__init__(
             dag=dag,
             name=name,
             image=f"{DEFAULT_REGISTRY}/itk2dcm:{KAAPANA_BUILD_VERSION}",
+            env_vars=env_vars,
             image_pull_secrets=["registry-secret"],
             execution_timeout=execution_timeout,
             ram_mem_mb=6000,
@@ -15,6 +15,7 @@ class PyRadiomicsOperator(KaapanaBaseOperator):
     single-mask nifti files, so that the radiomics features will be calculated per class.
 
     Default behaviour is only shape and first order features.
+    The image is loaded once per series and the masks are extracted in parallel processes.
 
     - Publication:
       Van Griethuysen, J. J., Fedorov, A., Parmar, C., Hosny, A., Aucoin, N., Narayan, V., ... & Aerts, H. J. (2017).
@@ -28,6 +29,7 @@ class PyRadiomicsOperator(KaapanaBaseOperator):
         dag,
         segmentation_operator,
         alg_name=None,
+        threads=None,
         env_vars=None,
         execution_timeout=timedelta(minutes=90),
         **kwargs,
@@ -39,6 +41,8 @@ class PyRadiomicsOperator(KaapanaBaseOperator):
             # directory that contains the segmentation objects
             "OPERATOR_IN_SEGMENATIONS_DIR": segmentation_operator.operator_out_dir,
             "ALGORITHM_NAME": f'{alg_name or "kaapana"}',
+            # number of extraction processes, all available cores if None
+            "THREADS": str(threads),
         }
         env_vars.update(envs)
 
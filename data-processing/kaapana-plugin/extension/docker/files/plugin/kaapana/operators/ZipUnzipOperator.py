@@ -35,6 +35,8 @@ class ZipUnzipOperator(KaapanaBaseOperator):
         batch_level=False,
         whitelist_files=None,  # eg: "*.txt,*.png" or whole filenames
         blacklist_files=None,  # eg: "*.txt,*.png" or whole filenames
+        compression="auto",  # 'auto', 'store' or 'deflate'
+        threads=None,
         env_vars=None,
         execution_timeout=timedelta(minutes=10),
         **kwargs,
@@ -46,6 +48,8 @@ class ZipUnzipOperator(KaapanaBaseOperator):
         :param whitelist_files: Only for packing. List of files to include seperated by ',' eg: "*.txt,*.png" or whole filenames
         :param blacklist_files: Only for packing. List of files to exclude seperated by ',' eg: "*.txt,*.png" or whole filenames
         :param info_file: additional files to add to the target zip files
+        :param compression: Only for packing. "auto" stores already compressed files (e.g. *.nii.gz) and deflates all others with a fast level, "store" stores all files, "deflate" deflates all files with the default level.
+        :param threads: Number of threads used to compress or extract the files, the CPU limit of the container (or all available cores) if None.
         """
 
         if env_vars is None:
@@ -64,6 +68,8 @@ class ZipUnzipOperator(KaapanaBaseOperator):
             "BLACKLIST_FILES": blacklist_files
             if blacklist_files is not None
             else "NONE",
+            "COMPRESSION": compression,
+            "THREADS": str(threads),
         }
 
         env_vars.update(envs)
@@ -0,0 +1,78 @@
+import multiprocessing
+from os.path import basename
+
+import cc3d
+import nibabel as nib
+import numpy as np
+
+"""
+Documentation cca_statistics.py:
+
+Connected component statistics in O(voxels):
+The components are labeled once (cc3d.connected_components) and the volume, bounding box and
+centroid of all components are derived in one pass over the labels (cc3d.statistics).
+The files are processed in parallel processes.
+"""
+
+
+def load_mask(nifti_file):
+    """
+    Reads the mask with its stored integer values (uint8, or uint16 for labels > 255).
+    """
+    data = np.asanyarray(nib.load(nifti_file).dataobj)
+    if data.dtype == np.uint8:
+        return data
+    max_label = int(data.max()) if data.size > 0 else 0
+    return data.astype(np.uint8 if max_label <= 255 else np.uint16)
+
+
+def compute_cca(seg_data, connectivity):
+    """
+    Returns the number of connected components (cc) and the volume (voxels), bounding box
+    (inclusive voxel index: min x/y/z, max x/y/z) and centroid (voxel index x/y/z) per cc_id.
+    Different labels are separate components.
+    """
+    labels_out, N = cc3d.connected_components(
+        seg_data, connectivity=connectivity, return_N=True
+    )
+    statistics = cc3d.statistics(labels_out, no_slice_conversion=True)
+    # cc_id 0 is the background
+    voxel_counts = statistics["voxel_counts"][1:]
+    bounding_boxes = statistics["bounding_boxes"][1:]
+    centroids = statistics["centroids"][1:]
+    cc_ids = range(1, N + 1)
+    return {
+        "component_count": int(N),
+        "component_volumes": {
+            cc_id: int(volume) for cc_id, volume in zip(cc_ids, voxel_counts)
+        },
+        "component_bounding_boxes": {
+            cc_id: [int(x) for x in bounding_box[0::2]]
+            + [int(x) for x in bounding_box[1::2]]
+            for cc_id, bounding_box in zip(cc_ids, bounding_boxes)
+        },
+        "component_centroids": {
+            cc_id: [round(float(x), 2) for x in centroid]
+            for cc_id, centroid in zip(cc_ids, centroids)
+        },
+    }
+
+
+def compute_cca_for_file(nifti_file, connectivity):
+    return basename(nifti_file), compute_cca(load_mask(nifti_file), connectivity)
+
+
+def compute_cca_for_files(nifti_files, connectivity, num_processes):
+    """
+    Returns {file name: cca statistics} of all nifti_files.
+    """
+    if len(nifti_files) == 0:
+        return {}
+    num_processes = max(1, min(num_processes, len(nifti_files)))
+    with multiprocessing.get_context("spawn").Pool(num_processes) as pool:
+        return dict(
+            pool.starmap(
+                compute_cca_for_file,
+                [(nifti_file, connectivity) for nifti_file in nifti_files],
+            )
+        )
@@ -9,29 +9,16 @@ import shutil
 from glob import glob
 from pathlib import Path
 import shutil
-import nibabel as nib
-import numpy as np
 import json
 import re
+import os
 
-import cc3d
+from cca_statistics import compute_cca_for_files
 
 processed_count = 0
 logger = None
-
-
-def compute_cca(seg_data, connectivity):
-    # perform cca
-    # returns label_out: np.array of same size as seg_data with a unique cc_id per cc
-    # returns N: number of connected components (cc)
-    labels_out, N = cc3d.connected_components(seg_data, return_N=True, connectivity=26)
-
-    # component_volumes = {cc_id: num_voxels_in_labels_out==ccid}
-    component_volumes = {}
-    for cc_id in range(0, N):
-        component_volumes[cc_id] = int(np.sum(labels_out == cc_id))
-
-    return component_volumes
+threads = getenv("THREADS", "None")
+threads = len(os.sched_getaffinity(0)) if threads.lower() == "none" else int(threads)
 
 
 def cca(nifti_dir, json_dir, connectivity=26):
@@ -39,20 +26,13 @@ def cca(nifti_dir, json_dir, connectivity=26):
     res_cca = {"connected_component_analysis": {}}
 
     # get nifti file names
-    nifti_files = glob(join(nifti_dir, "*.nii.gz"), recursive=True)
-
-    for nifti_file in nifti_files:
-        # load pixel_array of nifti_file to np.array
-        nifti = nib.load(nifti_file)
-        nifti_numpy = nifti.get_fdata().astype(int)
-
-        # compute cca
-        res_cca_from_nifti = compute_cca(nifti_numpy, connectivity)
-        res_cca["connected_component_analysis"][
-            basename(nifti_file)
-        ] = res_cca_from_nifti
+    nifti_files = sorted(glob(join(nifti_dir, "*.nii.gz"), recursive=True))
 
-        processed_count += 1
+    # compute cca of all files in parallel
+    res_cca["connected_component_analysis"] = compute_cca_for_files(
+        nifti_files, int(connectivity), threads
+    )
+    processed_count += len(nifti_files)
 
     return True, res_cca
 
@@ -107,6 +87,7 @@ if __name__ == "__main__":
     logger.info(f"# operator_out_dir: {operator_out_dir}")
     logger.info(f"# json_info_dir: {json_info_dir}")
     logger.info(f"# connectivity: {connectivity}")
+    logger.info(f"# threads: {threads}")
     logger.info("#")
     logger.info("#")
     logger.info("##################################################")
@@ -20,7 +20,6 @@ from pynetdicom.status import code_to_status, code_to_category
 from datetime import datetime, timedelta
 from enum import Enum
 
-
 log = logging.getLogger(__name__)
 
 
@@ -331,13 +330,11 @@ class DicomQueryClient:
 if __name__ == "__main__":
     logging.basicConfig()
     log.setLevel(logging.INFO)
-    parser = argparse.ArgumentParser(
-        description="""
+    parser = argparse.ArgumentParser(description="""
 Helper script to query PACS using C-FIND
 
 note: tries to mimic dcmtk tools options
-"""
-    )
+""")
     parser.add_argument("peer", help="hostname of DICOM peer")
     parser.add_argument("port", type=int, help="tcp/ip port number of DICOM peer")
     parser.add_argument(
@@ -356,6 +353,12 @@ note: tries to mimic dcmtk tools options
         help="If set to a positiv value larger than 0, the query is chunked int smaller queries. The estimated size of a single query would be smaller or equal to this paremter",
         default=None,
     )
+    parser.add_argument(
+        "--associations",
+        type=int,
+        help="Number of parallel associations for queries with --max-query-size (study and series level)",
+        default=4,
+    )
     parser.add_argument(
         "outfile", help="a jsonlines file containing the the resultset of this query"
     )
@@ -387,44 +390,69 @@ note: tries to mimic dcmtk tools options
     start_dt = datetime.fromisoformat(args.start_date) if args.start_date else None
     end_dt = datetime.fromisoformat(args.end_date) if args.end_date else None
 
-    with DicomQueryClient(
-        args.aet, args.aec, args.peer, args.port, args.level
-    ) as client:
-        path = args.outfile
-        log.info("Opening result file %s", path)
-        with jsonlines.open(path, mode="w") as writer:
-            if args.max_query_size:
-                logging.info("Max query size: %d", args.max_query_size)
-                resultset = client.execute_query(
-                    start_dt=start_dt, end_dt=end_dt, limit=args.max_query_size
-                )
-            else:
-                resultset = client.execute_query(start_dt=start_dt, end_dt=end_dt)
-
-            for result in resultset:
-                if args.filter_uid:
-                    filtered = False
-                    if args.level == QueryLevel.patient and "PatientID" not in result:
-                        filtered = True
-                    elif (
-                        args.level == QueryLevel.study
-                        and "StudyInstanceUID" not in result
-                    ):
-                        filtered = True
-                    elif (
-                        args.level == QueryLevel.series
-                        and "SeriesInstanceUID" not in result
-                    ):
-                        filtered = True
-
-                    if filtered:
-                        log.warn(
-                            "Skipping Object because it does not contain correct identifier for level %s (Object: %s)",
-                            args.level,
-                            result,
-                        )
-                        continue
-
-                writer.write(result.to_json_dict())
+    if args.max_query_size and args.level in [QueryLevel.study, QueryLevel.series]:
+        # date windows bisected to the query size, queried in parallel with checkpointing
+        from query_engine import ParallelQueryEngine
+
+        logging.info("Max query size: %d", args.max_query_size)
+        engine = ParallelQueryEngine(
+            args.aet,
+            args.aec,
+            args.peer,
+            args.port,
+            args.level,
+            limit=args.max_query_size,
+            num_associations=args.associations,
+            filter_uid=args.filter_uid,
+        )
+        result_count = engine.run(
+            args.outfile,
+            start_date=start_dt.date() if start_dt else None,
+            end_date=end_dt.date() if end_dt else None,
+        )
+        log.info("Results: %d", result_count)
+    else:
+        with DicomQueryClient(
+            args.aet, args.aec, args.peer, args.port, args.level
+        ) as client:
+            path = args.outfile
+            log.info("Opening result file %s", path)
+            with jsonlines.open(path, mode="w") as writer:
+                if args.max_query_size:
+                    logging.info("Max query size: %d", args.max_query_size)
+                    resultset = client.execute_query(
+                        start_dt=start_dt, end_dt=end_dt, limit=args.max_query_size
+                    )
+                else:
+                    resultset = client.execute_query(start_dt=start_dt, end_dt=end_dt)
+
+                for result in resultset:
+                    if args.filter_uid:
+                        filtered = False
+                        if (
+                            args.level == QueryLevel.patient
+                            and "PatientID" not in result
+                        ):
+                            filtered = True
+                        elif (
+                            args.level == QueryLevel.study
+                            and "StudyInstanceUID" not in result
+                        ):
+                            filtered = True
+                        elif (
+                            args.level == QueryLevel.series
+                            and "SeriesInstanceUID" not in result
+                        ):
+                            filtered = True
+
+                        if filtered:
+                            log.warn(
+                                "Skipping Object because it does not contain correct identifier for level %s (Object: %s)",
+                                args.level,
+                                result,
+                            )
+                            continue
+
+                    writer.write(result.to_json_dict())
 
     log.info("All done")
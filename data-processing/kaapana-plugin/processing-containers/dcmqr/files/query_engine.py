@@ -0,0 +1,285 @@
+#
+# query_engine.py: Parallel C-FIND over date windows with adaptive bisection
+#
+# The requested date range is split into windows which are queried concurrently
+# (one association per worker). A window whose result count reaches the limit
+# (the PACS may truncate it) is bisected and both halves are queried again.
+# Results are streamed into the result file, deduplicated by the UID of the
+# query level. Completed windows are checkpointed, so an interrupted sweep
+# resumes with the remaining windows only.
+
+import json
+import logging
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date
+
+import jsonlines
+from pydicom.datadict import tag_for_keyword
+from pynetdicom.status import code_to_category
+from query import DicomQueryClient, QueryLevel
+
+log = logging.getLogger(__name__)
+
+UID_KEYWORDS = {
+    QueryLevel.study: "StudyInstanceUID",
+    QueryLevel.series: "SeriesInstanceUID",
+}
+# StudyDate is used for the windows if no start date is given
+DEFAULT_START_DATE = date(1900, 1, 1)
+
+
+def subtract_windows(first, last, done_windows):
+    """
+    Returns the day ranges [first, last] (inclusive ordinals) not covered by done_windows.
+    """
+    remaining = []
+    current = first
+    for done_first, done_last in sorted(done_windows):
+        if done_last < current:
+            continue
+        if done_first > last:
+            break
+        if done_first > current:
+            remaining.append((current, done_first - 1))
+        current = max(current, done_last + 1)
+    if current <= last:
+        remaining.append((current, last))
+    return remaining
+
+
+def split_window(first, last, count):
+    size = max(1, (last - first + 1) // count)
+    windows = []
+    while first <= last:
+        window_last = last if len(windows) == count - 1 else min(last, first + size - 1)
+        windows.append((first, window_last))
+        first = window_last + 1
+    return windows
+
+
+class ParallelQueryEngine:
+    def __init__(
+        self,
+        aet: str,
+        aec: str,
+        peer: str,
+        port: int,
+        level: QueryLevel,
+        limit: int,
+        num_associations: int = 4,
+        filter_uid: bool = False,
+        max_window_retries: int = 3,
+    ):
+        assert level in UID_KEYWORDS, f"Query level {level} is not supported"
+        assert limit > 0, "Query limit must be bigger than 0"
+        self.aet = aet
+        self.aec = aec
+        self.peer = peer
+        self.port = port
+        self.level = level
+        self.limit = limit
+        self.num_associations = num_associations
+        self.filter_uid = filter_uid
+        self.max_window_retries = max_window_retries
+        self.uid_keyword = UID_KEYWORDS[level]
+
+        self.local = threading.local()
+        self.clients = []
+        self.lock = threading.Lock()
+        self.uids = set()
+
+    def get_client(self):
+        client = getattr(self.local, "client", None)
+        if client is None or not client.assoc.is_established:
+            client = DicomQueryClient(
+                self.aet, self.aec, self.peer, self.port, self.level
+            )
+            self.local.client = client
+            self.local.query_ds = client.create_query_dataset()
+            with self.lock:
+                self.clients.append(client)
+        return client
+
+    def drop_client(self):
+        client = getattr(self.local, "client", None)
+        self.local.client = None
+        if client is not None and client.assoc.is_established:
+            client.assoc.abort()
+
+    def query_window(self, window):
+        """
+        Returns the identifiers of the window (inclusive ordinals of StudyDate).
+        """
+        client = self.get_client()
+        ds = self.local.query_ds
+        ds.StudyDate = client.date_range(
+            date.fromordinal(window[0]), date.fromordinal(window[1])
+        )
+        identifiers = []
+        for status, identifier in client.assoc.send_c_find(
+            ds, client.query_model, priority=2
+        ):
+            if not status:
+                raise ConnectionError("Connection time out, abort or invalid response")
+            category = code_to_category(status.Status)
+            if category not in ["Success", "Pending"]:
+                raise ValueError(f"C-FIND status 0x{status.Status:04X} ({category})")
+            if identifier is not None:
+                identifiers.append(identifier)
+        return identifiers
+
+    def query_window_with_retries(self, window):
+        for try_count in range(1, self.max_window_retries + 1):
+            try:
+                return self.query_window(window)
+            except Exception as e:
+                log.warning(
+                    "Query %s failed (try %d/%d): %s",
+                    self.window_str(window),
+                    try_count,
+                    self.max_window_retries,
+                    e,
+                )
+                self.drop_client()
+        raise Exception(f"Query {self.window_str(window)} failed")
+
+    @staticmethod
+    def window_str(window):
+        return f"{date.fromordinal(window[0])}-{date.fromordinal(window[1])}"
+
+    def load_checkpoint(self, checkpoint_path, outfile, query):
+        if not os.path.exists(checkpoint_path) or not os.path.exists(outfile):
+            return []
+        with open(checkpoint_path, "r") as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("query") != query:
+            log.info("Checkpoint of a different query -> starting from scratch")
+            return []
+        with jsonlines.open(outfile, mode="r") as reader:
+            for result in reader:
+                uid = result.get(self.get_uid_tag(), {}).get("Value", [None])[0]
+                if uid is not None:
+                    self.uids.add(uid)
+        log.info(
+            "Resuming: %d completed windows, %d results",
+            len(checkpoint["done"]),
+            len(self.uids),
+        )
+        return [tuple(x) for x in checkpoint["done"]]
+
+    def save_checkpoint(self, checkpoint_path, query, done_windows):
+        checkpoint_tmp_path = f"{checkpoint_path}.tmp"
+        with open(checkpoint_tmp_path, "w") as f:
+            json.dump({"query": query, "done": sorted(done_windows)}, f)
+        os.replace(checkpoint_tmp_path, checkpoint_path)
+
+    def get_uid_tag(self):
+        # key of the UID in the json dict of a dataset
+        return f"{tag_for_keyword(self.uid_keyword):08X}"
+
+    def write_results(self, writer, identifiers):
+        new_count = 0
+        for identifier in identifiers:
+            uid = identifier.get(self.uid_keyword)
+            if not uid:
+                if self.filter_uid:
+                    log.warning(
+                        "Skipping Object because it does not contain correct identifier for level %s (Object: %s)",
+                        self.level,
+                        identifier,
+                    )
+                    continue
+            elif str(uid) in self.uids:
+                continue
+            else:
+                self.uids.add(str(uid))
+            writer.write(identifier.to_json_dict())
+            new_count += 1
+        return new_count
+
+    def run(self, outfile, start_date: date = None, end_date: date = None):
+        """
+        Queries [start_date, end_date] and writes the deduplicated results to outfile (jsonlines).
+        Returns the number of results.
+        """
+        first = (start_date or DEFAULT_START_DATE).toordinal()
+        last = (end_date or date.today()).toordinal()
+        assert first <= last, "Start must be before end"
+        query = {
+            "level": str(self.level),
+            "limit": self.limit,
+            "start": first,
+            "end": last,
+        }
+        checkpoint_path = f"{outfile}.checkpoint.json"
+        done_windows = self.load_checkpoint(checkpoint_path, outfile, query)
+        windows = []
+        for remaining_first, remaining_last in subtract_windows(
+            first, last, done_windows
+        ):
+            windows.extend(
+                split_window(remaining_first, remaining_last, self.num_associations)
+            )
+        log.info(
+            "Querying %d windows with %d associations (limit %d)",
+            len(windows),
+            self.num_associations,
+            self.limit,
+        )
+
+        with jsonlines.open(
+            outfile, mode="a" if len(done_windows) > 0 else "w", flush=True
+        ) as writer, ThreadPoolExecutor(self.num_associations) as executor:
+            futures = {
+                executor.submit(self.query_window_with_retries, x): x for x in windows
+            }
+            try:
+                while len(futures) > 0:
+                    finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        window = futures.pop(future)
+                        identifiers = future.result()
+                        if len(identifiers) >= self.limit and window[0] < window[1]:
+                            # maybe truncated -> query both halves
+                            middle = window[0] + (window[1] - window[0]) // 2
+                            log.info(
+                                "%s: %d results >= limit -> bisecting",
+                                self.window_str(window),
+                                len(identifiers),
+                            )
+                            for half in [(window[0], middle), (middle + 1, window[1])]:
+                                futures[
+                                    executor.submit(
+                                        self.query_window_with_retries, half
+                                    )
+                                ] = half
+                            continue
+
+                        if len(identifiers) >= self.limit:
+                            log.warning(
+                                "%s: %d results >= limit for a single day, results may be truncated",
+                                self.window_str(window),
+                                len(identifiers),
+                            )
+                        new_count = self.write_results(writer, identifiers)
+                        done_windows.append(window)
+                        self.save_checkpoint(checkpoint_path, query, done_windows)
+                        log.info(
+                            "%s: %d results (%d new, total %d, %d windows pending)",
+                            self.window_str(window),
+                            len(identifiers),
+                            new_count,
+                            len(self.uids),
+                            len(futures),
+                        )
+            finally:
+                for future in futures:
+                    future.cancel()
+                for client in self.clients:
+                    if client.assoc.is_established:
+                        client.assoc.release()
+
+        os.remove(checkpoint_path)
+        return len(self.uids)
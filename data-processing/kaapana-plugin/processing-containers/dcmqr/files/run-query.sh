@@ -7,6 +7,10 @@ if [ -n "$MAX_QUERY_SIZE" ]; then
     CMD="$CMD --max-query-size $MAX_QUERY_SIZE"
 fi
 
+if [ -n "$NUM_ASSOCIATIONS" ]; then
+    CMD="$CMD --associations $NUM_ASSOCIATIONS"
+fi
+
 if [ -n "$START_DATE" ]; then
     CMD="$CMD --start-date $START_DATE"
 fi
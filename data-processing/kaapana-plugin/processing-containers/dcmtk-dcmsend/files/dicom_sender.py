@@ -0,0 +1,205 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+from pydicom.errors import InvalidDicomError
+from pydicom.uid import (
+    UID,
+    ExplicitVRBigEndian,
+    ExplicitVRLittleEndian,
+    ImplicitVRLittleEndian,
+)
+from pynetdicom import AE
+from pynetdicom.status import code_to_category
+
+"""
+Documentation dicom_sender.py:
+
+C-STORE sender based on pynetdicom (replaces one dcmsend process per directory):
+
+- The header of every file is read once: non-DICOM files are skipped and the
+  SOP classes / transfer syntaxes of all instances are collected.
+- The presentation contexts are built once for this set and used for all associations.
+- Every worker thread keeps its own association open for all of its instances.
+- Only failed instances are sent again.
+- A failed association ends the round for all workers without an open association,
+  so an unreachable PACS costs one connect timeout per round and not one per instance.
+  After max_association_failures rounds in a row without any sent instance a
+  ConnectionError is raised.
+"""
+
+# a requestor may propose at most 128 presentation contexts
+MAX_PRESENTATION_CONTEXTS = 128
+UNCOMPRESSED_TRANSFER_SYNTAXES = [
+    ExplicitVRLittleEndian,
+    ImplicitVRLittleEndian,
+    ExplicitVRBigEndian,
+]
+
+
+def read_instance_info(path):
+    """
+    Returns (path, SOPClassUID, TransferSyntaxUID) or None if path is not a DICOM file.
+    """
+    try:
+        ds = pydicom.dcmread(
+            str(path), stop_before_pixels=True, specific_tags=["SOPClassUID"]
+        )
+    except (InvalidDicomError, OSError):
+        return None
+    if "SOPClassUID" not in ds or "TransferSyntaxUID" not in ds.file_meta:
+        return None
+    return path, str(ds.SOPClassUID), str(ds.file_meta.TransferSyntaxUID)
+
+
+def get_presentation_contexts(instance_infos):
+    """
+    One context per SOP class for all uncompressed instances and one context per
+    SOP class and compressed transfer syntax (the SCP accepts one syntax per context).
+    """
+    contexts = {}
+    for _, sop_class_uid, transfer_syntax_uid in instance_infos:
+        if UID(transfer_syntax_uid).is_compressed:
+            contexts[(sop_class_uid, transfer_syntax_uid)] = [transfer_syntax_uid]
+        else:
+            contexts[(sop_class_uid, None)] = UNCOMPRESSED_TRANSFER_SYNTAXES
+    if len(contexts) > MAX_PRESENTATION_CONTEXTS:
+        raise ValueError(
+            f"{len(contexts)} presentation contexts needed, max {MAX_PRESENTATION_CONTEXTS}"
+        )
+    return [
+        (sop_class_uid, transfer_syntaxes)
+        for (sop_class_uid, _), transfer_syntaxes in sorted(contexts.items())
+    ]
+
+
+class DicomSender:
+    def __init__(
+        self,
+        host,
+        port,
+        calling_aet,
+        called_aet,
+        num_associations=4,
+        timeout=60,
+        max_retries=5,
+        max_association_failures=3,
+    ):
+        self.host = host
+        self.port = int(port)
+        self.calling_aet = calling_aet
+        self.called_aet = called_aet
+        self.num_associations = num_associations
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_association_failures = max_association_failures
+
+        self.local = threading.local()
+        self.associations = []
+        self.lock = threading.Lock()
+        self.association_failed = threading.Event()
+
+    def get_association(self):
+        assoc = getattr(self.local, "assoc", None)
+        if assoc is not None and assoc.is_established:
+            return assoc
+        if self.association_failed.is_set():
+            # another worker could not associate in this round -> no new connect attempt
+            return None
+        assoc = self.ae.associate(self.host, self.port, ae_title=self.called_aet)
+        if not assoc.is_established:
+            raise ConnectionError(
+                f"Association with {self.host}:{self.port} ({self.called_aet}) rejected, aborted or never connected"
+            )
+        self.local.assoc = assoc
+        with self.lock:
+            self.associations.append(assoc)
+        return assoc
+
+    def drop_association(self):
+        assoc = getattr(self.local, "assoc", None)
+        self.local.assoc = None
+        if assoc is not None and assoc.is_established:
+            assoc.abort()
+
+    def send_instance(self, path):
+        try:
+            assoc = self.get_association()
+        except ConnectionError as e:
+            print(f"# {e} -> end of round")
+            self.association_failed.set()
+            return path, False
+        if assoc is None:
+            return path, False
+
+        try:
+            status = assoc.send_c_store(pydicom.dcmread(str(path)))
+        except Exception as e:
+            print(f"# C-STORE of {path} failed: {e}")
+            self.drop_association()
+            return path, False
+
+        # empty status -> timeout, abort or invalid response
+        if "Status" not in status:
+            print(f"# C-STORE of {path}: no valid response")
+            self.drop_association()
+            return path, False
+        category = code_to_category(status.Status)
+        if category not in ["Success", "Warning"]:
+            print(f"# C-STORE of {path}: status 0x{status.Status:04X} ({category})")
+            return path, False
+        return path, True
+
+    def release_associations(self):
+        for assoc in self.associations:
+            if assoc.is_established:
+                assoc.release()
+        self.associations = []
+
+    def send(self, instance_infos):
+        """
+        Sends all instances (see read_instance_info) and returns the paths which could not be sent.
+        """
+        self.ae = AE(ae_title=self.calling_aet)
+        self.ae.acse_timeout = self.timeout
+        self.ae.dimse_timeout = self.timeout
+        self.ae.network_timeout = self.timeout
+        for sop_class_uid, transfer_syntaxes in get_presentation_contexts(
+            instance_infos
+        ):
+            self.ae.add_requested_context(sop_class_uid, transfer_syntaxes)
+
+        pending = [path for path, _, _ in instance_infos]
+        try_count = 0
+        association_failure_count = 0
+        start_time = time.time()
+        while len(pending) > 0 and try_count < self.max_retries:
+            if try_count > 0:
+                print(f"# Retry {try_count}: {len(pending)} failed instance(s)")
+                time.sleep(min(2**try_count, 30))
+            try_count += 1
+            self.association_failed.clear()
+            with ThreadPoolExecutor(self.num_associations) as executor:
+                results = list(executor.map(self.send_instance, pending))
+            self.release_associations()
+            sent_in_round = len(pending)
+            pending = [path for path, success in results if not success]
+            sent_in_round -= len(pending)
+
+            if self.association_failed.is_set() and sent_in_round == 0:
+                association_failure_count += 1
+                if association_failure_count >= self.max_association_failures:
+                    raise ConnectionError(
+                        f"No association with {self.host}:{self.port} ({self.called_aet}) "
+                        f"in {association_failure_count} rounds -> {len(pending)} instance(s) not sent"
+                    )
+            else:
+                association_failure_count = 0
+
+        sent_count = len(instance_infos) - len(pending)
+        duration = time.time() - start_time
+        print(
+            f"# Sent {sent_count}/{len(instance_infos)} instance(s) with {self.num_associations} association(s) in {duration:.1f} s"
+        )
+        return pending
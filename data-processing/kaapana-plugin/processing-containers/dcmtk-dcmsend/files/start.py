@@ -1,10 +1,10 @@
 import glob
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from subprocess import PIPE, run
-from typing import List
 
 import pydicom
+from dicom_sender import DicomSender, read_instance_info
 from kaapanapy.helper import load_workflow_config
 from kaapanapy.settings import KaapanaSettings
 
@@ -26,122 +26,94 @@ PROJECT_NAME = PROJECT.get("name")
 PACS_HOST = os.getenv("PACS_HOST") or f"ctp-dicom-service.{SERVICES_NAMESPACE}.svc"
 PACS_PORT = os.getenv("PACS_PORT", "11112")
 CALLED_AE_TITLE_SCP = os.getenv("CALLED_AE_TITLE_SCP", DEFAULT_SCP)
+# number of parallel associations (C-STORE of one instance per association at a time)
+NUM_ASSOCIATIONS = int(os.getenv("NUM_ASSOCIATIONS", "4"))
+# ACSE/DIMSE/network timeout in seconds
+SEND_TIMEOUT = int(os.getenv("SEND_TIMEOUT", "60"))
+# retries of the failed instances
+MAX_RETRIES = int(os.getenv("MAX_RETRIES", "5"))
 
 print(f"AETITLE: {AETITLE}")
 print(f"PACS_HOST: {PACS_HOST}")
 print(f"PACS_PORT: {PACS_PORT}")
 print(f"CALLED_AE_TITLE_SCP: {CALLED_AE_TITLE_SCP}")
 print(f"LEVEL: {LEVEL}")
+print(f"NUM_ASSOCIATIONS: {NUM_ASSOCIATIONS}")
 
 dicom_sent_count = 0
 
 
-def send_dicom_data(send_dir, project_name, aetitle=AETITLE, timeout=60):
+def send_dicom_data(send_dir, project_name, aetitle=AETITLE, timeout=SEND_TIMEOUT):
     global dicom_sent_count
 
-    dicom_list: List[Path] = sorted(
-        [
-            f
-            for f in Path(send_dir).rglob("*")
-            if f.is_file() and pydicom.misc.is_dicom(f)
+    # one header read per file: skips non-DICOM files (e.g. zip-upload) and collects the SOP classes
+    with ThreadPoolExecutor(NUM_ASSOCIATIONS) as executor:
+        instance_infos = [
+            x
+            for x in executor.map(
+                read_instance_info,
+                sorted([f for f in Path(send_dir).rglob("*") if f.is_file()]),
+            )
+            if x is not None
         ]
-    )
 
-    if len(dicom_list) == 0:
+    if len(instance_infos) == 0:
         print(send_dir)
         print("############### No dicoms found...! Skipping to next Batch.")
         # raise FileNotFoundError # Not very elegant, but it still fails if nothing is processed. Maybe would be better if the dag would specify an "allow partial fail" parameter.
         return
 
-    for dicom_dir, _, _ in os.walk(send_dir):
-        dicom_list = [
-            f
-            for f in Path(dicom_dir).glob("*")
-            if f.is_file() and pydicom.misc.is_dicom(f)
-        ]
-
-        if len(dicom_list) == 0:
-            continue
-
-        dcm_file = pydicom.dcmread(dicom_list[0])
-        series_uid = str(dcm_file[0x0020, 0x000E].value)
-
+    dicom_dirs = sorted(set(path.parent for path, _, _ in instance_infos))
+    for dicom_dir in dicom_dirs:
         print(
-            f"Found {len(dicom_list)} file(s) in {dicom_dir}. Will use series_uuid {series_uid}"
+            f"Found {len([x for x in instance_infos if x[0].parent == dicom_dir])} file(s) in {dicom_dir}"
         )
-        if aetitle is None:
-            if "WORKFLOW_NAME" in os.environ:
-                aetitle = os.environ["WORKFLOW_NAME"]
-                print(f"Using workflow_name as aetitle:    {aetitle}")
-            else:
-                try:
-                    aetitle = str(dcm_file[0x012, 0x020].value)
-                    print(f"Found aetitle    {aetitle}")
-                except Exception as e:
-                    print(f"Could not load aetitle: {e}")
-                    aetitle = "KAAPANA export"
-                    print(f"Using default aetitle {aetitle}")
-
-        print(f"Sending {dicom_dir} to {PACS_HOST} {PACS_PORT} with aetitle {aetitle}")
-        aec = CALLED_AE_TITLE_SCP
-        if PACS_HOST == f"ctp-dicom-service.{SERVICES_NAMESPACE}.svc":
-            dataset = aetitle if aetitle.startswith("kp-") else f"kp-{aetitle}"
-            if CALLED_AE_TITLE_SCP == DEFAULT_SCP:
-                aec = project_name
-            aec = aec if aec.startswith("kp-") else f"kp-{aec}"
+
+    if aetitle is None:
+        if "WORKFLOW_NAME" in os.environ:
+            aetitle = os.environ["WORKFLOW_NAME"]
+            print(f"Using workflow_name as aetitle:    {aetitle}")
         else:
-            dataset = aetitle
-
-        env = dict(os.environ)
-        # To process even if the input contains non-DICOM files the --no-halt option is needed (e.g. zip-upload functionality)
-        command = [
-            "dcmsend",
-            "-v",
-            f"{PACS_HOST}",
-            f"{PACS_PORT}",
-            "-aet",
-            dataset,
-            "-aec",
-            aec,
-            "--scan-directories",
-            "--no-halt",
-            f"{dicom_dir}",
-        ]
-        print(" ".join(command))
-        max_retries = 5
-        try_count = 0
-        while try_count < max_retries:
-            print("Try: {}".format(try_count))
-            try_count += 1
             try:
-                output = run(
-                    command,
-                    stdout=PIPE,
-                    stderr=PIPE,
-                    universal_newlines=True,
-                    env=env,
-                    timeout=timeout,
+                dcm_file = pydicom.dcmread(
+                    str(instance_infos[0][0]), stop_before_pixels=True
                 )
-                if output.returncode != 0 or "with status SUCCESS" not in str(output):
-                    print("############### Something went wrong with dcmsend!")
-                    for line in str(output).split("\\n"):
-                        print(line)
-                    print("##################################################")
-                    # exit(1)
-                else:
-                    print(f"Success! output: {output}")
-                    print("")
-                    break
+                aetitle = str(dcm_file[0x012, 0x020].value)
+                print(f"Found aetitle    {aetitle}")
             except Exception as e:
-                print(f"Something went wrong: {e}, trying again!")
-
-        if try_count >= max_retries:
-            print("------------------------------------")
-            print("Max retries reached!")
-            print("------------------------------------")
-            raise ValueError(f"Something went wrong with dcmsend!")
+                print(f"Could not load aetitle: {e}")
+                aetitle = "KAAPANA export"
+                print(f"Using default aetitle {aetitle}")
+
+    print(f"Sending {send_dir} to {PACS_HOST} {PACS_PORT} with aetitle {aetitle}")
+    aec = CALLED_AE_TITLE_SCP
+    if PACS_HOST == f"ctp-dicom-service.{SERVICES_NAMESPACE}.svc":
+        dataset = aetitle if aetitle.startswith("kp-") else f"kp-{aetitle}"
+        if CALLED_AE_TITLE_SCP == DEFAULT_SCP:
+            aec = project_name
+        aec = aec if aec.startswith("kp-") else f"kp-{aec}"
+    else:
+        dataset = aetitle
+
+    sender = DicomSender(
+        host=PACS_HOST,
+        port=PACS_PORT,
+        calling_aet=dataset,
+        called_aet=aec,
+        num_associations=NUM_ASSOCIATIONS,
+        timeout=timeout,
+        max_retries=MAX_RETRIES,
+    )
+    failed = sender.send(instance_infos)
+    if len(failed) > 0:
+        print("------------------------------------")
+        print("Max retries reached!")
+        for path in failed:
+            print(f"Not sent: {path}")
+        print("------------------------------------")
+        raise ValueError(f"Something went wrong with C-STORE!")
 
-        dicom_sent_count += 1
+    dicom_sent_count += len(dicom_dirs)
 
 
 if LEVEL == "element":
@@ -161,14 +133,14 @@ if LEVEL == "element":
         element_input_dir = os.path.join(
             batch_element_dir, os.environ["OPERATOR_IN_DIR"]
         )
-        send_dicom_data(element_input_dir, project_name=PROJECT_NAME, timeout=600)
+        send_dicom_data(element_input_dir, project_name=PROJECT_NAME)
 
 elif LEVEL == "batch":
     batch_input_dir = os.path.join(
         "/", os.environ["WORKFLOW_DIR"], os.environ["OPERATOR_IN_DIR"]
     )
     print(f"Sending DICOM data from batch-level: {batch_input_dir}")
-    send_dicom_data(batch_input_dir, project_name=PROJECT_NAME, timeout=3600)
+    send_dicom_data(batch_input_dir, project_name=PROJECT_NAME)
 else:
     raise NameError(
         'level must be either "element" or "batch". \
@@ -4,12 +4,23 @@ import time
 import json
 import shutil
 import glob
+import tempfile
+import threading
 import warnings
 
+import numpy as np
 import SimpleITK as sitk
 
 from pathlib import Path
-from pydicom.uid import generate_uid, PYDICOM_ROOT_UID
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import pydicom
+from pydicom.dataset import Dataset
+from pydicom.uid import (
+    generate_uid,
+    PYDICOM_ROOT_UID,
+    MultiFrameGrayscaleWordSecondaryCaptureImageStorage,
+)
 
 # http://dicomlookup.com/modalities.asp
 VALID_MODALITIES = [
@@ -54,14 +65,17 @@ VALID_MODALITIES = [
     "SMR",
 ]
 
+# slices: one DICOM file per slice, multiframe: one multi-frame DICOM file per series
+OUTPUT_MODES = ["slices", "multiframe"]
+
 
 def make_out_dir(series_uid, dataset, case, segmentation=False, human_readable=False):
     # operator_output = "/data/output"
     batch_output = os.path.join(
         "/", os.environ["WORKFLOW_DIR"], os.environ["BATCH_NAME"]
     )  # , os.environ['OPERATOR_OUT_DIR'])
-    if not os.path.exists(batch_output):
-        os.mkdir(batch_output)
+    # exist_ok: cases are converted by parallel processes
+    os.makedirs(batch_output, exist_ok=True)
     if human_readable:
         case_dir = Path(batch_output) / dataset / str(case).split(".")[0]
     else:
@@ -77,10 +91,29 @@ class Nifti2DcmConverter:
     on a 'per study' basis. (See __call__(self, ...))
     """
 
-    def __init__(self, root_dir: Path, parser=None, seed=42):
+    def __init__(
+        self,
+        root_dir: Path,
+        parser=None,
+        seed=42,
+        output_mode="slices",
+        use_compression=True,
+        threads=1,
+        processes=1,
+        max_cases_in_flight=None,
+    ):
         self.parser = parser or Parser()
         self.seed = str(seed)
         self.root_dir = root_dir  # self.get_root()
+        if output_mode not in OUTPUT_MODES:
+            raise Exception(
+                f"Invalid output mode {output_mode}! Options: {OUTPUT_MODES}"
+            )
+        self.output_mode = output_mode
+        self.use_compression = use_compression
+        self.threads = threads
+        self.processes = processes
+        self.max_cases_in_flight = max_cases_in_flight or 2 * processes
 
     def __call__(self):
         """Run the converter on a path with either the following directory structure:
@@ -139,6 +172,7 @@ class Nifti2DcmConverter:
             print(f"Setting {k}={v}")
             series_tag_values[k] = v
 
+        jobs = []
         for i, case in enumerate(cases):
             case_path = Path(case[0])
             # defaults
@@ -179,9 +213,65 @@ class Nifti2DcmConverter:
             if "0020|000e" not in series_tag_values:  # Series Instance UID
                 series_tag_values["0020|000e"] = generate_uid()
 
-            self.convert_series(
-                case_path, series_tag_values=series_tag_values, segmentation=case[1]
-            )
+            # the slice UIDs only depend on the series tags and the seed
+            # -> UIDs do not depend on the order or scheduling of the cases
+            jobs.append((case_path, series_tag_values, case[1]))
+
+        if self.processes > 1:
+            case_timings = self.convert_cases_parallel(jobs)
+        else:
+            case_timings = [self.convert_case(*job) for job in jobs]
+        self.print_case_timings(case_timings)
+
+    def convert_case(self, case_path, series_tag_values, segmentation):
+        start = time.time()
+        self.convert_series(
+            case_path,
+            series_tag_values=series_tag_values,
+            segmentation=segmentation,
+        )
+        return str(case_path), time.time() - start
+
+    def convert_cases_parallel(self, jobs):
+        """Converts the cases in a process pool.
+
+        At most max_cases_in_flight cases are submitted at once, so that the
+        arguments and results of pending cases do not pile up.
+        """
+        print(
+            f"Converting {len(jobs)} cases with {self.processes} processes "
+            f"(max {self.max_cases_in_flight} in flight) ..."
+        )
+        in_flight = threading.BoundedSemaphore(self.max_cases_in_flight)
+        results = []
+        with Pool(self.processes) as pool:
+            for job in jobs:
+                in_flight.acquire()
+                results.append(
+                    pool.apply_async(
+                        self.convert_case,
+                        job,
+                        callback=lambda _: in_flight.release(),
+                        error_callback=lambda _: in_flight.release(),
+                    )
+                )
+            # raises the first exception of a failed case
+            return [result.get() for result in results]
+
+    @staticmethod
+    def print_case_timings(case_timings):
+        if len(case_timings) == 0:
+            return
+        durations = [duration for _, duration in case_timings]
+        print("----case timings----")
+        print(f"cases: {len(case_timings)}")
+        print(f"total: {sum(durations):.2f}s")
+        print(f"mean:  {sum(durations) / len(durations):.2f}s")
+        print(f"max:   {max(durations):.2f}s")
+        for case_path, duration in sorted(
+            case_timings, key=lambda x: x[1], reverse=True
+        )[:5]:
+            print(f"{duration:8.2f}s {case_path}")
 
     def convert_series(self, case_path, series_tag_values, segmentation=None):
         """
@@ -210,31 +300,25 @@ class Nifti2DcmConverter:
 
         new_img = sitk.ReadImage(str(case_path))
 
-        direction = new_img.GetDirection()
-
-        series_tag_values["0020|0037"] = "\\".join(
-            map(
-                str,
-                (
-                    direction[0],
-                    direction[3],
-                    direction[6],
-                    direction[1],
-                    direction[4],
-                    direction[7],
-                ),
-            )
-        )
-
         castFilter = sitk.CastImageFilter()
         castFilter.SetOutputPixelType(sitk.sitkInt16)
         imgFiltered = castFilter.Execute(new_img)
+        new_img = None
 
         # with open(out_dir / "atags.json", "w", encoding='utf-8') as jsonData:
         #     json.dump(series_tag_values, jsonData, indent=2, sort_keys=True, ensure_ascii=True)
 
-        for i in range(imgFiltered.GetDepth()):
-            self.write_slices(imgFiltered, series_tag_values, i, out_dir)  # /'dicoms')
+        series_writer = DicomSeriesWriter(
+            imgFiltered,
+            series_tag_values,
+            seed=self.seed,
+            use_compression=self.use_compression,
+            threads=self.threads,
+        )
+        if self.output_mode == "multiframe":
+            series_writer.write_multiframe(out_dir)
+        else:
+            series_writer.write_slices(out_dir)
         print("***", out_dir, "written.")
 
         if segmentation:
@@ -249,48 +333,137 @@ class Nifti2DcmConverter:
             print("### Passing seg_info.json to segmentation converter.")
             shutil.copy2(self.root_dir / "seg_info.json", seg_out_dir)
 
-    def write_slices(self, new_img, series_tag_values, i, out_dir):
-        image_slice = new_img[:, :, i]
-        writer = sitk.ImageFileWriter()
-        writer.KeepOriginalImageUIDOn()
-        writer.UseCompressionOn()  # Uses JPEG 2000 Lesless by default.
+
+class DicomSeriesWriter:
+    """Writes a 3D image as DICOM series.
+
+    The tags shared by all slices, the SOP instance UIDs and the image positions are
+    prepared once for the whole volume. Slices are written in parallel with a thread
+    pool (SimpleITK releases the GIL while writing).
+    """
+
+    def __init__(self, image, series_tag_values, seed, use_compression=True, threads=1):
+        self.image = image
+        self.use_compression = use_compression
+        self.threads = threads
+        self.depth = image.GetDepth()
+
+        direction = np.array(image.GetDirection()).reshape(3, 3)
+        self.shared_tags = dict(series_tag_values)
+        # Image Orientation (Patient): row and column direction cosines
+        self.shared_tags["0020|0037"] = "\\".join(
+            map(str, direction[:, 0].tolist() + direction[:, 1].tolist())
+        )
+        # Instance Creation Date and Time
+        self.shared_tags["0008|0012"] = time.strftime("%Y%m%d")
+        self.shared_tags["0008|0013"] = time.strftime("%H%M%S")
 
         patient_id = series_tag_values["0010|0020"]
         study_uid = series_tag_values["0020|000d"]
         series_uid = series_tag_values["0020|000e"]
+        # strip the prefix from the series uid and reuse it for the slice identifiers
+        self.uid_prefix = ".".join(series_uid.split(".")[:4]) + "."
+        self.uid_entropy = [patient_id, study_uid, series_uid]
+        self.seed = seed
+        self.instance_uids = [self.generate_instance_uid(i) for i in range(self.depth)]
+
+        # (0020, 0032) image position patient determines the 3D spacing between slices:
+        # origin + i * spacing_z * slice direction
+        slice_offsets = np.outer(
+            np.arange(self.depth), direction[:, 2] * image.GetSpacing()[2]
+        )
+        self.positions = (np.array(image.GetOrigin()) + slice_offsets).tolist()
+        self.image_positions = [
+            "\\".join(map(str, position)) for position in self.positions
+        ]
 
-        prefix = (
-            ".".join(series_uid.split(".")[:4]) + "."
-        )  # ugly syntax for strap the prefix from the series uid and reuse it for slice identifier but w/e
-        slice_instance_uid = generate_uid(
-            prefix=prefix,
-            entropy_srcs=[patient_id, study_uid, series_uid, str(i), self.seed],
+    def generate_instance_uid(self, i):
+        return generate_uid(
+            prefix=self.uid_prefix,
+            entropy_srcs=[*self.uid_entropy, str(i), self.seed],
         )
 
-        series_tag_values["0008|0018"] = slice_instance_uid
+    def get_writer(self, file_path, use_compression=None):
+        writer = sitk.ImageFileWriter()
+        writer.KeepOriginalImageUIDOn()
+        # Uses JPEG 2000 Lossless by default.
+        writer.SetUseCompression(
+            self.use_compression if use_compression is None else use_compression
+        )
+        writer.SetFileName(str(file_path))
+        return writer
 
-        # set metadata shared by series
-        for tag, value in series_tag_values.items():
+    def write_slice(self, i, out_dir, use_compression=None):
+        image_slice = self.image[:, :, i]
+        for tag, value in self.shared_tags.items():
             image_slice.SetMetaData(tag, value)
-
-        # set slice specific metadata tags.
-        image_slice.SetMetaData(
-            "0008|0012", time.strftime("%Y%m%d")
-        )  # Instance Creation Date
-        image_slice.SetMetaData(
-            "0008|0013", time.strftime("%H%M%S")
-        )  # Instance Creation Time
-
-        # (0020, 0032) image position patient determines the 3D spacing between slices.
-        image_slice.SetMetaData(
-            "0020|0032",
-            "\\".join(map(str, new_img.TransformIndexToPhysicalPoint((0, 0, i)))),
-        )  # Image Position (Patient)
+        image_slice.SetMetaData("0008|0018", self.instance_uids[i])  # SOP Instance UID
+        image_slice.SetMetaData("0020|0032", self.image_positions[i])  # Image Position
         image_slice.SetMetaData("0020|0013", str(i))  # Instance Number
 
         # Write to the output directory and add the extension dcm, to force writing in DICOM format.
-        writer.SetFileName(os.path.join(out_dir, "slice" + str(i).zfill(4) + ".dcm"))
-        writer.Execute(image_slice)
+        self.get_writer(
+            os.path.join(out_dir, "slice" + str(i).zfill(4) + ".dcm"),
+            use_compression=use_compression,
+        ).Execute(image_slice)
+
+    def write_slices(self, out_dir):
+        if self.threads > 1:
+            with ThreadPool(self.threads) as threadpool:
+                threadpool.map(
+                    lambda i: self.write_slice(i, out_dir), range(self.depth)
+                )
+        else:
+            for i in range(self.depth):
+                self.write_slice(i, out_dir)
+
+    def write_multiframe(self, out_dir):
+        """Writes the whole volume as a single multi-frame DICOM object.
+
+        The header of the first slice (written by GDCM) is reused as Multi-frame Grayscale
+        Word Secondary Capture with the plane positions as per-frame functional groups.
+        The multi-frame object is written uncompressed.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.write_slice(0, tmp_dir, use_compression=False)
+            ds = pydicom.dcmread(os.path.join(tmp_dir, "slice0000.dcm"))
+
+        ds.SOPClassUID = MultiFrameGrayscaleWordSecondaryCaptureImageStorage
+        ds.SOPInstanceUID = self.generate_instance_uid("multiframe")
+        ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        ds.InstanceNumber = 1
+        ds.NumberOfFrames = self.depth
+        ds.FrameIncrementPointer = pydicom.tag.Tag(0x5200, 0x9230)
+        for keyword in ["ImagePositionPatient", "ImageOrientationPatient"]:
+            if keyword in ds:
+                delattr(ds, keyword)
+
+        spacing = self.image.GetSpacing()
+        pixel_measures = Dataset()
+        pixel_measures.PixelSpacing = [spacing[1], spacing[0]]
+        pixel_measures.SliceThickness = spacing[2]
+        plane_orientation = Dataset()
+        plane_orientation.ImageOrientationPatient = self.shared_tags["0020|0037"].split(
+            "\\"
+        )
+        shared_functional_groups = Dataset()
+        shared_functional_groups.PixelMeasuresSequence = [pixel_measures]
+        shared_functional_groups.PlaneOrientationSequence = [plane_orientation]
+        ds.SharedFunctionalGroupsSequence = [shared_functional_groups]
+
+        per_frame_functional_groups = []
+        for position in self.positions:
+            plane_position = Dataset()
+            plane_position.ImagePositionPatient = position
+            frame_functional_groups = Dataset()
+            frame_functional_groups.PlanePositionSequence = [plane_position]
+            per_frame_functional_groups.append(frame_functional_groups)
+        ds.PerFrameFunctionalGroupsSequence = per_frame_functional_groups
+
+        # (z, y, x) int16 -> frames in slice order
+        ds.PixelData = sitk.GetArrayViewFromImage(self.image).tobytes()
+        ds.save_as(os.path.join(out_dir, "multiframe.dcm"))
 
 
 class Parser:
@@ -516,6 +689,13 @@ if __name__ == "__main__":
         else:
             print(f"Skipping directory {root}")
         if parser:
-            converter = Nifti2DcmConverter(Path(root), parser=parser)
+            converter = Nifti2DcmConverter(
+                Path(root),
+                parser=parser,
+                output_mode=os.getenv("OUTPUT_MODE", "slices"),
+                use_compression=os.getenv("USE_COMPRESSION", "True").lower() == "true",
+                threads=int(os.getenv("THREADS", "1")),
+                processes=int(os.getenv("PARALLEL_CASES", "1")),
+            )
             converter()
         parser = None
@@ -0,0 +1,92 @@
+"""
+Memory/throughput benchmark of the label map engine vs. the previous
+get_fdata().astype(int) + np.maximum combining on a synthetic multi-label volume.
+
+Usage: python3 benchmark_label_map.py [--labels 117] [--shape 256 256 200]
+"""
+
+import argparse
+import tempfile
+import tracemalloc
+from os.path import join
+from time import time
+
+import nibabel as nib
+import numpy as np
+from label_map import LabelMap, load_mask
+
+
+def create_synthetic_masks(target_dir, shape, label_count):
+    # Non-overlapping masks: the volume is split into label_count slabs along z
+    # and every label gets a box within its slab.
+    nifti_paths = []
+    affine = np.eye(4)
+    slab_borders = np.linspace(0, shape[2], label_count + 1).astype(int)
+    for label_int in range(1, label_count + 1):
+        mask = np.zeros(shape, dtype=np.uint8)
+        z_start, z_stop = slab_borders[label_int - 1], slab_borders[label_int]
+        mask[
+            shape[0] // 4 : 3 * shape[0] // 4,
+            shape[1] // 4 : 3 * shape[1] // 4,
+            z_start : max(z_stop, z_start + 1),
+        ] = 1
+        nifti_path = join(target_dir, f"{label_int}.nii.gz")
+        nib.Nifti1Image(mask, affine).to_filename(nifti_path)
+        nifti_paths.append((label_int, nifti_path))
+    return nifti_paths
+
+
+def combine_legacy(nifti_paths):
+    base_img_numpy = None
+    for label_int, nifti_path in nifti_paths:
+        nifti_numpy = nib.load(nifti_path).get_fdata().astype(int)
+        nifti_numpy[nifti_numpy == 1] = label_int
+        np.unique(nifti_numpy)
+        if base_img_numpy is None:
+            base_img_numpy = nifti_numpy
+            continue
+        agg_arr = np.where(base_img_numpy != 0, 1, base_img_numpy) + np.where(
+            nifti_numpy != 0, 1, nifti_numpy
+        )
+        assert int(np.amax(agg_arr)) <= 1
+        base_img_numpy = np.maximum(base_img_numpy, nifti_numpy)
+        np.unique(base_img_numpy)
+    return base_img_numpy
+
+
+def combine_label_map(nifti_paths):
+    label_map = None
+    for label_int, nifti_path in nifti_paths:
+        nifti_loaded, mask = load_mask(nifti_path, foreground_value=1)
+        if label_map is None:
+            label_map = LabelMap(nifti_loaded, max_label_int=len(nifti_paths))
+        assert label_map.add(mask, label_int) == 0
+    return label_map.label_map
+
+
+def measure(name, function, nifti_paths):
+    tracemalloc.start()
+    start_time = time()
+    result = function(nifti_paths)
+    duration = time() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{name:<12} {duration:8.2f} s {peak / 1024**2:10.1f} MB peak  dtype={result.dtype}"
+    )
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--labels", type=int, default=117)
+    parser.add_argument("--shape", type=int, nargs=3, default=[256, 256, 200])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print(f"Creating {args.labels} synthetic masks with shape {args.shape} ...")
+        nifti_paths = create_synthetic_masks(tmp_dir, tuple(args.shape), args.labels)
+        legacy_result = measure("legacy", combine_legacy, nifti_paths)
+        label_map_result = measure("label_map", combine_label_map, nifti_paths)
+        assert np.array_equal(legacy_result, label_map_result)
+        print("Results are identical.")
@@ -0,0 +1,120 @@
+import nibabel as nib
+import numpy as np
+
+
+def get_label_dtype(max_label_int):
+    if max_label_int <= np.iinfo(np.uint8).max:
+        return np.uint8
+    elif max_label_int <= np.iinfo(np.uint16).max:
+        return np.uint16
+    return np.uint32
+
+
+def load_mask(nifti_path, foreground_value=None):
+    """
+    Loads a binary segmentation mask without float64/int64 intermediates.
+    Voxels == foreground_value are treated as foreground, any non-zero voxel if
+    foreground_value is None.
+
+    Returns the nibabel image and a bool mask (1 byte per voxel).
+    """
+    nifti_loaded = nib.load(nifti_path)
+    # dataobj keeps the on-disk dtype (usually uint8 for masks) instead of float64
+    data = np.asanyarray(nifti_loaded.dataobj)
+    mask = data != 0 if foreground_value is None else data == foreground_value
+    return nifti_loaded, mask
+
+
+def get_bbox(mask):
+    """
+    Returns the bounding box of a mask as tuple of slices or None if the mask is empty.
+    """
+    bbox = []
+    for axis in range(mask.ndim):
+        other_axes = tuple(x for x in range(mask.ndim) if x != axis)
+        non_zero = np.flatnonzero(np.any(mask, axis=other_axes))
+        if len(non_zero) == 0:
+            return None
+        bbox.append(slice(non_zero[0], non_zero[-1] + 1))
+    return tuple(bbox)
+
+
+def bboxes_intersect(bbox_a, bbox_b):
+    return all(a.start < b.stop and b.start < a.stop for a, b in zip(bbox_a, bbox_b))
+
+
+class LabelMap:
+    """
+    Multi-label map which is filled in-place with binary masks.
+
+    The label map uses the smallest unsigned dtype that fits all label_ints.
+    Overlap with already added masks is only checked within the bounding box of the
+    new mask and only if it intersects the bounding box of an already added mask.
+    """
+
+    def __init__(self, reference_nifti, max_label_int):
+        self.affine = reference_nifti.affine
+        self.header = reference_nifti.header.copy()
+        self.shape = reference_nifti.shape
+        self.label_map = np.zeros(self.shape, dtype=get_label_dtype(max_label_int))
+        self.bboxes = {}
+
+    @property
+    def labels(self):
+        return list(self.bboxes.keys())
+
+    def add(self, mask, label_int):
+        """
+        Adds a binary mask as label_int to the label map.
+
+        Returns the overlap with the already added masks in percent of the volume.
+        If there is an overlap the mask is not added.
+        """
+        assert mask.shape == self.shape
+        bbox = get_bbox(mask)
+        if bbox is None:
+            return 0
+
+        label_map_crop = self.label_map[bbox]
+        mask_crop = mask[bbox]
+        if any(bboxes_intersect(bbox, x) for x in self.bboxes.values()):
+            overlap_voxel_count = np.count_nonzero(label_map_crop[mask_crop])
+            if overlap_voxel_count > 0:
+                return 100 * float(overlap_voxel_count) / float(self.label_map.size)
+
+        label_map_crop[mask_crop] = label_int
+        self.bboxes[label_int] = bbox
+        return 0
+
+    def to_nifti(self):
+        result_nifti = nib.Nifti1Image(self.label_map, self.affine, self.header)
+        result_nifti.set_data_dtype(self.label_map.dtype)
+        return result_nifti
+
+    def to_filename(self, target_nifti_path):
+        self.to_nifti().to_filename(target_nifti_path)
+
+
+def fuse_masks(nifti_paths, fused_label_int):
+    """
+    ORs all binary masks into a single label map with fused_label_int as encoding.
+
+    Returns the label map as nibabel image (header and affine of the last mask).
+    """
+    fused_mask = None
+    nifti_loaded = None
+    for nifti_path in nifti_paths:
+        nifti_loaded, mask = load_mask(nifti_path)
+        if fused_mask is None:
+            fused_mask = mask
+            continue
+        assert mask.shape == fused_mask.shape
+        np.logical_or(fused_mask, mask, out=fused_mask)
+
+    fused_label_map = fused_mask.astype(get_label_dtype(fused_label_int))
+    fused_label_map *= fused_label_map.dtype.type(fused_label_int)
+    result_nifti = nib.Nifti1Image(
+        fused_label_map, nifti_loaded.affine, nifti_loaded.header
+    )
+    result_nifti.set_data_dtype(fused_label_map.dtype)
+    return result_nifti
@@ -3,15 +3,10 @@ from os.path import join, exists, dirname, basename
 from glob import glob
 from pathlib import Path
 from logger_helper import get_logger
+from label_map import LabelMap, load_mask, fuse_masks
 import logging
 import json
 import shutil
-from glob import glob
-from pathlib import Path
-import shutil
-import nibabel as nib
-import numpy as np
-import json
 import re
 
 processed_count = 0
@@ -36,10 +31,9 @@ def combine(
 ):
     global processed_count, input_file_extension
 
-    # define base_imgs for combining process
-    base_img = None
-    base_img_numpy = None
-    base_img_labels = None
+    # label map for the combining process - created with the first non-empty mask
+    label_map = None
+    max_label_int = max(int(x["label_int"]) for x in seg_info_list)
 
     # multiple labels in seg_info -> combine them
     for label_entry in seg_info_list:
@@ -77,32 +71,24 @@ def combine(
         logger.info("")
         logger.info(f"Combining {basename(label_nifti_path)}")
 
-        # load current nifti and it's numpy array
-        nifti_loaded = nib.load(label_nifti_path)
-        nifti_numpy = nifti_loaded.get_fdata().astype(int)
-
-        # modify one-hot encoded numpy array to have label_int as encoding integer in segmentation label mask
-        nifti_numpy[nifti_numpy == 1] = label_int
-        nifti_labels_found = list(np.unique(nifti_numpy))
-        logger.info(f"New labels found {nifti_labels_found}")
+        # load current nifti as binary mask (no float64/int64 copies), only voxels == 1 are mapped to label_int
+        nifti_loaded, nifti_mask = load_mask(label_nifti_path, foreground_value=1)
 
         # if no one-hot encoded label was found in nifti numpy array --> skip segmentation label mask
-        if len(nifti_labels_found) == 1:
+        if not nifti_mask.any():
             logger.warning("No annotation has been found -> skipping mask ...")
             continue
+        logger.info(f"New labels found {[0, label_int]}")
 
-        # first of to-be-combined niftis serves as base image
-        if base_img == None:
-            base_img = nifti_loaded
-            base_img_numpy = nifti_numpy
-            base_img_labels = nifti_labels_found
-            logger.info(f"Set base_img with labels: {base_img_labels}")
-            processed_count += 1
-            target_seg_info_dict["seg_info"].append(label_entry)
-            continue
+        # first of to-be-combined niftis serves as reference image
+        if label_map is None:
+            label_map = LabelMap(
+                reference_nifti=nifti_loaded, max_label_int=max_label_int
+            )
+            logger.info(f"Set label_map with dtype: {label_map.label_map.dtype}")
 
         # can not combine niftis with different shapes --> throw error
-        if base_img.shape != nifti_loaded.shape:
+        if label_map.shape != nifti_loaded.shape:
             logger.error("")
             logger.error(basename(label_nifti_path))
             logger.error("Shape miss-match! -> Error")
@@ -110,21 +96,16 @@ def combine(
             exit(1)
 
         # check whether label_int of current label was already combined with a previous nifti; if yes --> throw error
-        duplicates_found = [
-            x for x in nifti_labels_found if x != 0 and x in base_img_labels
-        ]
-        for duplicate in duplicates_found:
+        if label_int in label_map.labels:
             logger.error("")
-            logger.error(f"Label {duplicate} has already been found! -> Error")
+            logger.error(f"Label {label_int} has already been found! -> Error")
             logger.error("")
-        else:
-            logger.info("No duplicates found.")
-        if len(duplicates_found) > 0:
             exit(1)
+        logger.info("No duplicates found.")
 
-        # check potential overlap of current segmentation label mask and already combined masks
-        overlap_percentage = check_overlap(base_map=base_img_numpy, new_map=nifti_numpy)
+        # combine current mask with already combined masks, if it does not overlap
         # if overlap, ignore current segmentation label mask in combining process
+        overlap_percentage = label_map.add(mask=nifti_mask, label_int=label_int)
         if overlap_percentage > 0:
             logger.error("")
             logger.error(label_nifti_path)
@@ -135,20 +116,15 @@ def combine(
             continue
 
         logger.info(" -> no overlap ♥")
-        logger.info(" Combining base_img_numpy + nifti_numpy ...")
+        logger.info(f" Combined labels: {label_map.labels}")
         logger.info("")
-        # combine current nifti numpy array with already combined nifti stack
-        # combining via taking from each pixel max value; as overlaps are already sorted out, it is always just label_int vs. 0
-        base_img_numpy = np.maximum(base_img_numpy, nifti_numpy)
-        base_img_labels = list(np.unique(base_img_numpy))
         target_seg_info_dict["seg_info"].append(label_entry)
         processed_count += 1
 
     # generate final nifti file from combined niftis
     logger.info(f" Generating combined result NIFTI @{basename(target_nifti_path)}")
-    assert len(base_img_labels) > 1
-    result_nifti = nib.Nifti1Image(base_img_numpy, base_img.affine, base_img.header)
-    result_nifti.to_filename(target_nifti_path)
+    assert label_map is not None and len(label_map.labels) > 0
+    label_map.to_filename(target_nifti_path)
     logger.info(f"Done {processed_count=}")
 
     if len(input_files) > 0:
@@ -254,8 +230,6 @@ def fuse(
                 fuse_label_index_in_seg_info[i]
             ]["label_int"]
             fuse_label_dict["nifti_fname"] = fitting_nifti_found[i]
-            nifti_loaded = nib.load(fuse_label_dict["nifti_fname"])
-            fuse_label_dict["nifti_np_array"] = nifti_loaded.get_fdata().astype(int)
 
             # add fuse_label_dict to fusion_list
             fusion_list.append(fuse_label_dict)
@@ -266,16 +240,12 @@ def fuse(
         # get new label_int of fused labels, i.e. smallest label_int of fused labels
         fused_label_int = min(fusion_list, key=lambda x: x["label_int"])["label_int"]
 
-        # check dims of fused label masks
-        nifti_np_arrays = [item["nifti_np_array"] for item in fusion_list]
-        dimensions_are_same = all(
-            arr.shape == nifti_np_arrays[0].shape for arr in nifti_np_arrays
-        )
-        assert dimensions_are_same
-
         # fuse them to single nifti file and set all non-zero label_ints to fused_label_int
-        fused_nifti_np = np.sum(nifti_np_arrays, axis=0)
-        fused_nifti_np[fused_nifti_np != 0] = fused_label_int
+        # -> the masks are ORed one after another, only one mask is loaded at a time
+        result_nifti = fuse_masks(
+            nifti_paths=[item["nifti_fname"] for item in fusion_list],
+            fused_label_int=fused_label_int,
+        )
 
         # save fused_nifti as nii.gz file
         result_nifti_fname = (
@@ -288,9 +258,6 @@ def fuse(
             + fused_label_name
             + ".nii.gz"
         )
-        result_nifti = nib.Nifti1Image(
-            fused_nifti_np, nifti_loaded.affine, nifti_loaded.header
-        )
         result_nifti.to_filename(result_nifti_fname)
 
     # adapt seg_info JSON
@@ -461,22 +428,6 @@ def merge_mask_niftis(nifti_dir, target_dir, mode=None):
     return res, nifti_dir, target_seg_info_dict
 
 
-def check_overlap(base_map, new_map):
-    overlap_percentage = 0
-
-    base_map = np.where(base_map != 0, 1, base_map)
-    new_map = np.where(new_map != 0, 1, new_map)
-
-    agg_arr = base_map + new_map
-    max_value = int(np.amax(agg_arr))
-    if max_value > 1:
-        overlap_indices = agg_arr > 1
-        overlap_voxel_count = overlap_indices.sum()
-        overlap_percentage = 100 * float(overlap_voxel_count) / float(base_map.size)
-
-    return overlap_percentage
-
-
 if __name__ == "__main__":
     log_level = getenv("LOG_LEVEL", "info").lower()
     log_level_int = None
@@ -0,0 +1,291 @@
+import multiprocessing
+import os
+import tempfile
+from os.path import join
+
+import numpy as np
+import SimpleITK as sitk
+
+"""
+Documentation radiomics_engine.py:
+
+Extracts the features of many masks of one image with the same results as one
+RadiomicsFeatureExtractor.execute(image_file, mask_file, label=label) per mask:
+
+- The image is read once and stored as uncompressed npy file, which all worker processes
+  memory-map read-only. A multilabel mask is shared the same way and the bounding boxes of all
+  its labels are computed in one pass.
+- Every mask is cropped to its bounding box (plus margin) before the extraction.
+- The resampling grid of pyradiomics (imageoperations.resampleImage) is aligned to the origin
+  of the full mask. It is computed on the full geometry and the cropped image and mask are
+  resampled onto it, so the result does not depend on the crop.
+- The number of worker processes scales with the available cores.
+
+Masks with a different geometry than the image are extracted from the files by pyradiomics.
+"""
+
+# additional voxels around the resampling grid: support of the B-spline interpolation
+# and decay of its prefilter at the crop borders
+crop_margin = 16
+
+# state of the worker processes
+worker = {}
+
+
+def get_available_cores():
+    return len(os.sched_getaffinity(0))
+
+
+def get_reference(geometry):
+    # 1-voxel image with the geometry of the full image -> index <-> physical point
+    reference = sitk.Image([1] * len(geometry["size"]), sitk.sitkUInt8)
+    reference.SetSpacing(geometry["spacing"])
+    reference.SetOrigin(geometry["origin"])
+    reference.SetDirection(geometry["direction"])
+    return reference
+
+
+def get_geometry(image):
+    return {
+        "size": list(image.GetSize()),
+        "spacing": list(image.GetSpacing()),
+        "origin": list(image.GetOrigin()),
+        "direction": list(image.GetDirection()),
+    }
+
+
+def is_same_geometry(geometry, image, tolerance):
+    other_geometry = get_geometry(image)
+    if other_geometry["size"] != geometry["size"]:
+        return False
+    return all(
+        np.allclose(geometry[key], other_geometry[key], rtol=0, atol=tolerance)
+        for key in ["spacing", "origin", "direction"]
+    )
+
+
+def get_bounding_boxes(mask):
+    """
+    Returns {label: bounding box (lower index followed by size, x/y/z order)} of all labels.
+    """
+    label_statistics = sitk.LabelShapeStatisticsImageFilter()
+    label_statistics.ComputePerimeterOff()
+    label_statistics.Execute(sitk.Cast(mask, sitk.sitkUInt32))
+    return {
+        label: np.array(label_statistics.GetBoundingBox(label))
+        for label in label_statistics.GetLabels()
+    }
+
+
+def get_resampling_grid(reference, size, bb, settings):
+    """
+    Same grid as imageoperations.resampleImage for a mask of size with the geometry of reference.
+    Returns (spacing, size, origin, continuous index of the origin, extent in index space)
+    or None if pyradiomics does not resample.
+    """
+    spacing = np.array(reference.GetSpacing())
+    nd = len(spacing)
+    pad_distance = settings.get("padDistance", 5)
+
+    resampled_spacing = np.array(settings["resampledPixelSpacing"])
+    resampled_spacing = np.where(resampled_spacing == 0, spacing, resampled_spacing)
+    resampled_spacing = np.where(bb[nd:] != 1, resampled_spacing, spacing)
+    if np.allclose(spacing, resampled_spacing):
+        return None
+
+    spacing_ratio = spacing / resampled_spacing
+    lower_bound = np.floor((bb[:nd] - 0.5) * spacing_ratio - pad_distance)
+    upper_bound = np.ceil((bb[:nd] + bb[nd:] - 0.5) * spacing_ratio + pad_distance)
+    max_upper_bound = np.ceil(size * spacing_ratio) - 1
+    lower_bound = np.where(lower_bound < 0, 0, lower_bound)
+    upper_bound = np.where(upper_bound > max_upper_bound, max_upper_bound, upper_bound)
+    new_size = np.array(upper_bound - lower_bound + 1, dtype="int")
+
+    origin_index = 0.5 * (resampled_spacing - spacing) / spacing
+    origin_index = origin_index + lower_bound / spacing_ratio
+    new_origin = reference.TransformContinuousIndexToPhysicalPoint(
+        origin_index.tolist()
+    )
+    index_extent = (new_size - 1) / spacing_ratio
+    return resampled_spacing, new_size, new_origin, origin_index, index_extent
+
+
+def crop_array(array, lower, upper):
+    # array: z/y/x, lower/upper: inclusive x/y/z index
+    return array[
+        lower[2] : upper[2] + 1, lower[1] : upper[1] + 1, lower[0] : upper[0] + 1
+    ]
+
+
+def array_to_image(array, reference, lower):
+    image = sitk.GetImageFromArray(np.ascontiguousarray(array))
+    image.SetSpacing(reference.GetSpacing())
+    image.SetDirection(reference.GetDirection())
+    image.SetOrigin(reference.TransformIndexToPhysicalPoint([int(x) for x in lower]))
+    return image
+
+
+def get_cropped_image_and_mask(image_array, mask_array, label, bb, settings):
+    """
+    Returns the image and mask (UInt32, label -> 1) as they are after loading and resampling
+    in pyradiomics (cropped to the resampling grid).
+    """
+    reference = worker["reference"]
+    size = np.array(worker["geometry"]["size"])
+    nd = len(size)
+    grid = get_resampling_grid(reference, size, bb, settings)
+    if grid is None:
+        # resampleImage only crops with padDistance (imageoperations.cropToTumorMask)
+        pad_distance = settings.get("padDistance", 5)
+        lower = np.maximum(bb[:nd] - pad_distance, 0)
+        upper = np.minimum(bb[:nd] + bb[nd:] - 1 + pad_distance, size - 1)
+    else:
+        _, _, _, origin_index, index_extent = grid
+        lower = np.maximum(np.floor(origin_index) - crop_margin, 0).astype(int)
+        upper = np.minimum(
+            np.ceil(origin_index + index_extent) + crop_margin, size - 1
+        ).astype(int)
+
+    image = array_to_image(crop_array(image_array, lower, upper), reference, lower)
+    mask = array_to_image(
+        (crop_array(mask_array, lower, upper) == label).astype(np.uint32),
+        reference,
+        lower,
+    )
+    if grid is None:
+        return image, mask
+
+    resampled_spacing, new_size, new_origin, _, _ = grid
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetOutputSpacing(resampled_spacing.tolist())
+    resampler.SetOutputDirection(reference.GetDirection())
+    resampler.SetSize(new_size.tolist())
+    resampler.SetOutputOrigin(new_origin)
+    resampler.SetOutputPixelType(image.GetPixelID())
+    resampler.SetInterpolator(
+        getattr(sitk, settings.get("interpolator", "sitkBSpline"))
+    )
+    image = resampler.Execute(image)
+    resampler.SetOutputPixelType(sitk.sitkUInt32)
+    resampler.SetInterpolator(sitk.sitkNearestNeighbor)
+    mask = resampler.Execute(mask)
+    return image, mask
+
+
+def get_extractor(settings, feature_classes):
+    from radiomics import featureextractor
+
+    extractor = featureextractor.RadiomicsFeatureExtractor(**settings)
+    extractor.disableAllFeatures()
+    for feature_class in feature_classes:
+        extractor.enableFeatureClassByName(feature_class)
+    return extractor
+
+
+def init_worker(img_file, image_npy, label_npy, geometry, settings, feature_classes):
+    # parallelism comes from the processes
+    sitk.ProcessObject_SetGlobalDefaultNumberOfThreads(1)
+    worker["img_file"] = img_file
+    worker["image_array"] = np.load(image_npy, mmap_mode="r")
+    worker["label_array"] = (
+        None if label_npy is None else np.load(label_npy, mmap_mode="r")
+    )
+    worker["geometry"] = geometry
+    worker["reference"] = get_reference(geometry)
+    worker["settings"] = settings
+    worker["feature_classes"] = feature_classes
+    # image and mask are already resampled
+    worker["extractor"] = get_extractor(
+        dict(settings, resampledPixelSpacing=None), feature_classes
+    )
+
+
+def extract_mask(task):
+    """
+    task: (mask name, mask file or None for the shared multilabel mask, label, bounding box)
+    Returns (mask name, features or None if the label is not present, error or None).
+    """
+    mask_name, mask_file, label, bb = task
+    settings = worker["settings"]
+    try:
+        if mask_file is None:
+            mask_array = worker["label_array"]
+        else:
+            mask = sitk.ReadImage(str(mask_file))
+            if not is_same_geometry(
+                worker["geometry"], mask, settings.get("geometryTolerance", 1e-3)
+            ):
+                print(f"# {mask_name}: geometry differs from the image -> files")
+                extractor = get_extractor(settings, worker["feature_classes"])
+                features = extractor.execute(
+                    str(worker["img_file"]), str(mask_file), label=label
+                )
+                return mask_name, features, None
+            mask_array = sitk.GetArrayViewFromImage(mask)
+            bb = get_bounding_boxes(mask).get(label)
+        if bb is None:
+            return mask_name, None, None
+
+        image, mask = get_cropped_image_and_mask(
+            worker["image_array"], mask_array, label, bb, settings
+        )
+        return mask_name, worker["extractor"].execute(image, mask, label=1), None
+    except Exception as e:
+        return mask_name, None, e
+
+
+def extract_features(
+    img_file,
+    masks,
+    settings,
+    feature_classes,
+    multilabel_file=None,
+    num_processes=None,
+):
+    """
+    masks: (mask name, mask file, label) or (mask name, label) if multilabel_file is set.
+    Yields (mask name, features or None if the label is not present, error or None)
+    in the order of masks.
+    """
+    num_processes = max(1, min(num_processes or get_available_cores(), len(masks)))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image = sitk.ReadImage(str(img_file))
+        geometry = get_geometry(image)
+        image_npy = join(tmp_dir, "image.npy")
+        np.save(image_npy, sitk.GetArrayViewFromImage(image))
+        del image
+
+        label_npy = None
+        if multilabel_file is not None:
+            label_image = sitk.ReadImage(str(multilabel_file))
+            assert is_same_geometry(
+                geometry, label_image, settings.get("geometryTolerance", 1e-3)
+            ), "Geometry of the multilabel mask differs from the image"
+            bounding_boxes = get_bounding_boxes(label_image)
+            label_npy = join(tmp_dir, "labels.npy")
+            np.save(label_npy, sitk.GetArrayViewFromImage(label_image))
+            del label_image
+            tasks = [
+                (mask_name, None, label, bounding_boxes.get(label))
+                for mask_name, label in masks
+            ]
+        else:
+            tasks = [
+                (mask_name, mask_file, label, None)
+                for mask_name, mask_file, label in masks
+            ]
+
+        print(f"# Extracting {len(tasks)} mask(s) with {num_processes} process(es)")
+        with multiprocessing.get_context("spawn").Pool(
+            num_processes,
+            initializer=init_worker,
+            initargs=(
+                img_file,
+                image_npy,
+                label_npy,
+                geometry,
+                settings,
+                feature_classes,
+            ),
+        ) as pool:
+            yield from pool.imap(extract_mask, tasks)
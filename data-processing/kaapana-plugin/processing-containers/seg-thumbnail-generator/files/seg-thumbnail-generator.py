@@ -16,6 +16,11 @@ from colormath.color_conversions import convert_color
 from colormath.color_objects import LabColor, sRGBColor
 from kaapanapy.logger import get_logger
 from PIL import Image, ImageDraw, ImageFilter
+from thumbnail_engine import (
+    UnsupportedInput,
+    load_best_slice_from_dicom_segmentation,
+    load_best_slice_from_rtstruct,
+)
 
 logger = get_logger(__name__)
 
@@ -86,74 +91,86 @@ def generate_thumbnail(parameters: tuple) -> tuple:
     logger.info(f"target_dir: {target_dir}")
 
     # Load the DICOM segmentation object or RTSTRUCT file to determine the modality and series UID
-    ds = pydicom.dcmread(os.path.join(dcm_seg_dir, os.listdir(dcm_seg_dir)[0]))
+    seg_path = os.path.join(dcm_seg_dir, os.listdir(dcm_seg_dir)[0])
+    ds = pydicom.dcmread(seg_path, stop_before_pixels=True)
     modality = ds.Modality
     seg_series_uid = ds.SeriesInstanceUID
 
     # Create the target directory if it does not exist
     os.makedirs(target_dir, exist_ok=True)
 
-    # Load the image and segmentation (and segment colors)
-    if modality == "RTSTRUCT":
-        image_array, seg_arrays, segment_colors = (
-            load_image_and_segmentation_from_rtstruct(dcm_dir, dcm_seg_dir)
-        )
-    elif modality == "SEG":
-        image_array, seg_arrays, segment_colors = (
-            load_image_and_segmentation_from_dicom_segmentation(dcm_dir, dcm_seg_dir)
-        )
-    else:
+    if modality not in ["RTSTRUCT", "SEG"]:
         logger.warning(f"Modality {modality} not supported. Skipping.")
         return False, ""
 
-    # Count the number of classes in each slice
-    classes_per_slice = np.sum(
-        np.any(seg_arrays > 0, axis=(2, 3)), axis=0
-    )  # Shape: (114,)
-
-    # Calculate the total segmentation area for each slice
-    area_per_slice = np.sum(
-        np.sum(seg_arrays, axis=0) > 0, axis=(1, 2)
-    )  # Shape: (114,)
-
-    # Combine the classes and area into a structured array for sorting
-    slice_metrics = np.array(
-        [
-            (i, classes_per_slice[i], area_per_slice[i])
-            for i in range(seg_arrays.shape[1])
-        ],
-        dtype=[("index", int), ("num_classes", int), ("area", int)],
-    )
-
-    # Sort by number of classes (descending) and area (descending)
-    sorted_slices = np.sort(slice_metrics, order=["num_classes", "area"])[::-1]
-
-    # The slice with the most classes and largest area
-    best_slice_index = sorted_slices[0]["index"]
-    best_slice_num_classes = sorted_slices[0]["num_classes"]
-    best_slice_area = sorted_slices[0]["area"]
+    # Only the best slice of the image and segmentation is decoded
+    try:
+        if modality == "RTSTRUCT":
+            slice_index, number_of_classes, area, base_image_array, slice_masks = (
+                load_best_slice_from_rtstruct(dcm_dir, seg_path)
+            )
+            segment_colors = {
+                seg_class: {
+                    "color": [randint(0, 255), randint(0, 255), randint(0, 255)]
+                }
+                for seg_class in slice_masks
+            }
+        else:
+            slice_index, number_of_classes, area, base_image_array, slice_masks = (
+                load_best_slice_from_dicom_segmentation(dcm_dir, seg_path)
+            )
+            segment_colors = get_segment_colors(ds)
+    except UnsupportedInput as e:
+        logger.info(f"{e} -> loading the complete image and segmentation")
+        (
+            slice_index,
+            number_of_classes,
+            area,
+            base_image_array,
+            slice_masks,
+            segment_colors,
+        ) = load_best_slice_from_volumes(dcm_dir, dcm_seg_dir, modality)
 
     best_slice = Slice(
-        slice_index=best_slice_index,
-        segmentation_classes=classes_per_slice[best_slice_index],
-        number_of_classes=best_slice_num_classes,
-        number_of_foreground_pixels=best_slice_area,
+        slice_index=slice_index,
+        segmentation_classes=sorted(slice_masks.keys()),
+        number_of_classes=number_of_classes,
+        number_of_foreground_pixels=area,
     )
 
     logger.info(
         f"Best slice: {best_slice.slice_index} with {best_slice.number_of_classes} classes and {best_slice.number_of_foreground_pixels} foreground pixels"
     )
 
-    # Select the best image slice
-    base_image_array = image_array[best_slice.slice_index, :, :]
-    del image_array
+    image = render_thumbnail(base_image_array, slice_masks, segment_colors)
 
-    # Binary mask to highligh where the segments are
-    seg_array_binary = np.where(np.sum(seg_arrays, axis=0) > 0, 1, 0)
+    # Save the thumbnail
+    target_png = os.path.join(target_dir, f"new_{seg_series_uid}.png")
+    image.save(target_png)
+    logger.info(f"Thumbnail saved to {target_png}")
+
+    processed_count += 1
 
-    # Select the corresponding binary mask
-    base_seg_array_binary = seg_array_binary[best_slice.slice_index, :, :]
-    del seg_array_binary
+    return True, target_png
+
+
+def render_thumbnail(
+    base_image_array: np.ndarray, slice_masks: dict, segment_colors: dict
+) -> Image.Image:
+    """Renders the segment masks of a slice on top of the windowed image slice
+
+    Args:
+        base_image_array (np.ndarray): Image slice (height, width)
+        slice_masks (dict): Binary masks of the slice per segment number
+        segment_colors (dict): Colors per segment number
+
+    Returns:
+        Image.Image: RGBA thumbnail
+    """
+    # Binary mask to highligh where the segments are
+    base_seg_array_binary = np.zeros(base_image_array.shape, dtype=np.uint8)
+    for mask in slice_masks.values():
+        base_seg_array_binary[mask] = 1
 
     # Use the binary mask to get the relevant intensities (To see the regions within the mask better)
     masked_array = base_image_array * base_seg_array_binary
@@ -175,8 +192,6 @@ def generate_thumbnail(parameters: tuple) -> tuple:
     # Apply windowing to the original DICOM image
     windowed_data = np.clip(base_image_array, window_min, window_max)
 
-    del base_image_array
-
     # Normalize the windowed pixel values to 0-255
     normalized_data = (windowed_data - window_min) / (window_max - window_min) * 255
     normalized_data = normalized_data.astype(np.uint8)
@@ -185,17 +200,17 @@ def generate_thumbnail(parameters: tuple) -> tuple:
     image = Image.fromarray(normalized_data).convert("RGBA")
 
     # Combine all binary masks for the best slice to calculate overlap
-    overlap_map = np.sum(
-        seg_arrays[:, best_slice_index], axis=0
-    )  # Shape: (height, width)
+    overlap_map = np.zeros(base_image_array.shape, dtype=np.int64)
+    for mask in slice_masks.values():
+        overlap_map += mask
 
     # Avoid division by zero
     overlap_map = np.clip(overlap_map, 1, None)
 
     # Apply transparency blending for each segment
-    for seg_class in range(seg_arrays.shape[0]):
-        color = segment_colors[seg_class + 1]["color"]  # RGB tuple (e.g., (255, 0, 0))
-        mask_array = np.uint8(seg_arrays[seg_class, best_slice_index] > 0) * 255
+    for seg_class, seg_mask in slice_masks.items():
+        color = segment_colors[seg_class]["color"]  # RGB tuple (e.g., (255, 0, 0))
+        mask_array = np.uint8(seg_mask > 0) * 255
 
         mask = Image.fromarray(mask_array, mode="L")
 
@@ -222,14 +237,83 @@ def generate_thumbnail(parameters: tuple) -> tuple:
 
         image = Image.alpha_composite(image, fill_overlay)
 
-    # Save the thumbnail
-    target_png = os.path.join(target_dir, f"new_{seg_series_uid}.png")
-    image.save(target_png)
-    logger.info(f"Thumbnail saved to {target_png}")
+    return image
 
-    processed_count += 1
 
-    return True, target_png
+def load_best_slice_from_volumes(image_dir: str, seg_dir: str, modality: str) -> tuple:
+    """Fallback: loads the complete image and segmentation and selects the best slice
+
+    Returns:
+        tuple: (slice_index, number_of_classes, area, image slice, {segment_number: mask}, segment colors)
+    """
+    if modality == "RTSTRUCT":
+        image_array, seg_arrays, class_values, segment_colors = (
+            load_image_and_segmentation_from_rtstruct(image_dir, seg_dir)
+        )
+    else:
+        image_array, seg_arrays, class_values, segment_colors = (
+            load_image_and_segmentation_from_dicom_segmentation(image_dir, seg_dir)
+        )
+
+    # Count the number of classes in each slice
+    classes_per_slice = np.sum(np.any(seg_arrays > 0, axis=(2, 3)), axis=0)
+
+    # Calculate the total segmentation area for each slice
+    area_per_slice = np.sum(np.any(seg_arrays > 0, axis=0), axis=(1, 2))
+
+    # Sort by number of classes (descending) and area (descending), ties -> higher index
+    best_slice_index = int(
+        np.lexsort(
+            (np.arange(len(classes_per_slice)), area_per_slice, classes_per_slice)
+        )[-1]
+    )
+
+    slice_masks = {
+        class_value: seg_arrays[class_index, best_slice_index] > 0
+        for class_index, class_value in enumerate(class_values)
+        if np.any(seg_arrays[class_index, best_slice_index] > 0)
+    }
+    return (
+        best_slice_index,
+        int(classes_per_slice[best_slice_index]),
+        int(area_per_slice[best_slice_index]),
+        image_array[best_slice_index, :, :],
+        slice_masks,
+        segment_colors,
+    )
+
+
+def get_segment_colors(dicom_seg: pydicom.Dataset) -> dict:
+    """Looks up the color for each segment of a DICOM SEG object"""
+    segment_colors = {}
+    if "SegmentSequence" in dicom_seg:
+        for segment in dicom_seg.SegmentSequence:
+            segment_number = segment.SegmentNumber
+            segment_label = segment.SegmentLabel
+
+            # Extract the color information
+            if hasattr(segment, "RecommendedDisplayCIELabValue"):
+                cie_lab_color_int = segment.RecommendedDisplayCIELabValue
+                cie_lab_color_float = [float(int(x)) for x in cie_lab_color_int]
+                color_rgb = dicomlab2LAB(dicomlab=cie_lab_color_float)
+                lab = LabColor(color_rgb[0], color_rgb[1], color_rgb[2])
+                color_rgb = convert_color(lab, sRGBColor).get_upscaled_value_tuple()
+                color = [max(min(x, 255), 0) for x in color_rgb]
+                color_type = "CIELab"
+            elif hasattr(segment, "RecommendedDisplayRGBValue"):
+                color = segment.RecommendedDisplayRGBValue
+                color_type = "RGB"
+            else:
+                # If no color information is available, generate a random color
+                color = [randint(0, 255), randint(0, 255), randint(0, 255)]
+                color_type = "Random"
+
+            segment_colors[segment_number] = {
+                "label": segment_label,
+                "color_type": color_type,
+                "color": color,
+            }
+    return segment_colors
 
 
 def load_image_and_segmentation_from_dicom_segmentation(
@@ -253,8 +337,7 @@ def load_image_and_segmentation_from_dicom_segmentation(
     reader = pydicom_seg.SegmentReader()
     result = reader.read(dicom_seg)
 
-    # Iterate through the segments and extract the colors
-    segment_colors = {}
+    # Iterate through the segments
     seg_arrays = []
     for segment_number in result.available_segments:
         seg_array = result.segment_data(segment_number)
@@ -272,37 +355,16 @@ def load_image_and_segmentation_from_dicom_segmentation(
             del cropped_seg
 
         seg_arrays.append(seg_array)
-        # Look up the color for each class from dicom seg ob
-        if "SegmentSequence" in dicom_seg:
-            for segment in dicom_seg.SegmentSequence:
-                segment_number = segment.SegmentNumber
-                segment_label = segment.SegmentLabel
-
-                # Extract the color information
-                if hasattr(segment, "RecommendedDisplayCIELabValue"):
-                    cie_lab_color_int = segment.RecommendedDisplayCIELabValue
-                    cie_lab_color_float = [float(int(x)) for x in cie_lab_color_int]
-                    color_rgb = dicomlab2LAB(dicomlab=cie_lab_color_float)
-                    lab = LabColor(color_rgb[0], color_rgb[1], color_rgb[2])
-                    color_rgb = convert_color(lab, sRGBColor).get_upscaled_value_tuple()
-                    color = [max(min(x, 255), 0) for x in color_rgb]
-                    color_type = "CIELab"
-                elif hasattr(segment, "RecommendedDisplayRGBValue"):
-                    color = segment.RecommendedDisplayRGBValue
-                    color_type = "RGB"
-                else:
-                    print("Tada")
-                    # If no color information is available, generate a random color
-                    color = [randint(0, 255), randint(0, 255), randint(0, 255)]
-                    color_type = "Random"
-
-                segment_colors[segment_number] = {
-                    "label": segment_label,
-                    "color_type": color_type,
-                    "color": color,
-                }
 
-    return image_array, np.array(seg_arrays), segment_colors
+    # Look up the color for each class from dicom seg ob
+    segment_colors = get_segment_colors(dicom_seg)
+
+    return (
+        image_array,
+        np.array(seg_arrays),
+        list(result.available_segments),
+        segment_colors,
+    )
 
 
 def load_image_and_segmentation_from_rtstruct(
@@ -315,7 +377,7 @@ def load_image_and_segmentation_from_rtstruct(
         rt_struct_dir (str): Directory containing the RTSTRUCT file
 
     Returns:
-        tuple: Tuple containing the image array, segmentation array, and segment colors
+        tuple: Tuple containing the image array, segmentation array, class values and segment colors
     """
 
     # Load the RTSTRUCT
@@ -399,7 +461,10 @@ def load_image_and_segmentation_from_rtstruct(
         color = [randint(0, 255), randint(0, 255), randint(0, 255)]
         segment_colors[seg_class] = {"color": color}
 
-    return image_array, seg_arrays, segment_colors
+    class_values = [
+        int(class_value) for class_value in unique_classes if class_value != 0
+    ]
+    return image_array, seg_arrays, class_values, segment_colors
 
 
 if __name__ == "__main__":
@@ -0,0 +1,372 @@
+import math
+import os
+import struct
+from collections import defaultdict
+
+import cv2
+import numpy as np
+import pydicom
+import SimpleITK as sitk
+from kaapanapy.logger import get_logger
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+
+logger = get_logger(__name__)
+
+PIXEL_DATA_TAG = 0x7FE00010
+# Frames are counted in batches -> memory is bounded by the batch, not by the SEG
+FRAME_BATCH_SIZE = 32
+
+
+class UnsupportedInput(Exception):
+    """The input can not be handled lazily -> the full volumes have to be loaded."""
+
+
+class ImageSeries:
+    """
+    Headers of a DICOM image series sorted along the slice normal.
+    Pixel data is only decoded for single slices.
+    """
+
+    def __init__(self, image_dir: str):
+        file_paths = []
+        datasets = []
+        for file_name in os.listdir(image_dir):
+            file_path = os.path.join(image_dir, file_name)
+            ds = pydicom.dcmread(file_path, stop_before_pixels=True, force=True)
+            if "ImagePositionPatient" not in ds or "ImageOrientationPatient" not in ds:
+                continue
+            file_paths.append(file_path)
+            datasets.append(ds)
+
+        if len(datasets) == 0:
+            raise UnsupportedInput(f"No image slices found in {image_dir}")
+        if len(set(ds.SeriesInstanceUID for ds in datasets)) > 1:
+            raise UnsupportedInput(f"Multiple series found in {image_dir}")
+
+        orientation = np.array(datasets[0].ImageOrientationPatient, dtype=float)
+        self.normal = np.cross(orientation[:3], orientation[3:])
+        positions = np.array([ds.ImagePositionPatient for ds in datasets], dtype=float)
+        distances = positions @ self.normal
+        sort_order = np.argsort(distances)
+
+        self.file_paths = [file_paths[i] for i in sort_order]
+        self.positions = positions[sort_order]
+        self.distances = distances[sort_order]
+        self.rows = int(datasets[0].Rows)
+        self.columns = int(datasets[0].Columns)
+
+        pixel_spacing = [float(x) for x in datasets[0].PixelSpacing]
+        slice_spacing = (
+            float(self.distances[1] - self.distances[0])
+            if len(self.distances) > 1
+            else 1.0
+        )
+        # same order as SimpleITK: (x, y, z)
+        self.spacing = np.array([pixel_spacing[1], pixel_spacing[0], slice_spacing])
+        self.origin = self.positions[0]
+
+    def __len__(self):
+        return len(self.file_paths)
+
+    def get_slice_index(self, position):
+        distance = np.dot(np.array(position, dtype=float), self.normal)
+        slice_index = int(np.argmin(np.abs(self.distances - distance)))
+        if abs(self.distances[slice_index] - distance) > 0.5 * abs(self.spacing[2]):
+            return None
+        return slice_index
+
+    def read_slice(self, slice_index):
+        # SimpleITK applies the rescale slope/intercept like the series reader
+        image = sitk.ReadImage(self.file_paths[slice_index])
+        return sitk.GetArrayFromImage(image)[0]
+
+
+class SegmentationFrames:
+    """
+    Frames of a DICOM SEG object.
+
+    Segment numbers and positions are taken from the per-frame functional groups.
+    Pixel data of uncompressed SEGs is read frame-wise from the file, so the SEG
+    is never decoded completely.
+    """
+
+    def __init__(self, seg_path: str):
+        self.seg_path = seg_path
+        with open(seg_path, "rb") as f:
+            # the header is read up to the pixel data, which is never loaded
+            self.ds = pydicom.dcmread(f, stop_before_pixels=True)
+            # dcmread stops at the start of the pixel data element
+            pixel_data_tell = f.tell()
+        ds = self.ds
+
+        if ds.file_meta.TransferSyntaxUID not in [
+            ExplicitVRLittleEndian,
+            ImplicitVRLittleEndian,
+        ]:
+            raise UnsupportedInput(
+                f"Transfer syntax {ds.file_meta.TransferSyntaxUID} not supported"
+            )
+        if int(ds.BitsAllocated) not in [1, 8]:
+            raise UnsupportedInput(f"BitsAllocated {ds.BitsAllocated} not supported")
+        if "PerFrameFunctionalGroupsSequence" not in ds:
+            raise UnsupportedInput("No per-frame functional groups")
+
+        self.rows = int(ds.Rows)
+        self.columns = int(ds.Columns)
+        self.bits_allocated = int(ds.BitsAllocated)
+        self.frame_count = int(ds.NumberOfFrames)
+
+        shared_segment_number = None
+        shared_groups = ds.get("SharedFunctionalGroupsSequence", [None])[0]
+        if (
+            shared_groups is not None
+            and "SegmentIdentificationSequence" in shared_groups
+        ):
+            shared_segment_number = int(
+                shared_groups.SegmentIdentificationSequence[0].ReferencedSegmentNumber
+            )
+
+        self.frame_segments = []
+        self.frame_positions = []
+        for frame_groups in ds.PerFrameFunctionalGroupsSequence:
+            if "SegmentIdentificationSequence" in frame_groups:
+                self.frame_segments.append(
+                    int(
+                        frame_groups.SegmentIdentificationSequence[
+                            0
+                        ].ReferencedSegmentNumber
+                    )
+                )
+            elif shared_segment_number is not None:
+                self.frame_segments.append(shared_segment_number)
+            else:
+                raise UnsupportedInput("Frame without segment identification")
+            if "PlanePositionSequence" not in frame_groups:
+                raise UnsupportedInput("Frame without plane position")
+            self.frame_positions.append(
+                [
+                    float(x)
+                    for x in frame_groups.PlanePositionSequence[0].ImagePositionPatient
+                ]
+            )
+
+        self.pixel_data_offset = self.get_pixel_data_offset(
+            pixel_data_tell,
+            ds.file_meta.TransferSyntaxUID == ImplicitVRLittleEndian,
+        )
+
+    def get_pixel_data_offset(self, element_tell, is_implicit_vr):
+        """
+        Parses the header of the pixel data element and returns the file offset of its value.
+        """
+        with open(self.seg_path, "rb") as f:
+            f.seek(element_tell)
+            header = f.read(12)
+        if len(header) < 12:
+            raise UnsupportedInput("No pixel data")
+        group, element = struct.unpack("<HH", header[:4])
+        if (group << 16) | element != PIXEL_DATA_TAG:
+            raise UnsupportedInput(f"Unexpected element ({group:04X},{element:04X})")
+        if is_implicit_vr:
+            value_offset = 8
+            (length,) = struct.unpack("<I", header[4:8])
+        else:
+            # OB/OW: tag, VR, 2 reserved bytes and a 4 byte length
+            if header[4:6] not in [b"OB", b"OW"]:
+                raise UnsupportedInput(f"Pixel data VR {header[4:6]} not supported")
+            value_offset = 12
+            (length,) = struct.unpack("<I", header[8:12])
+        if length == 0xFFFFFFFF:
+            raise UnsupportedInput("Encapsulated pixel data not supported")
+        frame_bits = self.rows * self.columns * self.bits_allocated
+        if length < math.ceil(self.frame_count * frame_bits / 8):
+            raise UnsupportedInput("Pixel data shorter than the frames")
+        return element_tell + value_offset
+
+    def read_frame_range(self, start, stop):
+        """
+        Returns the foreground masks (bool) of the frames start:stop.
+        """
+        frame_bits = self.rows * self.columns * self.bits_allocated
+        bit_start = start * frame_bits
+        bit_stop = stop * frame_bits
+        byte_start = bit_start // 8
+        byte_stop = math.ceil(bit_stop / 8)
+
+        # only the bytes of the frames are read
+        with open(self.seg_path, "rb") as f:
+            f.seek(self.pixel_data_offset + byte_start)
+            buffer = f.read(byte_stop - byte_start)
+        data = np.frombuffer(buffer, dtype=np.uint8)
+
+        if self.bits_allocated == 1:
+            offset = bit_start - byte_start * 8
+            data = np.unpackbits(data, bitorder="little")[
+                offset : offset + bit_stop - bit_start
+            ]
+        return data.reshape(stop - start, self.rows, self.columns) > 0
+
+    def read_frames(self, frame_indices):
+        return [self.read_frame_range(x, x + 1)[0] for x in frame_indices]
+
+    def get_foreground_counts(self):
+        counts = np.zeros(self.frame_count, dtype=np.int64)
+        for start in range(0, self.frame_count, FRAME_BATCH_SIZE):
+            stop = min(start + FRAME_BATCH_SIZE, self.frame_count)
+            counts[start:stop] = np.count_nonzero(
+                self.read_frame_range(start, stop), axis=(1, 2)
+            )
+        return counts
+
+
+def select_best_slice(classes_per_slice, area_per_slice, get_exact_area=None):
+    """
+    Selects the slice with the most classes and the largest segmented area.
+    Ties are resolved by the higher slice index (same as the previous structured sort).
+
+    area_per_slice may be an upper bound (sum of the per-class areas); get_exact_area
+    is then only called for the slices with the most classes.
+    """
+    max_classes = max(len(x) for x in classes_per_slice.values())
+    candidates = [
+        slice_index
+        for slice_index, classes in classes_per_slice.items()
+        if len(classes) == max_classes
+    ]
+    if get_exact_area is not None:
+        area_per_slice = dict(area_per_slice)
+        for slice_index in candidates:
+            area_per_slice[slice_index] = get_exact_area(slice_index)
+    best_slice_index = max(candidates, key=lambda x: (area_per_slice[x], x))
+    return best_slice_index, max_classes, int(area_per_slice[best_slice_index])
+
+
+def load_best_slice_from_dicom_segmentation(image_dir: str, seg_path: str) -> tuple:
+    """
+    Selects the best slice of a DICOM SEG from its per-frame functional groups and
+    decodes only the frames and the image slice needed for the thumbnail.
+
+    Returns:
+        tuple: (slice_index, number_of_classes, area, image slice, {segment_number: mask})
+    """
+    image_series = ImageSeries(image_dir)
+    frames = SegmentationFrames(seg_path)
+    if (frames.rows, frames.columns) != (image_series.rows, image_series.columns):
+        raise UnsupportedInput("SEG and image have different in-plane dimensions")
+
+    frame_counts = frames.get_foreground_counts()
+
+    frames_per_slice = defaultdict(list)
+    classes_per_slice = defaultdict(set)
+    area_per_slice = defaultdict(int)
+    for frame_index, (segment_number, position, count) in enumerate(
+        zip(frames.frame_segments, frames.frame_positions, frame_counts)
+    ):
+        if count == 0:
+            continue
+        slice_index = image_series.get_slice_index(position)
+        if slice_index is None:
+            raise UnsupportedInput(f"Frame {frame_index} is not on an image slice")
+        frames_per_slice[slice_index].append(frame_index)
+        classes_per_slice[slice_index].add(segment_number)
+        area_per_slice[slice_index] += int(count)
+
+    if len(classes_per_slice) == 0:
+        raise UnsupportedInput("Empty segmentation")
+
+    def get_exact_area(slice_index):
+        if len(frames_per_slice[slice_index]) == 1:
+            return area_per_slice[slice_index]
+        masks = frames.read_frames(frames_per_slice[slice_index])
+        return int(np.count_nonzero(np.any(masks, axis=0)))
+
+    best_slice_index, number_of_classes, area = select_best_slice(
+        classes_per_slice, area_per_slice, get_exact_area
+    )
+
+    slice_masks = {}
+    for frame_index, mask in zip(
+        frames_per_slice[best_slice_index],
+        frames.read_frames(frames_per_slice[best_slice_index]),
+    ):
+        segment_number = frames.frame_segments[frame_index]
+        if segment_number in slice_masks:
+            mask = mask | slice_masks[segment_number]
+        slice_masks[segment_number] = mask
+
+    return (
+        best_slice_index,
+        number_of_classes,
+        area,
+        image_series.read_slice(best_slice_index),
+        slice_masks,
+    )
+
+
+def load_best_slice_from_rtstruct(image_dir: str, rtstruct_path: str) -> tuple:
+    """
+    Selects the best slice of an RTSTRUCT from the contour z-positions and rasterizes
+    only the contours of the candidate slices.
+
+    Returns:
+        tuple: (slice_index, number_of_classes, area, image slice, {roi_label: mask})
+    """
+    image_series = ImageSeries(image_dir)
+    rtstruct = pydicom.dcmread(rtstruct_path)
+
+    roi_label_mapping = {
+        roi.ROINumber: label
+        for label, roi in enumerate(rtstruct.StructureSetROISequence, start=1)
+    }
+
+    contours_per_slice = defaultdict(list)
+    for contour in rtstruct.ROIContourSequence:
+        roi_label = roi_label_mapping[contour.ReferencedROINumber]
+        for contour_sequence in contour.get("ContourSequence", []):
+            contour_data = np.array(contour_sequence.ContourData).reshape(-1, 3)
+            # Convert contour points to image indices
+            contour_points = np.round(
+                (contour_data - image_series.origin) / image_series.spacing
+            ).astype(int)
+            slice_number = int(contour_points[0, 2])
+            if slice_number < 0 or slice_number >= len(image_series):
+                continue
+            contours_per_slice[slice_number].append((roi_label, contour_points[:, :2]))
+
+    if len(contours_per_slice) == 0:
+        raise UnsupportedInput("Empty RTSTRUCT")
+
+    def rasterize(slice_index):
+        label_slice = np.zeros(
+            (image_series.rows, image_series.columns), dtype=np.uint8
+        )
+        for roi_label, points in contours_per_slice[slice_index]:
+            slice_mask = np.zeros_like(label_slice)
+            cv2.fillPoly(slice_mask, [points], roi_label)
+            # preserve labels like the volume rasterization
+            np.maximum(label_slice, slice_mask, out=label_slice)
+        return label_slice
+
+    classes_per_slice = {
+        slice_index: set(roi_label for roi_label, _ in contours)
+        for slice_index, contours in contours_per_slice.items()
+    }
+    best_slice_index, number_of_classes, area = select_best_slice(
+        classes_per_slice,
+        {x: 0 for x in classes_per_slice},
+        lambda x: int(np.count_nonzero(rasterize(x))),
+    )
+
+    label_slice = rasterize(best_slice_index)
+    slice_masks = {
+        int(roi_label): label_slice == roi_label
+        for roi_label in np.unique(label_slice)
+        if roi_label != 0
+    }
+    return (
+        best_slice_index,
+        number_of_classes,
+        area,
+        image_series.read_slice(best_slice_index),
+        slice_masks,
+    )
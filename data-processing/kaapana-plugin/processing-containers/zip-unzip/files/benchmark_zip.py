@@ -0,0 +1,107 @@
+"""
+Zip / unzip throughput of the previous implementation (single-threaded ZIP_DEFLATED, extractall)
+vs. zip_engine on a synthetic set of series (DICOM-like slices with 16 bit pixel data
+and one NIfTI.gz per series).
+
+Usage: python3 benchmark_zip.py [--files 10000] [--files-per-series 200] [--slice-size 512] [--threads <cores>]
+"""
+
+import argparse
+import gzip
+import os
+import tempfile
+import zipfile
+from os.path import getsize, join
+from time import time
+
+from zip_engine import collect_files, extract_members, get_available_cores, zip_files
+
+
+def create_slice(slice_size, index):
+    # smooth high byte + noisy low byte -> compresses roughly like CT pixel data
+    pixel_count = slice_size * slice_size
+    pixels = bytearray(2 * pixel_count)
+    pixels[0::2] = os.urandom(pixel_count)
+    pixels[1::2] = bytes((x // slice_size + index) % 16 for x in range(pixel_count))
+    return b"\0" * 128 + b"DICM" + os.urandom(1024) + bytes(pixels)
+
+
+def create_dataset(target_dir, file_count, files_per_series, slice_size):
+    slices = [create_slice(slice_size, index) for index in range(16)]
+    for series_index in range(0, file_count, files_per_series):
+        series_dir = join(target_dir, f"series-{series_index // files_per_series:04d}")
+        os.makedirs(series_dir)
+        series_file_count = min(files_per_series, file_count - series_index)
+        for index in range(series_file_count):
+            with open(join(series_dir, f"{index:05d}.dcm"), "wb") as f:
+                f.write(slices[index % len(slices)])
+        with gzip.open(join(series_dir, "image.nii.gz"), "wb", compresslevel=1) as f:
+            for index in range(series_file_count):
+                f.write(slices[index % len(slices)])
+
+
+def zip_previous(files, target_file):
+    with zipfile.ZipFile(target_file, "w", zipfile.ZIP_DEFLATED) as zipf:
+        for path, arcname in files:
+            zipf.write(path, arcname)
+
+
+def unzip_previous(zip_file, target_dir):
+    with zipfile.ZipFile(zip_file, "r") as zipf:
+        zipf.extractall(target_dir)
+
+
+def unzip_engine(zip_file, target_dir, threads):
+    for _ in extract_members(zip_file, target_dir, threads=threads):
+        pass
+
+
+def run(name, files, tmp_dir, zip_function, unzip_function):
+    zip_file = join(tmp_dir, f"{name}.zip")
+    start_time = time()
+    zip_function(files, zip_file)
+    zip_duration = time() - start_time
+
+    target_dir = join(tmp_dir, f"{name}-extracted")
+    start_time = time()
+    unzip_function(zip_file, target_dir)
+    unzip_duration = time() - start_time
+
+    extracted_count = sum(len(x[2]) for x in os.walk(target_dir))
+    assert extracted_count == len(files), f"{extracted_count} != {len(files)}"
+    print(
+        f"{name:<16} zip {zip_duration:7.2f} s  unzip {unzip_duration:7.2f} s  "
+        f"size {getsize(zip_file) / 1024**2:9.1f} MiB"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--files-per-series", type=int, default=200)
+    parser.add_argument("--slice-size", type=int, default=512)
+    parser.add_argument("--threads", type=int, default=get_available_cores())
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = join(tmp_dir, "data")
+        create_dataset(data_dir, args.files, args.files_per_series, args.slice_size)
+        files = collect_files(data_dir)
+        data_size = sum(getsize(path) for path, _ in files)
+        print(
+            f"Files: {len(files)} ({data_size / 1024**2:.1f} MiB), threads: {args.threads}"
+        )
+
+        run("previous", files, tmp_dir, zip_previous, unzip_previous)
+        for compression in ["deflate", "auto", "store"]:
+            run(
+                compression,
+                files,
+                tmp_dir,
+                lambda files, zip_file: zip_files(
+                    files, zip_file, compression=compression, threads=args.threads
+                ),
+                lambda zip_file, target_dir: unzip_engine(
+                    zip_file, target_dir, args.threads
+                ),
+            )
@@ -1,18 +1,35 @@
 import os
 import glob
 import pathlib
-import zipfile
-from shutil import copy2
-from os.path import join, relpath, basename, dirname, exists
+from time import time
+from os.path import join
+
+from zip_engine import (
+    collect_files,
+    compression_modes,
+    extract_members,
+    get_available_cores,
+    get_file_suffixes,
+    zip_files,
+)
 
 processed_count = 0
+compression = os.getenv("COMPRESSION", "auto").lower().strip()
+threads = os.getenv("THREADS", "None")
+threads = get_available_cores() if threads.lower() == "none" else int(threads)
 
 
 def unzip_file(zip_path, target_path):
     global processed_count
 
-    with zipfile.ZipFile(zip_path, "r") as zip_ref:
-        zip_ref.extractall(target_path)
+    print(f"# Unzipping {zip_path} --> {target_path}")
+    start_time = time()
+    extracted_count = 0
+    for _ in extract_members(zip_path, target_path, threads=threads):
+        extracted_count += 1
+        if extracted_count % 1000 == 0:
+            print(f"# {extracted_count} file(s) extracted ...")
+    print(f"# Extracted {extracted_count} file(s) in {time() - start_time:.1f} s")
     processed_count += 1
 
 
@@ -21,81 +38,30 @@ def zip_dir(zip_dir_path, target_file):
 
     print(f"# Zipping {zip_dir_path} --> {target_file}")
 
-    zipf = zipfile.ZipFile(target_file, "w", zipfile.ZIP_DEFLATED)
-    whitelist_files = os.getenv("WHITELIST_FILES", "NONE").split(",")
-    whitelist_files = None if whitelist_files[0] == "NONE" else whitelist_files
-    blacklist_files = os.getenv("BLACKLIST_FILES", "NONE").split(",")
-    blacklist_files = None if blacklist_files[0] == "NONE" else blacklist_files
-    # info_files = os.getenv("INFO_FILES", "NONE").split(",")
-    # info_files = None if info_files[0] == "NONE" else info_files
-    # target_dir = dirname(target_file)
+    whitelist_files = get_file_suffixes(os.getenv("WHITELIST_FILES", "NONE"))
+    blacklist_files = get_file_suffixes(os.getenv("BLACKLIST_FILES", "NONE"))
     print("#")
     print(f"# whitelist_files: {whitelist_files}")
     print(f"# blacklist_files: {blacklist_files}")
+    print(f"# compression:     {compression}")
+    print(f"# threads:         {threads}")
     print("#")
 
-    for root, dirs, files in os.walk(zip_dir_path):
-        for file in files:
-            skip_file = None
-
-            print("#")
-            print(f"# Checking file {file}")
-
-            # if info_files != None:
-            #     for info_file in info_files:
-            #         info_file = info_file.replace("*", "")
-            #         index_found = file.find(info_file)
-            #         if index_found != -1 and index_found + len(info_file) == len(file):
-            #             target_info_file_path = join(target_dir, basename(file))
-            #             info_file = join(root, file)
-            #             print(f"# Found info-file: {info_file}")
-            #             print(f"# Target: {target_info_file_path}")
-            #             copy2(info_file, target_info_file_path)
-
-            if blacklist_files != None:
-                skip_file = False
-                for blacklist_file in blacklist_files:
-                    blacklist_file = blacklist_file.replace("*", "")
-                    index_found = file.find(blacklist_file)
-                    if index_found != -1 and index_found + len(blacklist_file) == len(
-                        file
-                    ):
-                        print(f"# blacklist skip: {blacklist_file}")
-                        skip_file = True
-                        break
-
-            if skip_file != None and skip_file:
-                continue
-
-            if whitelist_files != None:
-                skip_file = True
-                for whitelist_file in whitelist_files:
-                    whitelist_file = whitelist_file.replace("*", "")
-                    index_found = file.find(whitelist_file)
-                    if index_found != -1 and index_found + len(whitelist_file) == len(
-                        file
-                    ):
-                        print(f"# whitelist add {whitelist_file}")
-                        skip_file = False
-                        break
-
-            if skip_file == None or not skip_file:
-                print(f"# Adding: {file}")
-                zipf.write(
-                    join(root, file),
-                    relpath(join(root.replace(zip_dir_path, ""), file), "/.."),
-                )
-                processed_count += 1
-            else:
-                print(f"# skipping: {file}")
-            print("#")
+    start_time = time()
+    files = collect_files(
+        zip_dir_path,
+        whitelist_suffixes=whitelist_files,
+        blacklist_suffixes=blacklist_files,
+    )
+    member_count = zip_files(
+        files, target_file, compression=compression, threads=threads
+    )
+    processed_count += member_count
 
     print("#")
-    print("# ZIPPING DONE")
+    print(f"# ZIPPING DONE: {member_count} file(s) in {time() - start_time:.1f} s")
     print("#")
 
-    zipf.close()
-
 
 if __name__ == "__main__":
     target_filename = os.getenv("TARGET_FILENAME", "NONE")
@@ -112,6 +78,9 @@ if __name__ == "__main__":
     print(f"# mode:        {mode}")
     print(f"# batch_level: {batch_level}")
     print("#")
+    if compression not in compression_modes:
+        print(f"# COMPRESSION: {compression} is not supported ({compression_modes})")
+        exit(1)
 
     batch_folders = sorted(
         [
@@ -159,9 +128,9 @@ if __name__ == "__main__":
                 pathlib.Path(element_output_dir).mkdir(parents=True, exist_ok=True)
 
                 print(f"Search dir: {element_input_dir}")
-                zip_files = glob.glob(join(element_input_dir, "*.zip"), recursive=True)
-                print(f"Files found: {zip_files}")
-                for zip_file in zip_files:
+                zip_paths = glob.glob(join(element_input_dir, "*.zip"), recursive=True)
+                print(f"Files found: {zip_paths}")
+                for zip_file in zip_paths:
                     unzip_file(zip_path=zip_file, target_path=element_output_dir)
 
         else:
@@ -173,8 +142,8 @@ if __name__ == "__main__":
             )
             pathlib.Path(batch_output_dir).mkdir(parents=True, exist_ok=True)
 
-            zip_files = glob.glob(join(batch_input_dir, "*.zip"), recursive=True)
-            for zip_file in zip_files:
+            zip_paths = glob.glob(join(batch_input_dir, "*.zip"), recursive=True)
+            for zip_file in zip_paths:
                 unzip_file(zip_path=zip_file, target_path=batch_output_dir)
 
     else:
@@ -0,0 +1,252 @@
+import math
+import os
+import shutil
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os.path import dirname, join, relpath
+
+"""
+Documentation zip_engine.py:
+
+Parallel zip / unzip based on zipfile:
+
+- The compression is chosen per file: already compressed payloads (*.nii.gz, *.zip, images, ...)
+  are stored, all other files are deflated with a fast level (COMPRESSION=auto).
+- Members are read and compressed by worker threads (zlib releases the GIL) and appended to the
+  archive in order by the main thread. Large files are streamed by zipfile itself.
+  The members waiting for the writer are bounded by max_pending_bytes, the default number of
+  threads by the CPU limit of the container.
+  zipfile switches to zip64 records as soon as sizes, offsets or the member count require it.
+- Members are extracted by worker threads and yielded as soon as they are written.
+  Every file is written to <name>.part first and renamed, so a consumer never sees partial files.
+"""
+
+compression_modes = ["auto", "store", "deflate"]
+stored_suffixes = (
+    ".gz",
+    ".zip",
+    ".npz",
+    ".pth",
+    ".pt",
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".jp2",
+    ".mp4",
+    ".bz2",
+    ".xz",
+    ".7z",
+)
+fast_compresslevel = 1
+default_compresslevel = 6
+# files above this size are written without reading them into memory
+large_file_size = 32 * 1024 * 1024
+# bounds the size of the files read or compressed but not yet written (independent of the threads)
+max_pending_bytes = 64 * 1024 * 1024
+copy_buffer_size = 1024 * 1024
+
+
+def get_cpu_quota():
+    """
+    Returns the CPU limit of the container (cgroup v2 or v1) or None if there is none.
+    """
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota == "max":
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def get_available_cores():
+    # in k8s the affinity covers all cores of the node, the pod is limited by its CPU quota
+    cores = len(os.sched_getaffinity(0))
+    cpu_quota = get_cpu_quota()
+    if cpu_quota is not None:
+        cores = min(cores, max(1, math.ceil(cpu_quota)))
+    return cores
+
+
+def get_file_suffixes(env_value):
+    """
+    "*.txt,*.png,plans.pkl" -> (".txt", ".png", "plans.pkl"), "NONE" -> None
+    """
+    if env_value is None or env_value.upper() == "NONE":
+        return None
+    return tuple(x.strip().replace("*", "") for x in env_value.split(",") if x.strip())
+
+
+def is_selected(file, whitelist_suffixes, blacklist_suffixes):
+    if blacklist_suffixes is not None and file.endswith(blacklist_suffixes):
+        return False
+    if whitelist_suffixes is not None and not file.endswith(whitelist_suffixes):
+        return False
+    return True
+
+
+def get_compression(file, compression):
+    """
+    Returns (compress_type, compresslevel) of a file for a compression mode.
+    """
+    if compression == "store":
+        return zipfile.ZIP_STORED, None
+    if compression == "deflate":
+        return zipfile.ZIP_DEFLATED, default_compresslevel
+    if file.lower().endswith(stored_suffixes):
+        return zipfile.ZIP_STORED, None
+    return zipfile.ZIP_DEFLATED, fast_compresslevel
+
+
+def collect_files(zip_dir_path, whitelist_suffixes=None, blacklist_suffixes=None):
+    """
+    Returns the sorted (path, arcname) of all selected files below zip_dir_path.
+    """
+    files = []
+    skipped_count = 0
+    for root, _, file_names in os.walk(zip_dir_path):
+        for file_name in file_names:
+            if not is_selected(file_name, whitelist_suffixes, blacklist_suffixes):
+                skipped_count += 1
+                continue
+            path = join(root, file_name)
+            files.append((path, relpath(path, zip_dir_path)))
+    print(f"# Selected {len(files)} file(s), skipped {skipped_count} file(s)")
+    return sorted(files, key=lambda x: x[1])
+
+
+def compress_member(path, arcname, compress_type, compresslevel):
+    zinfo = zipfile.ZipInfo.from_file(path, arcname, strict_timestamps=False)
+    with open(path, "rb") as f:
+        data = f.read()
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data)
+    zinfo.compress_type = zipfile.ZIP_STORED
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        # keep incompressible files stored
+        if len(compressed) < len(data):
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            data = compressed
+    zinfo.compress_size = len(data)
+    return zinfo, data
+
+
+def write_compressed_member(zipf, zinfo, data):
+    """
+    Appends an already compressed member (same bookkeeping as ZipFile.write).
+    """
+    zinfo.header_offset = zipf.fp.tell()
+    zipf.fp.write(zinfo.FileHeader())
+    zipf.fp.write(data)
+    zipf.filelist.append(zinfo)
+    zipf.NameToInfo[zinfo.filename] = zinfo
+    zipf.start_dir = zipf.fp.tell()
+
+
+def zip_files(files, target_file, compression="auto", threads=None):
+    """
+    Writes files (path, arcname) into target_file and returns the number of members.
+    """
+    assert compression in compression_modes, f"Unknown compression: {compression}"
+    threads = threads or get_available_cores()
+    # bounds the compressed members waiting for the writer by count and by bytes
+    max_pending = 2 * threads
+    with zipfile.ZipFile(target_file, "w", allowZip64=True) as zipf:
+        with ThreadPoolExecutor(threads) as executor:
+            pending = deque()
+            pending_bytes = 0
+
+            def write_next():
+                nonlocal pending_bytes
+                future, file_size = pending.popleft()
+                write_compressed_member(zipf, *future.result())
+                pending_bytes -= file_size
+
+            for path, arcname in files:
+                compress_type, compresslevel = get_compression(arcname, compression)
+                file_size = os.path.getsize(path)
+                if file_size > large_file_size:
+                    while len(pending) > 0:
+                        write_next()
+                    zipf.write(path, arcname, compress_type, compresslevel)
+                    continue
+                while len(pending) > 0 and (
+                    len(pending) >= max_pending
+                    or pending_bytes + file_size > max_pending_bytes
+                ):
+                    write_next()
+                pending.append(
+                    (
+                        executor.submit(
+                            compress_member,
+                            path,
+                            arcname,
+                            compress_type,
+                            compresslevel,
+                        ),
+                        file_size,
+                    )
+                )
+                pending_bytes += file_size
+            while len(pending) > 0:
+                write_next()
+            return len(zipf.filelist)
+
+
+def get_target_file(target_path, name):
+    # same as extractall: no absolute paths, nothing outside of target_path
+    target_file = os.path.realpath(join(target_path, name.lstrip("/")))
+    if os.path.commonpath([target_path, target_file]) != target_path:
+        raise ValueError(f"Illegal member path: {name}")
+    return target_file
+
+
+def extract_member(zipf, zinfo, target_file):
+    os.makedirs(dirname(target_file), exist_ok=True)
+    part_file = f"{target_file}.part"
+    with zipf.open(zinfo) as src, open(part_file, "wb") as dst:
+        shutil.copyfileobj(src, dst, copy_buffer_size)
+    os.replace(part_file, target_file)
+    return target_file
+
+
+def extract_members(zip_path, target_path, threads=None):
+    """
+    Extracts all members of zip_path into target_path and yields the path of every
+    extracted file as soon as it has been written (not in archive order).
+    """
+    threads = threads or get_available_cores()
+    target_path = os.path.realpath(target_path)
+    with zipfile.ZipFile(zip_path, "r") as zipf:
+        members = []
+        for zinfo in zipf.infolist():
+            target_file = get_target_file(target_path, zinfo.filename)
+            if zinfo.is_dir():
+                os.makedirs(target_file, exist_ok=True)
+            else:
+                members.append((zinfo, target_file))
+
+        with ThreadPoolExecutor(threads) as executor:
+            futures = [
+                executor.submit(extract_member, zipf, zinfo, target_file)
+                for zinfo, target_file in members
+            ]
+            try:
+                for future in as_completed(futures):
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
@@ -12,17 +12,29 @@ class PreprocessingOperator(KaapanaBaseOperator):
         self,
         dag,
         name="classification-preprocessing",
+        threads=4,
+        env_vars=None,
         execution_timeout=timedelta(minutes=20),
         *args,
         **kwargs,
     ):
+        if env_vars is None:
+            env_vars = {}
+
+        envs = {
+            # number of cases preprocessed in parallel (one volume in memory per process)
+            "THREADS": str(threads),
+        }
+        env_vars.update(envs)
+
         super().__init__(
             dag=dag,
             name=name,
             image=f"{DEFAULT_REGISTRY}/classification-preprocessing:{KAAPANA_BUILD_VERSION}",
             image_pull_secrets=["registry-secret"],
             execution_timeout=execution_timeout,
-            ram_mem_mb=4000,
+            env_vars=env_vars,
+            ram_mem_mb=8000,
             labels={"network-access-opensearch": "true"},
             *args,
             **kwargs,
@@ -1,7 +1,10 @@
 import ast
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
+from os import getenv
 
 import numpy as np
 import SimpleITK as sitk
@@ -41,24 +44,55 @@ class ZScoreNormalizer:
         return (image - np.mean(image)) / np.std(image)
 
 
-def compute_statistics(data):
+def get_percentile(partitioned, position):
+    # linear interpolation as np.percentile
+    lower = int(np.floor(position))
+    upper = min(lower + 1, partitioned.size - 1)
+    a = float(partitioned[lower])
+    b = float(partitioned[upper])
+    t = position - lower
+    return b - (b - a) * (1 - t) if t >= 0.5 else a + (b - a) * t
+
+
+def compute_statistics(data, chunk_size=2**22):
+    """
+    One streaming pass over chunks (sum, sum of squares) for mean and std and
+    one partition for min, max and all percentiles.
+    """
+    values = np.ravel(data)
+    n = values.size
+    total = 0.0
+    total_squares = 0.0
+    for chunk_start in range(0, n, chunk_size):
+        chunk = values[chunk_start : chunk_start + chunk_size].astype(np.float64)
+        total += float(chunk.sum())
+        total_squares += float(np.dot(chunk, chunk))
+    mean = total / n
+
+    percentiles = {"percentile_00_5": 0.5, "median": 50, "percentile_99_5": 99.5}
+    positions = {key: q / 100 * (n - 1) for key, q in percentiles.items()}
+    kth = {0, n - 1}
+    for position in positions.values():
+        kth.update([int(np.floor(position)), min(int(np.floor(position)) + 1, n - 1)])
+    partitioned = np.partition(values, sorted(kth))
+
     stats = {}
     stats["dimensions"] = data.shape
-    stats["mean"] = float(np.mean(data))
-    stats["median"] = float(np.median(data))
-    stats["std"] = float(np.std(data))
-    stats["min"] = float(np.min(data))
-    stats["max"] = float(np.max(data))
-    stats["percentile_99_5"] = float(np.percentile(data, 99.5))
-    stats["percentile_00_5"] = float(np.percentile(data, 0.5))
+    stats["mean"] = mean
+    stats["median"] = get_percentile(partitioned, positions["median"])
+    stats["std"] = float(np.sqrt(max(total_squares / n - mean**2, 0.0)))
+    stats["min"] = float(partitioned[0])
+    stats["max"] = float(partitioned[n - 1])
+    stats["percentile_99_5"] = get_percentile(partitioned, positions["percentile_99_5"])
+    stats["percentile_00_5"] = get_percentile(partitioned, positions["percentile_00_5"])
     return stats
 
 
-def resample_image(patient, order=3):
+def resample_image(data, order=3):
     tuple_from_string = ast.literal_eval(os.environ["PATCH_SIZE"])
     new_shape = np.array(tuple_from_string)
     resized = resize(
-        sitk.GetArrayFromImage(patient["image"]).squeeze(),
+        data.squeeze(),
         new_shape,
         order=order,
         mode="edge",
@@ -68,49 +102,156 @@ def resample_image(patient, order=3):
     return resized
 
 
-if __name__ == "__main__":
-    batch = {}
+def get_input_hash(input_file, chunk_size=2**20):
+    sha256 = hashlib.sha256()
+    with open(input_file, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def load_cache_entry(cache_file):
+    if not os.path.isfile(cache_file):
+        return None
+    with open(cache_file, "r") as f:
+        return json.load(f)
+
+
+def get_packed_dataset_dir():
+    return os.path.join("/", os.environ["WORKFLOW_DIR"], os.environ["OPERATOR_OUT_DIR"])
+
 
-    for patient in os.listdir(os.environ["BATCHES_INPUT_DIR"]):
-        
+def create_packed_dataset(patients, patch_size):
+    """
+    All cases in one contiguous array (cases, channels, *patch_size) for the training:
+    packed_data.npy + packed_index.json (uid of every row, written when all rows are complete).
+    """
+    packed_dir = get_packed_dataset_dir()
+    os.makedirs(packed_dir, exist_ok=True)
+    if os.path.exists(os.path.join(packed_dir, "packed_index.json")):
+        os.remove(os.path.join(packed_dir, "packed_index.json"))
+    return np.lib.format.open_memmap(
+        os.path.join(packed_dir, "packed_data.npy"),
+        mode="w+",
+        dtype=np.float32,
+        shape=(len(patients), 1, *patch_size),
+    )
+
+
+def finish_packed_dataset(packed_data, patients):
+    packed_data.flush()
+    with open(os.path.join(get_packed_dataset_dir(), "packed_index.json"), "w") as f:
+        json.dump({"uids": patients, "shape": list(packed_data.shape)}, f)
+    logger.debug(f"Packed {len(patients)} cases with shape {packed_data.shape[1:]}")
+
+
+def preprocess_case(patient, patient_index, packed_file):
+    """
+    Preprocesses one case into <patient>/OPERATOR_OUT_DIR/<patient>.npy and its row of
+    the packed dataset. The preprocessing is skipped if <patient>.json (written last)
+    has the same input hash and PATCH_SIZE.
+    Returns (patient, True if the cached result was used).
+    """
+    input_file = os.path.join(
+        os.environ["BATCHES_INPUT_DIR"],
+        patient,
+        "dcm-converter",
+        patient + ".nrrd",
+    )
+    target_dir = os.path.join(
+        os.environ["BATCHES_INPUT_DIR"], patient, os.environ["OPERATOR_OUT_DIR"]
+    )
+    target_file = os.path.join(target_dir, patient + ".npy")
+    cache_file = os.path.join(target_dir, patient + ".json")
+
+    cache_key = {
+        "input_hash": get_input_hash(input_file),
+        "patch_size": list(ast.literal_eval(os.environ["PATCH_SIZE"])),
+    }
+    cache_entry = load_cache_entry(cache_file)
+    cached = (
+        cache_entry is not None
+        and all(cache_entry.get(key) == value for key, value in cache_key.items())
+        and os.path.isfile(target_file)
+    )
+
+    if cached:
+        data_normalized = np.load(target_file, mmap_mode="r")
+    else:
         # Log
         logger.debug(f"Preprocessing for case {patient} started")
 
-        patient_dict = {}
+        image = sitk.ReadImage(input_file)
 
-        patient_dict["image"] = sitk.ReadImage(
-            os.path.join(
-                os.environ["BATCHES_INPUT_DIR"],
-                patient,
-                "dcm-converter",
-                patient + ".nrrd",
-            )
-        )
-
-        spacing = patient_dict["image"].GetSpacing()
+        spacing = image.GetSpacing()
 
         if len(spacing) > 3:
             raise ValueError(
                 "Not covering the scope of >3-dimensional arrays: E.g. 2 images in one"
             )
 
-        patient_dict["stats"] = compute_statistics(
-            sitk.GetArrayFromImage(patient_dict["image"])
-        )
+        data = sitk.GetArrayViewFromImage(image)
+        stats = compute_statistics(data)
 
         # Resample
-        data_resampled = resample_image(patient_dict)
+        data_resampled = resample_image(data)
+        del data, image
 
         # Normalize
         normalizer = ZScoreNormalizer()
         data_normalized = normalizer.normalize(data_resampled)
 
-        target_dir = os.path.join(
-            os.environ["BATCHES_INPUT_DIR"], patient, os.environ["OPERATOR_OUT_DIR"]
-        )
         os.makedirs(target_dir, exist_ok=True)
-        np.save(os.path.join(target_dir, patient + ".npy"), data_normalized)
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        np.save(target_file, data_normalized)
+        with open(cache_file, "w") as f:
+            json.dump(dict(cache_key, stats=stats), f)
+
+    if packed_file is not None:
+        packed_data = np.load(packed_file, mmap_mode="r+")
+        packed_data[patient_index, 0] = data_normalized
+        packed_data.flush()
+        del packed_data
+
+    # Log
+    logger.debug(f"{patient} was {'loaded from cache' if cached else 'preprocessed'}")
+    return patient, cached
+
+
+if __name__ == "__main__":
+    patients = sorted(os.listdir(os.environ["BATCHES_INPUT_DIR"]))
+
+    threads = getenv("THREADS", "None")
+    threads = (
+        len(os.sched_getaffinity(0)) if threads.lower() == "none" else int(threads)
+    )
+    threads = max(1, min(threads, len(patients)))
+    logger.debug(f"Preprocessing {len(patients)} cases with {threads} process(es)")
+
+    # the training reads all cases from one packed array
+    packed_data = None
+    packed_file = None
+    if "inference" not in os.environ["WORKFLOW_NAME"] and len(patients) > 0:
+        packed_data = create_packed_dataset(
+            patients, ast.literal_eval(os.environ["PATCH_SIZE"])
+        )
+        packed_file = packed_data.filename
+
+    tasks = [
+        (patient, patient_index, packed_file)
+        for patient_index, patient in enumerate(patients)
+    ]
+    if threads == 1:
+        results = [preprocess_case(*task) for task in tasks]
+    else:
+        with multiprocessing.get_context("spawn").Pool(threads) as pool:
+            results = pool.starmap(preprocess_case, tasks)
+
+    cached_count = sum(cached for _, cached in results)
+    logger.debug(
+        f"{len(results) - cached_count} cases preprocessed, {cached_count} from cache"
+    )
 
-        #Log
-        logger.debug(f"{patient} was preprocessed")
-        
+    if packed_data is not None:
+        finish_packed_dataset(packed_data, patients)
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import json
 import os
 import random
 import numpy as np
@@ -22,6 +23,7 @@ from batchgenerators.transforms.spatial_transforms import (
     SpatialTransform,
 )
 
+
 def configure_rotation_and_mirroring(patch_size):
     dim = len(patch_size)
 
@@ -52,6 +54,30 @@ def configure_rotation_and_mirroring(patch_size):
     return rotation_for_DA, mirror_axes
 
 
+def get_label_matrix(uids, uid_to_tag_mapping, num_classes):
+    """
+    Labels of all uids (len(uids), num_classes): the class for binary tasks,
+    the combined one-hot encoding of all tags otherwise.
+    """
+    labels = np.zeros((len(uids), num_classes), dtype="int16")
+    for i, uid in enumerate(uids):
+        if os.environ["TASK"] == "binary":
+            labels[i] = np.array(uid_to_tag_mapping[uid])
+        else:
+            labels[i, np.array(uid_to_tag_mapping[uid])] = 1
+    return labels
+
+
+def get_packed_dataset_dir():
+    return os.path.join("/", os.environ["WORKFLOW_DIR"], os.environ["OPERATOR_IN_DIR"])
+
+
+def has_packed_dataset(packed_dir=None):
+    # the index is written by the preprocessing when all cases are packed
+    packed_dir = packed_dir or get_packed_dataset_dir()
+    return os.path.isfile(os.path.join(packed_dir, "packed_index.json"))
+
+
 class ClassificationDataset(DataLoader):
     def __init__(
         self,
@@ -89,6 +115,10 @@ class ClassificationDataset(DataLoader):
             if uid not in self.uid_to_tag_mapping:
                 raise ValueError(f"UID {uid} not found in tag mapping")
 
+        self.labels = get_label_matrix(
+            self._data, self.uid_to_tag_mapping, self.num_classes
+        )
+
     def __len__(self):
         return len(self._data)
 
@@ -100,7 +130,7 @@ class ClassificationDataset(DataLoader):
         data = np.zeros(
             (self.batch_size, self.num_modalities, *self.patch_size), dtype=np.float32
         )
-        seg = np.zeros((self.batch_size, self.num_classes), dtype="int16")
+        seg = self.labels[idx]
 
         for i, j in enumerate(patients_for_batch):
             input_image_path = os.path.join(
@@ -110,19 +140,6 @@ class ClassificationDataset(DataLoader):
                 j + ".npy",
             )
             input_image = np.load(input_image_path, mmap_mode="r")
-
-            if os.environ["TASK"] == "binary":
-                seg[i] = np.array(self.uid_to_tag_mapping[j])
-            else:
-                # Convert to one-hot encoding
-                one_hot_np = np.eye(self.num_classes)[
-                    np.array(self.uid_to_tag_mapping[j])
-                ]
-
-                # Apply logical OR operation along the first dimension
-                combined_one_hot = one_hot_np.any(axis=0).astype(int)
-                seg[i] = combined_one_hot
-
             data[i] = input_image
 
         return {"data": data, "class": seg, "sample": j}
@@ -223,3 +240,54 @@ class ClassificationDataset(DataLoader):
         )
 
         return train_samples, val_samples
+
+
+class PackedClassificationDataset(ClassificationDataset):
+    """
+    Reads the batches from the packed dataset of the preprocessing (all cases in one
+    array packed_data.npy, row index in packed_index.json) instead of one file per case.
+    """
+
+    def __init__(
+        self,
+        data,
+        batch_size,
+        patch_size,
+        num_threads_in_multithreaded,
+        packed_dir=None,
+        **kwargs,
+    ):
+        super().__init__(
+            data, batch_size, patch_size, num_threads_in_multithreaded, **kwargs
+        )
+
+        self.packed_dir = packed_dir or get_packed_dataset_dir()
+        with open(os.path.join(self.packed_dir, "packed_index.json"), "r") as f:
+            packed_index = json.load(f)
+        rows = {uid: row for row, uid in enumerate(packed_index["uids"])}
+        for uid in self._data:
+            if uid not in rows:
+                raise ValueError(
+                    f"UID {uid} not found in packed dataset {self.packed_dir}"
+                )
+        self.rows = np.array([rows[uid] for uid in self._data], dtype=np.int64)
+
+        # opened in the process that generates the batches
+        self.packed_data = None
+
+    def generate_train_batch(self):
+        if self.packed_data is None:
+            self.packed_data = np.load(
+                os.path.join(self.packed_dir, "packed_data.npy"), mmap_mode="r"
+            )
+
+        # ascending rows -> sequential reads of the memory map
+        idx = np.array(self.get_indices())
+        idx = idx[np.argsort(self.rows[idx], kind="stable")]
+
+        data = np.asarray(
+            self.packed_data[self.rows[idx], : self.num_modalities], dtype=np.float32
+        )
+        seg = self.labels[idx]
+
+        return {"data": data, "class": seg, "sample": self._data[idx[-1]]}
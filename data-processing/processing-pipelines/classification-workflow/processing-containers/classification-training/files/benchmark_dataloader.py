@@ -0,0 +1,119 @@
+"""
+Loader throughput of ClassificationDataset (one .npy file per case) vs.
+PackedClassificationDataset (all cases in one memory-mapped array) on synthetic cases
+in the layout of the classification-preprocessing.
+
+Usage: python3 benchmark_dataloader.py [--cases 500] [--patch-size 64,64,64] [--batch-size 16] [--batches 200] [--workers 4] [--dir <tmp dir>]
+
+--dir can point to a network file system (e.g. NFS) to include the file open latency.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+from os.path import join
+from time import time
+
+import numpy as np
+from batchgenerators.dataloading.multi_threaded_augmenter import MultiThreadedAugmenter
+from batchgenerators_dataloader import (
+    ClassificationDataset,
+    PackedClassificationDataset,
+)
+
+operator_in_dir = "classification-preprocessing"
+
+
+def create_dataset(target_dir, case_count, patch_size, num_classes):
+    batches_input_dir = join(target_dir, "batch")
+    packed_dir = join(target_dir, operator_in_dir)
+    os.makedirs(packed_dir)
+    uids = [f"case-{index:05d}" for index in range(case_count)]
+    packed_data = np.lib.format.open_memmap(
+        join(packed_dir, "packed_data.npy"),
+        mode="w+",
+        dtype=np.float32,
+        shape=(case_count, 1, *patch_size),
+    )
+    rng = np.random.default_rng(0)
+    uid_to_tag_mapping = {}
+    for index, uid in enumerate(uids):
+        data = rng.standard_normal(patch_size)
+        case_dir = join(batches_input_dir, uid, operator_in_dir)
+        os.makedirs(case_dir)
+        np.save(join(case_dir, f"{uid}.npy"), data)
+        packed_data[index, 0] = data
+        uid_to_tag_mapping[uid] = [index % num_classes]
+    packed_data.flush()
+    with open(join(packed_dir, "packed_index.json"), "w") as f:
+        json.dump({"uids": uids, "shape": list(packed_data.shape)}, f)
+    return batches_input_dir, uids, uid_to_tag_mapping
+
+
+def run(name, data_loader, batch_count, workers):
+    if workers > 0:
+        data_loader = MultiThreadedAugmenter(
+            data_loader=data_loader,
+            transform=None,
+            num_processes=workers,
+            num_cached_per_queue=4,
+        )
+    start_time = time()
+    case_count = 0
+    # epochs until batch_count batches are loaded (StopIteration at the end of each epoch)
+    while batch_count > 0:
+        for batch in data_loader:
+            case_count += batch["data"].shape[0]
+            batch_count -= 1
+            if batch_count == 0:
+                break
+    duration = time() - start_time
+    if workers > 0:
+        data_loader._finish()
+    print(f"{name:<8} {case_count / duration:9.1f} cases/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=int, default=500)
+    parser.add_argument("--patch-size", type=str, default="64,64,64")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--batches", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--classes", type=int, default=3)
+    parser.add_argument("--dir", type=str, default=None)
+    args = parser.parse_args()
+    patch_size = tuple(int(x) for x in args.patch_size.split(","))
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        batches_input_dir, uids, uid_to_tag_mapping = create_dataset(
+            tmp_dir, args.cases, patch_size, args.classes
+        )
+        os.environ["BATCHES_INPUT_DIR"] = batches_input_dir
+        os.environ["WORKFLOW_DIR"] = tmp_dir
+        os.environ["OPERATOR_IN_DIR"] = operator_in_dir
+        os.environ["TASK"] = "multiclass"
+        print(
+            f"Cases: {args.cases}, patch size: {patch_size}, "
+            f"batch size: {args.batch_size}, workers: {args.workers}"
+        )
+
+        kwargs = dict(
+            data=uids,
+            batch_size=args.batch_size,
+            patch_size=patch_size,
+            num_threads_in_multithreaded=max(args.workers, 1),
+            uid_to_tag_mapping=uid_to_tag_mapping,
+            num_classes=args.classes,
+        )
+        # same batches from both loaders
+        batch = ClassificationDataset(**kwargs, shuffle=False).generate_train_batch()
+        packed_batch = PackedClassificationDataset(
+            **kwargs, shuffle=False
+        ).generate_train_batch()
+        assert np.array_equal(batch["data"], packed_batch["data"])
+        assert np.array_equal(batch["class"], packed_batch["class"])
+
+        run("files", ClassificationDataset(**kwargs), args.batches, args.workers)
+        run("packed", PackedClassificationDataset(**kwargs), args.batches, args.workers)
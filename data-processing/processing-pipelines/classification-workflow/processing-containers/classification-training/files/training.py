@@ -12,7 +12,11 @@ from batchgenerators.transforms.abstract_transforms import Compose
 from batchgenerators.transforms.sample_normalization_transforms import (
     ZeroMeanUnitVarianceTransform,
 )
-from batchgenerators_dataloader import ClassificationDataset
+from batchgenerators_dataloader import (
+    ClassificationDataset,
+    PackedClassificationDataset,
+    has_packed_dataset,
+)
 from monai.networks.nets import resnet18
 from opensearch_helper import OpenSearchHelper
 from torch.utils.tensorboard import SummaryWriter
@@ -250,7 +254,14 @@ if __name__ == "__main__":
 
     transform = ClassificationDataset.get_train_transform(patch_size)
 
-    dl_train = ClassificationDataset(
+    # one memory-mapped array of the preprocessing instead of one file per case
+    if has_packed_dataset():
+        logger.debug("Load batches from the packed dataset")
+        Dataset = PackedClassificationDataset
+    else:
+        Dataset = ClassificationDataset
+
+    dl_train = Dataset(
         data=train_samples,
         batch_size=int(os.environ["BATCH_SIZE"]),
         patch_size=patch_size,
@@ -271,7 +282,7 @@ if __name__ == "__main__":
         pin_memory=True,
     )
 
-    dl_val = ClassificationDataset(
+    dl_val = Dataset(
         data=val_samples,
         batch_size=int(os.environ["BATCH_SIZE"]),
         patch_size=patch_size,
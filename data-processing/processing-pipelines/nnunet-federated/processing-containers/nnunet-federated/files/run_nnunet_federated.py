@@ -443,31 +443,26 @@ class nnUNetFederatedTraining(KaapanaFederatedTrainingBase):
             print(psutil.Process(os.getpid()).memory_info().rss / 1024**2)
 
             ### FL Aggregation during training ###
-            # load model_weights
-            site_model_weights_dict = self.load_model_weights(
-                current_federated_round_dir
-            )
             # process model_weights according to aggregation method
-            if self.aggregation_strategy == "fedavg":
-                # FedAvg
-                processed_site_model_weights_dict = self.fed_avg(
-                    site_model_weights_dict
-                )
-            elif self.aggregation_strategy == "feddc":
-                if federated_round == -1:
-                    # average in fl_round=-1 to initialize everywhere w/ same model
-                    processed_site_model_weights_dict = self.fed_avg(
-                        site_model_weights_dict
-                    )
-                else:
-                    # FedDC
-                    processed_site_model_weights_dict = self.fed_dc(
-                        site_model_weights_dict, federated_round
-                    )
-            else:
+            if self.aggregation_strategy not in ["fedavg", "feddc"]:
                 raise ValueError(
                     "No Federated Learning method is given. Choose between 'fedavg', 'feddc'."
                 )
+            if self.is_fed_avg_round(federated_round):
+                # FedAvg (FedDC: in fl_round=-1 and aggregation rounds)
+                # sites are added to the running sum as soon as they are downloaded
+                processed_site_model_weights_dict = self.fed_avg_streaming(
+                    current_federated_round_dir
+                )
+            else:
+                # FedDC
+                # load model_weights
+                site_model_weights_dict = self.load_model_weights(
+                    current_federated_round_dir
+                )
+                processed_site_model_weights_dict = self.fed_dc(
+                    site_model_weights_dict, federated_round
+                )
             # save model_weights to server's minio
             fname = self.save_model_weights(
                 current_federated_round_dir, processed_site_model_weights_dict
@@ -495,6 +490,11 @@ class nnUNetFederatedTraining(KaapanaFederatedTrainingBase):
                     dst=os.path.join(dst, "dataset.json"),
                 )  # A little bit ugly... but necessary for Bin2Dcm operator
 
+    def on_site_downloaded(self, federated_round, instance_name, site_dir):
+        # FedAvg: add the site's model_weights while the other sites are downloaded
+        if federated_round != -2 and self.is_fed_avg_round(federated_round):
+            self.add_site_to_fed_avg(instance_name, site_dir)
+
     @timeit
     def on_wait_for_jobs_end(self, federated_round):
         if federated_round == -2:
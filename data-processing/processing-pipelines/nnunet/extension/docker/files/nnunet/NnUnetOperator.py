@@ -5,6 +5,7 @@ from kaapana.operators.KaapanaBaseOperator import KaapanaBaseOperator
 from kaapana.blueprints.kaapana_global_variables import (
     DEFAULT_REGISTRY,
     KAAPANA_BUILD_VERSION,
+    GPU_SUPPORT,
 )
 from datetime import timedelta
 
@@ -42,8 +43,9 @@ class NnUnetOperator(KaapanaBaseOperator):
         mixed_precision=True,
         test_time_augmentation=False,
         inf_batch_dataset=False,
-        inf_threads_prep=1,
-        inf_threads_nifti=1,
+        inf_threads_prep=None,  # None -> sized to the available cores
+        inf_threads_nifti=None,
+        inf_device="auto",  # auto (GPU if the platform has GPU support), cuda or cpu
         inf_softmax=False,
         inf_seg_filter=None,
         inf_remove_if_empty=True,
@@ -94,6 +96,7 @@ class NnUnetOperator(KaapanaBaseOperator):
             "MIXED_PRECISION": str(mixed_precision),
             "INF_THREADS_PREP": str(inf_threads_prep),
             "INF_THREADS_NIFTI": str(inf_threads_nifti),
+            "INF_DEVICE": str(inf_device),
             "INF_BATCH_DATASET": str(inf_batch_dataset),
             "INF_SOFTMAX": str(inf_softmax),
             "INF_SEG_FILTER": str(inf_seg_filter),
@@ -107,7 +110,10 @@ class NnUnetOperator(KaapanaBaseOperator):
         if mode == "training" or mode == "inference" or mode == "ensemble":
             if mode == "training":
                 gpu_mem_mb = 11000
-            elif mode == "inference" or mode == "ensemble":
+            elif (mode == "inference" or mode == "ensemble") and (
+                inf_device == "cuda" or (inf_device == "auto" and GPU_SUPPORT)
+            ):
+                # auto without GPU support -> no GPU request, the prediction runs on the CPU
                 gpu_mem_mb = 5500
 
         parallel_id = parallel_id if parallel_id is not None else mode
@@ -0,0 +1,106 @@
+"""
+Parity check of label_metrics.compute_metrics against the MONAI metrics used before
+on synthetic label maps, incl. labels with an empty prediction, an empty ground truth
+and both empty.
+
+Requires monai and torch (not part of the container).
+
+Usage: python3 check_label_metrics.py [--shape 48 40 32] [--spacing 0.8 1.0 2.5]
+"""
+
+import argparse
+import tempfile
+from os.path import join
+
+import nibabel as nib
+import numpy as np
+import torch
+from label_metrics import LabelMap, compute_metrics
+from monai.metrics import (
+    DiceMetric,
+    compute_average_surface_distance,
+    compute_hausdorff_distance,
+    compute_surface_dice,
+)
+
+max_label_encoding = 5
+
+
+def create_label_maps(shape):
+    gt = np.zeros(shape, dtype=np.uint8)
+    pred = np.zeros(shape, dtype=np.uint8)
+    x, y, z = (s // 8 for s in shape)
+    # label 1: shifted boxes, label 2: the prediction touches the volume border
+    gt[x : 4 * x, y : 4 * y, z : 4 * z] = 1
+    pred[x + 2 : 4 * x + 1, y : 4 * y + 3, z + 1 : 4 * z] = 1
+    gt[5 * x : 7 * x, 5 * y : 7 * y, 5 * z : 7 * z] = 2
+    pred[5 * x :, 5 * y : 7 * y, 4 * z : 7 * z] = 2
+    # label 3: empty prediction, label 4: empty ground truth, label 5: both empty
+    gt[x : 3 * x, 5 * y : 7 * y, z : 3 * z] = 3
+    pred[5 * x : 7 * x, y : 3 * y, z : 3 * z] = 4
+    return pred, gt
+
+
+def to_one_hot(label_map):
+    one_hot = torch.nn.functional.one_hot(
+        torch.from_numpy(label_map.astype(np.int64)), max_label_encoding + 1
+    )
+    return one_hot.permute(3, 0, 1, 2).unsqueeze(0)
+
+
+def compute_monai_metrics(pred, gt, include_background, spacing):
+    y_pred = to_one_hot(pred)
+    y = to_one_hot(gt)
+    class_count = max_label_encoding + (1 if include_background else 0)
+    return {
+        "dice_scores": DiceMetric(include_background=include_background)(
+            y_pred, y
+        ).numpy()[0],
+        "asd_scores": compute_average_surface_distance(
+            y_pred=y_pred, y=y, include_background=include_background
+        ).numpy()[0],
+        "hd_scores": compute_hausdorff_distance(
+            y_pred=y_pred, y=y, include_background=include_background
+        ).numpy()[0],
+        "sd_scores": compute_surface_dice(
+            y_pred=y_pred,
+            y=y,
+            class_thresholds=[1.0] * class_count,
+            include_background=include_background,
+            spacing=list(spacing),
+        ).numpy()[0],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shape", type=int, nargs=3, default=[48, 40, 32])
+    parser.add_argument("--spacing", type=float, nargs=3, default=[0.8, 1.0, 2.5])
+    args = parser.parse_args()
+
+    pred, gt = create_label_maps(tuple(args.shape))
+    affine = np.diag(args.spacing + [1.0])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        nib.Nifti1Image(pred, affine).to_filename(join(tmp_dir, "pred.nii.gz"))
+        nib.Nifti1Image(gt, affine).to_filename(join(tmp_dir, "gt.nii.gz"))
+        pred_map = LabelMap(join(tmp_dir, "pred.nii.gz"), max_label_encoding)
+        gt_map = LabelMap(join(tmp_dir, "gt.nii.gz"), max_label_encoding)
+
+    for include_background in (False, True):
+        metrics = compute_metrics(
+            pred_map=pred_map,
+            gt_map=gt_map,
+            include_background=include_background,
+            spacing=gt_map.spacing,
+        )
+        monai_metrics = compute_monai_metrics(
+            pred, gt, include_background, gt_map.spacing
+        )
+        for metric_key, monai_scores in monai_metrics.items():
+            print(f"{metric_key:<12} background={include_background!s:<5}")
+            print(f"  label_metrics: {metrics[metric_key]}")
+            print(f"  monai:         {np.float32(monai_scores)}")
+            np.testing.assert_allclose(
+                metrics[metric_key], monai_scores, rtol=1e-5, equal_nan=True
+            )
+    print("label_metrics matches MONAI")
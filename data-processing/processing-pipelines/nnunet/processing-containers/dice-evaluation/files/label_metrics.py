@@ -0,0 +1,179 @@
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+# Voxels per bincount call -> bounds the int64 temporaries of the confusion matrix
+confusion_chunk_size = 2**24
+
+
+def get_label_dtype(max_label_int):
+    if max_label_int <= np.iinfo(np.uint8).max:
+        return np.uint8
+    elif max_label_int <= np.iinfo(np.uint16).max:
+        return np.uint16
+    return np.uint32
+
+
+class LabelMap:
+    """
+    Multi-label segmentation loaded in the smallest unsigned dtype.
+
+    Encodings outside of [0, max_label_encoding] are mapped to max_label_encoding + 1
+    and do not belong to any class (same as the previous one-hot encoding).
+    Surface voxels and search trees are extracted per label from the label's bounding
+    box and cached, so a ground truth can be shared between all evaluated predictions.
+    """
+
+    def __init__(self, nifti_path, max_label_encoding):
+        nifti_loaded = nib.load(nifti_path)
+        self.spacing = tuple(float(x) for x in nifti_loaded.header.get_zooms()[:3])
+        self.max_label_encoding = max_label_encoding
+        self.invalid_label = max_label_encoding + 1
+
+        # dataobj keeps the on-disk dtype instead of float64
+        label_map = np.asanyarray(nifti_loaded.dataobj)
+        if not np.issubdtype(label_map.dtype, np.integer):
+            # same truncation as the previous get_fdata().astype(int)
+            label_map = label_map.astype(np.int32)
+        invalid = (label_map < 0) | (label_map > max_label_encoding)
+        self.label_map = label_map.astype(get_label_dtype(self.invalid_label))
+        self.label_map[invalid] = self.invalid_label
+
+        self.shape = self.label_map.shape
+        self.bboxes = ndimage.find_objects(self.label_map, max_label=max_label_encoding)
+        self.edges = {}
+        self.trees = {}
+
+    def get_bbox(self, label_int):
+        if label_int == 0:
+            # background is not covered by find_objects
+            return tuple(slice(0, x) for x in self.shape)
+        return self.bboxes[label_int - 1]
+
+    def get_edges(self, label_int):
+        """
+        Returns the voxel coordinates of the label's surface (mask ^ eroded mask).
+        """
+        if label_int not in self.edges:
+            bbox = self.get_bbox(label_int)
+            if bbox is None:
+                self.edges[label_int] = np.zeros((0, len(self.shape)), dtype=np.int64)
+            else:
+                # zero margin of 1 -> voxels at the volume border are surface voxels
+                mask = np.pad(self.label_map[bbox] == label_int, 1)
+                edges = mask ^ ndimage.binary_erosion(mask)
+                offset = np.array([x.start for x in bbox]) - 1
+                self.edges[label_int] = np.argwhere(edges) + offset
+        return self.edges[label_int]
+
+    def get_tree(self, label_int, spacing=None):
+        key = (label_int, spacing)
+        if key not in self.trees:
+            self.trees[key] = cKDTree(
+                scale_coordinates(self.get_edges(label_int), spacing)
+            )
+        return self.trees[key]
+
+
+def scale_coordinates(coordinates, spacing):
+    if spacing is None:
+        return coordinates
+    return coordinates * np.asarray(spacing, dtype=np.float64)
+
+
+def get_surface_distances(from_map, to_map, label_int, spacing=None):
+    """
+    Distances from every surface voxel of from_map to the closest surface voxel of
+    to_map (inf if to_map has no surface, empty if from_map has no surface).
+    """
+    from_edges = from_map.get_edges(label_int)
+    if len(from_edges) == 0:
+        return np.zeros(0)
+    if len(to_map.get_edges(label_int)) == 0:
+        return np.full(len(from_edges), np.inf)
+    distances, _ = to_map.get_tree(label_int, spacing).query(
+        scale_coordinates(from_edges, spacing)
+    )
+    return distances
+
+
+def get_confusion_matrix(pred_map, gt_map):
+    """
+    Returns the (gt, pred) confusion matrix over all encodings incl. the invalid one.
+    """
+    assert pred_map.shape == gt_map.shape
+    bins = gt_map.invalid_label + 1
+    # both label maps come from nibabel -> ravel in F-order returns views
+    gt_flat = gt_map.label_map.ravel(order="F")
+    pred_flat = pred_map.label_map.ravel(order="F")
+    confusion_matrix = np.zeros(bins * bins, dtype=np.int64)
+    for start in range(0, gt_flat.size, confusion_chunk_size):
+        end = start + confusion_chunk_size
+        confusion_matrix += np.bincount(
+            gt_flat[start:end].astype(np.int64) * bins + pred_flat[start:end],
+            minlength=bins * bins,
+        )
+    return confusion_matrix.reshape(bins, bins)
+
+
+def compute_metrics(pred_map, gt_map, include_background, spacing, class_threshold=1.0):
+    """
+    Computes the metrics per class with the semantics of the MONAI metrics used before:
+
+    * dice_scores: DiceMetric (nan if the ground truth is empty)
+    * asd_scores: compute_average_surface_distance (voxel units, pred -> gt)
+    * hd_scores: compute_hausdorff_distance (voxel units, symmetric)
+    * sd_scores: compute_surface_dice (normalized surface distance, spacing in mm)
+    * nave_scores: normalized average volume error
+    """
+    labels = list(range(0 if include_background else 1, gt_map.max_label_encoding + 1))
+
+    confusion_matrix = get_confusion_matrix(pred_map=pred_map, gt_map=gt_map)
+    intersection = np.diag(confusion_matrix)[labels].astype(np.float64)
+    vox_gt = confusion_matrix.sum(axis=1)[labels].astype(np.float64)
+    vox_pred = confusion_matrix.sum(axis=0)[labels].astype(np.float64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dice_scores = np.where(
+            vox_gt > 0, 2.0 * intersection / (vox_gt + vox_pred), np.nan
+        )
+        nave_scores = np.abs(vox_pred - vox_gt) / vox_gt
+
+    asd_scores = np.full(len(labels), np.nan)
+    hd_scores = np.full(len(labels), np.nan)
+    sd_scores = np.full(len(labels), np.nan)
+    for index, label_int in enumerate(labels):
+        if vox_gt[index] == 0 and vox_pred[index] == 0:
+            continue
+
+        distances_pred_gt = get_surface_distances(pred_map, gt_map, label_int)
+        distances_gt_pred = get_surface_distances(gt_map, pred_map, label_int)
+        if len(distances_pred_gt) > 0:
+            asd_scores[index] = distances_pred_gt.mean()
+        else:
+            # empty prediction: MONAI measures inf from every gt surface voxel
+            asd_scores[index] = np.inf
+        # exactly one empty surface -> the other direction is all inf (as in MONAI)
+        hd_scores[index] = np.concatenate([distances_pred_gt, distances_gt_pred]).max()
+
+        distances_pred_gt = get_surface_distances(
+            pred_map, gt_map, label_int, spacing=spacing
+        )
+        distances_gt_pred = get_surface_distances(
+            gt_map, pred_map, label_int, spacing=spacing
+        )
+        boundary_complete = len(distances_pred_gt) + len(distances_gt_pred)
+        if boundary_complete > 0:
+            boundary_correct = np.count_nonzero(
+                distances_pred_gt <= class_threshold
+            ) + np.count_nonzero(distances_gt_pred <= class_threshold)
+            sd_scores[index] = boundary_correct / boundary_complete
+
+    return {
+        "dice_scores": np.float32(dice_scores),
+        "asd_scores": np.float32(asd_scores),
+        "hd_scores": np.float32(hd_scores),
+        "sd_scores": np.float32(sd_scores),
+        "nave_scores": np.float32(nave_scores),
+    }
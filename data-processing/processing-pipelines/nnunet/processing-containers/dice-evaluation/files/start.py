@@ -4,19 +4,10 @@ from os import getenv
 from os.path import join, exists, dirname, basename
 from glob import glob
 from pathlib import Path
-from multiprocessing.pool import ThreadPool
+from multiprocessing import Pool
 from pathlib import Path
-import numpy as np
-import nibabel as nib
-import torch
 import pandas as pd
-from monai.metrics import (
-    # compute_meandice,
-    DiceMetric,
-    compute_average_surface_distance,
-    compute_hausdorff_distance,
-    compute_surface_dice,
-)
+from label_metrics import LabelMap, compute_metrics
 from pprint import pprint
 import seaborn as sns
 import matplotlib.pyplot as plt
@@ -174,98 +165,24 @@ def check_prediction_info(seg_info):
     return True
 
 
-def compute_normalized_average_volume_error(y_pred, y, include_background):
-    """
-    This function computes the normalized average volume error between a predicted mask (y_pred) and a gt mask (y).
-    (source: "Rapid artificial intelligence solutions in a pandemic—The COVID-19-20 Lung CT Lesion Segmentation Challenge", H. R. Roth et al.)
-
-    Formula:
-    V_error = (abs(V_pred - V_gt)) / (V_gt)
-    = (abs((voxels_pred * V_voxel) - (voxels_gt * V_voxel))) / (voxels_gt * V_voxel)
-    = (abs(voxels_pred - voxels_gt)) / voxels_gt
-
-    Inputs:
-    * y_pred: predicted segmentation mask
-    * y: ground-truth segmentation mask
-    * include_background: Boolean indicating incorporation of background mask
+def evaluate_prediction(pred_file, gt_map):
     """
-    # get voxels per class dependent in incorporation of background class
-    if include_background:
-        vox_pred = torch.sum(y_pred != 0, dim=(0, 2, 3, 4))
-        vox_gt = torch.sum(y != 0, dim=(0, 2, 3, 4))
-    elif not include_background:
-        vox_pred = torch.sum(y_pred[:, 1:] != 0, dim=(0, 2, 3, 4))
-        vox_gt = torch.sum(y[:, 1:] != 0, dim=(0, 2, 3, 4))
-
-    # compute volume errors
-    volume_errors = (abs(vox_pred - vox_gt)) / vox_gt
-    return volume_errors
-
+    This function computes all metrics between a prediction mask and the ground-truth mask.
 
-def compute_metric(metric_key, y_pred, y, include_background, voxel_spacings=None):
-    """
-    This function serves to compute a given metric between a prediction mask (y_pred) and a ground-truth mask (y).
-
-    Inputs:
-    * metric: computed metric, e.g. "mean_dice", "average_surface_distance", "hausdorff_distance", "surface_dice", "nave"
-    * y_pred: evaluated prediction mask
-    * y: ground-truth mask
-    * include_background: boolean indicating inclusion of background class into metric computation.
+    Input:
+    * pred_file: NIFTI prediction mask.
+    * gt_map: LabelMap of the ground-truth mask (shared between all predictions of a case).
 
     Output:
-    * metrics: computed metrics
+    * metrics: dict with the computed per-class metrics
     """
-
-    if metric_key == "mean_dice":
-        # dice_scores = compute_meandice(
-        #     y_pred=y_pred, y=y, include_background=include_background
-        # ).numpy()[0]
-        dice_scores = DiceMetric(include_background=include_background)(
-            y_pred, y
-        ).numpy()[0]
-        return dice_scores
-    elif metric_key == "average_surface_distance":
-        asd_scores = compute_average_surface_distance(
-            y_pred=y_pred, y=y, include_background=include_background
-        ).numpy()[0]
-        return asd_scores
-    elif metric_key == "hausdorff_distance":
-        hd_scores = compute_hausdorff_distance(
-            y_pred=y_pred, y=y, include_background=include_background
-        ).numpy()[0]
-        return hd_scores
-    elif metric_key == "surface_dice":
-        # computes (normalized) surface dice (source: https://docs.monai.io/en/stable/metrics.html#surface-dice)
-        # normalized surface dice and normalized surface distance are synonyms (source: "Metrics Reloaded: Recommendations for image analysis validation", L. Maier-Hein et al.)
-        sd_scores = compute_surface_dice(
-            y_pred=y_pred,
-            y=y,
-            class_thresholds=[1.0 for i in range(0, (y.shape[1] - 1))],
-            include_background=include_background,
-            spacing=[float(f) for f in voxel_spacings],
-        ).numpy()[0]
-        return sd_scores
-    elif metric_key == "nave":
-        nave_scores = compute_normalized_average_volume_error(
-            y_pred=y_pred, y=y, include_background=include_background
-        ).numpy()
-        return nave_scores
-
-    else:
-        print("#")
-        print("##################################################")
-        print("#")
-        print("##################  ERROR  #######################")
-        print("#")
-        print("# ----> Given metric not implementated!")
-        print(f"# Given metric: {metric_key}")
-        print(
-            "# Implemented metrics: mean_dice, average_surface_distance, hausdorff_distance, surface_dice, nave"
-        )
-        print("#")
-        print("##################################################")
-        print("#")
-        exit(1)
+    pred_map = LabelMap(pred_file, max_label_encoding=max_label_encoding)
+    return compute_metrics(
+        pred_map=pred_map,
+        gt_map=gt_map,
+        include_background=include_background,
+        spacing=gt_map.spacing,
+    )
 
 
 def get_metric_score(input_data):
@@ -274,21 +191,8 @@ def get_metric_score(input_data):
 
     results = {}
 
-    # load gt from nifti file to one-hot encoded torch tensor
-    ground_trouth = nib.load(gt_file)
-    ground_trouth_array = ground_trouth.get_fdata().astype(int)
-    one_hot_encoding_gt = (
-        (np.arange(max_label_encoding + 1) == ground_trouth_array[..., None])
-        .astype(int)
-        .transpose()
-    )
-    one_hot_encoding_gt = np.expand_dims(one_hot_encoding_gt, axis=0)
-    gt_tensor = torch.from_numpy(one_hot_encoding_gt)
-    # get voxel spacing of ground truth mask
-    gt_vox_spacings = ground_trouth.header.get_zooms()
-    ground_trouth = None
-    ground_trouth_array = None
-    one_hot_encoding_gt = None
+    # load gt once -> label map, surfaces and search trees are shared by all predictions
+    gt_map = LabelMap(gt_file, max_label_encoding=max_label_encoding)
 
     # iterate over present single_model_pred_files
     for model_pred_file in single_model_pred_files:
@@ -305,72 +209,13 @@ def get_metric_score(input_data):
         assert model_id not in results
         results[model_id] = {}
 
-        # load current model_pred mask from nifti file to one-hot encoded torch tensor
-        single_model_prediction = nib.load(model_pred_file).get_fdata().astype(int)
-        one_hot_encoding_pred = (
-            (np.arange(max_label_encoding + 1) == single_model_prediction[..., None])
-            .astype(int)
-            .transpose()
-        )
-        one_hot_encoding_pred = np.expand_dims(one_hot_encoding_pred, axis=0)
-        single_model_prediction = None
-        pred_tensor = torch.from_numpy(one_hot_encoding_pred)
-        one_hot_encoding_pred = None
-
         ### COMPUTE METRICS ###
-        # mean dice
-        dice_scores = compute_metric(
-            metric_key="mean_dice",
-            y_pred=pred_tensor,
-            y=gt_tensor,
-            include_background=include_background,
-        )
-        # avg surface distance
-        asd_scores = compute_metric(
-            metric_key="average_surface_distance",
-            y_pred=pred_tensor,
-            y=gt_tensor,
-            include_background=include_background,
-        )
-        # hausdorff distance
-        hd_scores = compute_metric(
-            metric_key="hausdorff_distance",
-            y_pred=pred_tensor,
-            y=gt_tensor,
-            include_background=include_background,
-        )
-        # surface dice
-        sd_scores = compute_metric(
-            metric_key="surface_dice",
-            y_pred=pred_tensor,
-            y=gt_tensor,
-            include_background=include_background,
-            voxel_spacings=gt_vox_spacings,
-        )
-        # normalized average volume error
-        nave_scores = compute_metric(
-            metric_key="nave",
-            y_pred=pred_tensor,
-            y=gt_tensor,
-            include_background=include_background,
-        )
+        metrics = evaluate_prediction(pred_file=model_pred_file, gt_map=gt_map)
 
         # report computed metrics and save
-        pred_tensor = None
-        print(f"# {model_pred_file} -> dice_scores: {list(dice_scores)}")
-        print(f"# {model_pred_file} -> asd_scores: {list(asd_scores)}")
-        print(f"# {model_pred_file} -> hd_scores: {list(hd_scores)}")
-        print(f"# {model_pred_file} -> sd_scores: {list(sd_scores)}")
-        print(f"# {model_pred_file} -> nave_scores: {list(nave_scores)}")
-        results[model_id] = {
-            pred_file_id: {
-                "dice_scores": np.float32(dice_scores),
-                "asd_scores": np.float32(asd_scores),
-                "hd_scores": np.float32(hd_scores),
-                "sd_scores": np.float32(sd_scores),
-                "nave_scores": np.float32(nave_scores),
-            }
-        }
+        for metric_key, scores in metrics.items():
+            print(f"# {model_pred_file} -> {metric_key}: {list(scores)}")
+        results[model_id] = {pred_file_id: metrics}
 
     # for present ensemble_pred_file
     if ensemble_pred_file is not None:
@@ -387,74 +232,15 @@ def get_metric_score(input_data):
 
         assert "ensemble" not in results
 
-        # load current ensemble_pred mask from nifti file to one-hot encoded torch tensor
         ensemble_file_id = basename(ensemble_pred_file).replace(".nii.gz", "")
-        ensemble_prediction = nib.load(ensemble_pred_file).get_fdata().astype(int)
-        one_hot_encoding_ensemble = (
-            (np.arange(max_label_encoding + 1) == ensemble_prediction[..., None])
-            .astype(int)
-            .transpose()
-        )
-        one_hot_encoding_ensemble = np.expand_dims(one_hot_encoding_ensemble, axis=0)
-        ensemble_prediction = None
-        ensemble_tensor = torch.from_numpy(one_hot_encoding_ensemble)
-        one_hot_encoding_ensemble = None
 
         ### COMPUTE METRICS ###
-        # mean dice
-        dice_scores = compute_metric(
-            metric_key="mean_dice",
-            y_pred=ensemble_tensor,
-            y=gt_tensor,
-            include_background=include_background,
-        )
-        # avg surface distance
-        asd_scores = compute_metric(
-            metric_key="average_surface_distance",
-            y_pred=ensemble_tensor,
-            y=gt_tensor,
-            include_background=include_background,
-        )
-        # hausdorff distance
-        hd_scores = compute_metric(
-            metric_key="hausdorff_distance",
-            y_pred=ensemble_tensor,
-            y=gt_tensor,
-            include_background=include_background,
-        )
-        # surface dice
-        sd_scores = compute_metric(
-            metric_key="surface_dice",
-            y_pred=ensemble_tensor,
-            y=gt_tensor,
-            include_background=include_background,
-            voxel_spacings=gt_vox_spacings,
-        )
-        # normalized average volume error
-        nave_scores = compute_metric(
-            metric_key="nave",
-            y_pred=ensemble_tensor,
-            y=gt_tensor,
-            include_background=include_background,
-        )
-
-        pred_tensor = None
+        metrics = evaluate_prediction(pred_file=ensemble_pred_file, gt_map=gt_map)
 
         # report computed metrics and save
-        print(f"# ensemble: {ensemble_pred_file} -> dice_scores: {list(dice_scores)}")
-        print(f"# ensemble: {ensemble_pred_file} -> asd_scores: {list(asd_scores)}")
-        print(f"# ensemble: {ensemble_pred_file} -> hd_scores: {list(hd_scores)}")
-        print(f"# ensemble: {ensemble_pred_file} -> sd_scores: {list(sd_scores)}")
-        print(f"# ensemble: {ensemble_pred_file} -> nave_scores: {list(nave_scores)}")
-        results["ensemble"] = {
-            ensemble_file_id: {
-                "dice_scores": np.float32(dice_scores),
-                "asd_scores": np.float32(asd_scores),
-                "hd_scores": np.float32(hd_scores),
-                "sd_scores": np.float32(sd_scores),
-                "nave_scores": np.float32(nave_scores),
-            }
-        }
+        for metric_key, scores in metrics.items():
+            print(f"# ensemble: {ensemble_pred_file} -> {metric_key}: {list(scores)}")
+        results["ensemble"] = {ensemble_file_id: metrics}
 
     return True, batch_id, results
 
@@ -558,8 +344,9 @@ print(
 )
 print(f"#")
 print(f"#")
-with ThreadPool(parallel_processes) as threadpool:
-    results = threadpool.imap_unordered(get_metric_score, queue_list)
+# cases are evaluated in worker processes (forked -> globals are inherited)
+with Pool(parallel_processes) as pool:
+    results = pool.imap_unordered(get_metric_score, queue_list)
     for success, batch_id, result in results:
         if success:
             processed_count += 1
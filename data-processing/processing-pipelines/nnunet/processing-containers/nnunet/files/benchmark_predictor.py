@@ -0,0 +1,77 @@
+"""
+Per-series latency of the nnU-Net prediction with a fresh predictor per series (cold, previous behaviour)
+vs. a cached predictor (warm).
+
+The input dir has to be in nnU-Net raw format (<case>_0000.nii.gz, ...). Every case is predicted
+as a separate series, like the batch-elements of simple_predict.
+
+Usage: python3 benchmark_predictor.py --model <trained model folder> --input-dir <dir> [--device cpu] [--folds all]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+from glob import glob
+from os.path import basename, join
+from time import time
+
+import simple_predict
+
+
+def split_series(input_dir, target_dir):
+    series_dirs = []
+    case_ids = sorted(
+        set(basename(x).rsplit("_", 1)[0] for x in glob(join(input_dir, "*.nii.gz")))
+    )
+    for case_id in case_ids:
+        series_dir = join(target_dir, case_id)
+        os.makedirs(series_dir)
+        for nifti in glob(join(input_dir, f"{case_id}_*.nii.gz")):
+            os.symlink(os.path.abspath(nifti), join(series_dir, basename(nifti)))
+        series_dirs.append(series_dir)
+    return series_dirs
+
+
+def run(name, series_dirs, output_dir, model, folds, checkpoint_name):
+    durations = []
+    for series_dir in series_dirs:
+        series_output_dir = join(output_dir, name, basename(series_dir))
+        start_time = time()
+        simple_predict.predict(
+            series_dir, series_output_dir, model, folds, checkpoint_name, False
+        )
+        durations.append(time() - start_time)
+    print(
+        f"{name:<6} first {durations[0]:8.2f} s  mean {sum(durations) / len(durations):8.2f} s  total {sum(durations):8.2f} s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--input-dir", required=True)
+    parser.add_argument("--folds", default="all")
+    parser.add_argument("--checkpoint", default="checkpoint_final")
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    folds = args.folds if args.folds == "all" else args.folds.split(",")
+    simple_predict.inf_device = args.device
+    print(f"Device: {args.device}, cores: {simple_predict.available_cores}")
+    print(
+        f"Workers: preprocessing {simple_predict.threads_preprocessing}, export {simple_predict.threads_nifiti}"
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        series_dirs = split_series(args.input_dir, join(tmp_dir, "input"))
+        print(f"Series: {len(series_dirs)}")
+
+        simple_predict.cache_predictors = False
+        run("cold", series_dirs, tmp_dir, args.model, folds, args.checkpoint)
+
+        simple_predict.cache_predictors = True
+        simple_predict.predictors.clear()
+        run("warm", series_dirs, tmp_dir, args.model, folds, args.checkpoint)
+
+        shutil.rmtree(join(tmp_dir, "input"))
@@ -2,7 +2,6 @@ from genericpath import isdir
 import os
 import glob
 import json
-import shutil
 from pathlib import Path
 import random
 import time
@@ -10,6 +9,7 @@ import nibabel as nib
 import numpy as np
 from multiprocessing.pool import ThreadPool
 from os.path import join, exists, dirname, basename, isdir
+from dataset_assembler import DatasetAssembler
 
 """
 Documentation create_dataset.py:
@@ -232,11 +232,7 @@ def prepare_dataset(datset_list, dataset_id):
             target_modality_path = join(
                 images_path, base_file_path.replace(".nii.gz", f"_{i:04}.nii.gz")
             )
-            Path(dirname(target_modality_path)).mkdir(parents=True, exist_ok=True)
-            if copy_target_data:
-                shutil.copy2(modality_nifti, target_modality_path)
-            else:
-                shutil.move(modality_nifti, target_modality_path)
+            dataset_assembler.place(modality_nifti, target_modality_path)
 
         target_seg_path = join(task_dir, labels_set_folder, base_file_path)
 
@@ -253,7 +249,7 @@ def prepare_dataset(datset_list, dataset_id):
         print("# -> start merging")
         assert len(seg_nifti_list) == 1
         seg_nifti = seg_nifti_list[0]
-        Path(dirname(target_seg_path)).mkdir(parents=True, exist_ok=True)
+        label_mapping = {}
 
         meta_info_json_path = glob.glob(
             join(dirname(seg_nifti), "*.json"), recursive=False
@@ -281,12 +277,19 @@ def prepare_dataset(datset_list, dataset_id):
                             elif "TrackingIdentifier" in part:
                                 extracted_label_tag = part["TrackingIdentifier"]
                     assert seg_id is not None and extracted_label_tag is not None
-                    label_names_found[extracted_label_tag] = seg_id
+                    if (
+                        extracted_label_tag in label_names_found
+                        and label_names_found[extracted_label_tag] != seg_id
+                    ):
+                        print(
+                            f"# replacing labels: {extracted_label_tag} -> from {seg_id} -> to {label_names_found[extracted_label_tag]}"
+                        )
+                        label_mapping[seg_id] = label_names_found[extracted_label_tag]
+                    else:
+                        label_names_found[extracted_label_tag] = seg_id
 
-        if copy_target_data:
-            shutil.copy2(seg_nifti, target_seg_path)
-        else:
-            shutil.move(seg_nifti, target_seg_path)
+        # the label file is only rewritten if an encoding has to be replaced
+        dataset_assembler.place(seg_nifti, target_seg_path, label_mapping=label_mapping)
 
         print("# Adding dataset ...")
         template_dataset_json[dataset_id].append(
@@ -456,10 +459,15 @@ train_series = series_list[:train_count]
 test_series = series_list[train_count:]
 
 label_names_found = {}
+dataset_assembler = DatasetAssembler(task_dir=task_dir, copy_data=copy_target_data)
 
 prepare_dataset(datset_list=train_series, dataset_id="training")
 prepare_dataset(datset_list=test_series, dataset_id="test")
 
+dataset_assembler.remove_stale()
+dataset_assembler.save_manifest()
+dataset_assembler.print_summary()
+
 print("#")
 print("# Creating dataset.json ....")
 print("#")
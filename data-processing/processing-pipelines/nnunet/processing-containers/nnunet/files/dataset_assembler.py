@@ -0,0 +1,174 @@
+import fcntl
+import json
+import os
+import shutil
+from os.path import dirname, exists, join, realpath, relpath
+
+import nibabel as nib
+import numpy as np
+
+"""
+Documentation dataset_assembler.py:
+
+Places the files of the nnUNet raw dataset without copying the data if possible.
+
+copy-mode: reflink (copy-on-write clone) -> hardlink -> copy
+move-mode: rename (shutil.move falls back to a copy across filesystems)
+
+Label files are only rewritten if their encodings have to be remapped.
+A manifest in the task-dir records the source of every placed file, so a re-run
+with the same inputs skips all files which are already in place.
+"""
+
+manifest_filename = ".dataset_manifest.json"
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+def reflink(source, target):
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(target)
+            raise
+    shutil.copystat(source, target)
+
+
+def get_stat(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def remap_labels(source, target, label_mapping):
+    nifti = nib.load(source)
+    # dataobj keeps the on-disk dtype instead of float64
+    label_map = np.asanyarray(nifti.dataobj)
+    remapped = label_map.copy()
+    for from_label, to_label in label_mapping.items():
+        remapped[label_map == from_label] = to_label
+    result_nifti = nib.Nifti1Image(remapped, nifti.affine, nifti.header)
+    result_nifti.set_data_dtype(label_map.dtype)
+    result_nifti.to_filename(target)
+
+
+class DatasetAssembler:
+    def __init__(self, task_dir, copy_data):
+        self.task_dir = task_dir
+        self.copy_data = copy_data
+        self.manifest_path = join(task_dir, manifest_filename)
+        self.manifest = {}
+        if exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, "r") as f:
+                    self.manifest = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"# Could not load dataset manifest {self.manifest_path}: {e}")
+                print("# -> placing all files again")
+        self.placed = set()
+        self.method_counts = {}
+        # reflinks are only supported by some filesystems (btrfs, xfs, ...)
+        self.reflink_supported = True
+
+    def is_unchanged(self, source, target, label_mapping):
+        entry = self.manifest.get(relpath(target, self.task_dir))
+        if entry is None or not exists(target):
+            return False
+        if (
+            entry["source"] != realpath(source)
+            or entry["label_mapping"] != label_mapping
+        ):
+            return False
+        if get_stat(target) != entry["target"]:
+            return False
+        if exists(source):
+            return get_stat(source) == entry["source_stat"]
+        # moved files are not present at the source anymore
+        return entry["method"] in ["move", "remap-move"]
+
+    def link_or_copy(self, source, target):
+        if self.reflink_supported:
+            try:
+                reflink(source, target)
+                return "reflink"
+            except OSError:
+                self.reflink_supported = False
+        try:
+            os.link(source, target)
+            return "hardlink"
+        except OSError:
+            shutil.copy2(source, target)
+            return "copy"
+
+    def place(self, source, target, label_mapping=None):
+        """
+        Places source at target. label_mapping ({from_label: to_label}) is only applied
+        if it contains an actual change of an encoding.
+        """
+        if label_mapping is not None:
+            label_mapping = {
+                str(k): int(v) for k, v in label_mapping.items() if int(k) != int(v)
+            }
+            if len(label_mapping) == 0:
+                label_mapping = None
+
+        target_key = relpath(target, self.task_dir)
+        self.placed.add(target_key)
+        if self.is_unchanged(source, target, label_mapping):
+            method = "unchanged"
+            self.method_counts[method] = self.method_counts.get(method, 0) + 1
+            return method
+
+        os.makedirs(dirname(target), exist_ok=True)
+        source_stat = get_stat(source)
+        if exists(target):
+            os.remove(target)
+
+        if label_mapping is not None:
+            remap_labels(source, target, {int(k): v for k, v in label_mapping.items()})
+            if self.copy_data:
+                method = "remap"
+            else:
+                os.remove(source)
+                method = "remap-move"
+        elif self.copy_data:
+            method = self.link_or_copy(source, target)
+        else:
+            shutil.move(source, target)
+            method = "move"
+
+        self.manifest[target_key] = {
+            "source": realpath(source),
+            "source_stat": source_stat,
+            "label_mapping": label_mapping,
+            "method": method,
+            "target": get_stat(target),
+        }
+        self.method_counts[method] = self.method_counts.get(method, 0) + 1
+        return method
+
+    def remove_stale(self):
+        """
+        Removes files of a previous run which are not part of the current dataset.
+        """
+        for target_key in sorted(set(self.manifest.keys()) - self.placed):
+            target = join(self.task_dir, target_key)
+            if exists(target):
+                print(f"# Removing stale dataset file: {target_key}")
+                os.remove(target)
+            del self.manifest[target_key]
+
+    def save_manifest(self):
+        manifest_tmp_path = f"{self.manifest_path}.tmp"
+        with open(manifest_tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=4, sort_keys=True)
+        os.replace(manifest_tmp_path, self.manifest_path)
+
+    def print_summary(self):
+        print("#")
+        print("# Dataset files:")
+        for method, count in sorted(self.method_counts.items()):
+            print(f"# {method:<12} {count}")
+        print("#")
@@ -2,12 +2,10 @@ import os
 import shutil
 import json
 import itertools
-from pathlib import Path
 from os import getenv
 from os.path import basename, join, exists
 from glob import glob
-from nnunetv2.ensembling.ensemble import ensemble_folders
-
+from ensemble_engine import ensemble_combinations
 
 batch_name = getenv("BATCH_NAME", "None")
 batch_name = batch_name if batch_name.lower() != "none" else None
@@ -30,7 +28,6 @@ pred_min_combination = (
 )
 
 override = True
-store_npz = True
 postprocessing_file = None
 
 global_seg_info = []
@@ -130,7 +127,8 @@ def main():
        for each input directory, and updating the global segmentation configuration (`global_seg_info`).
     3. Selects and verifies the most common segmentation configuration across directories for ensemble compatibility.
     4. Constructs model combinations based on the minimum number of required predictions (`pred_min_combination`).
-    5. Evaluates each model combination, merging their predictions into a unified output format.
+    5. Evaluates all model combinations in one pass per case (see ensemble_engine.py) and writes the
+       segmentation of each combination.
     6. After completing all combinations, moves ensemble output files to the final target directory, ensuring
        organized storage with unique filenames.
 
@@ -154,8 +152,6 @@ def main():
         Minimum number of predictions required for a valid ensemble combination.
     - override : bool
         Flag indicating whether to override existing configurations.
-    - store_npz : bool
-        Flag indicating whether to store merged probability outputs as `.npz` files.
     - postprocessing_file : str
         Path to the post-processing configuration file.
     - global_seg_info : list
@@ -179,7 +175,7 @@ def main():
     >>> main()
     """
 
-    global batch_name, workflow_dir, operator_in_dir, operator_out_dir, threads_nifiti, pred_min_combination, override, store_npz, postprocessing_file, global_seg_info
+    global batch_name, workflow_dir, operator_in_dir, operator_out_dir, threads_nifiti, pred_min_combination, override, postprocessing_file, global_seg_info
 
     print("##################################################")
     print("#")
@@ -265,25 +261,30 @@ def main():
             if len(subset) >= pred_min_combination:
                 model_combinations.append(subset)
 
+    combination_output_dirs = []
     for combination_index in range(0, len(model_combinations)):
         model_combination = model_combinations[combination_index]
         combination_output_dir = os.path.join(
             "/", workflow_dir, operator_out_dir, f"combination_{combination_index}"
         )
-        Path(combination_output_dir).mkdir(parents=True, exist_ok=True)
-        print(f"#")
-        print(f"# Evaluating combination: {combination_index}: {model_combination}")
+        combination_output_dirs.append(combination_output_dir)
         print(f"#")
+        print(f"# Combination: {combination_index}: {model_combination}")
         print(f"# combination_output_dir:    {combination_output_dir}")
         print(f"#")
 
-        ensemble_folders(
-            list_of_input_folders=ensemble_dirs,
-            output_folder=combination_output_dir,
-            save_merged_probabilities=store_npz,
-            num_processes=threads_nifiti,
-        )
-        print(f"# COMBINATION {model_combination} DONE #")
+    # extracted probabilities are kept next to (not in) operator_out_dir, which must
+    # only contain the combination dirs
+    ensemble_tmp_dir = join("/", workflow_dir, f"{operator_out_dir}-tmp")
+    os.makedirs(ensemble_tmp_dir, exist_ok=True)
+    ensemble_combinations(
+        ensemble_dirs=ensemble_dirs,
+        model_combinations=model_combinations,
+        combination_output_dirs=combination_output_dirs,
+        num_processes=threads_nifiti,
+        tmp_dir=ensemble_tmp_dir,
+    )
+    shutil.rmtree(ensemble_tmp_dir)
 
     print("#")
     print("##################################################")
@@ -0,0 +1,210 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import zipfile
+from os.path import join
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import (
+    load_json,
+    load_pickle,
+    save_json,
+    subfiles,
+)
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+
+"""
+Documentation ensemble_engine.py:
+
+Ensembles all model combinations of a case in one pass (same results as nnunetv2 ensemble_folders).
+
+- The probabilities of every model are extracted once per case from the npz into an uncompressed
+  npy file and memory-mapped.
+- The probabilities are processed in slabs along the slowest axis. The sum of every combination
+  is derived from the sum of its prefix combination plus one model, so each model slab is read
+  once and every combination costs a single addition. Only the sums of the current chain of
+  prefixes are kept.
+- Only the segmentation (argmax) of each combination is written.
+"""
+
+# number of slices per slab
+slab_size = 16
+copy_buffer_size = 16 * 1024 * 1024
+
+
+def get_case_files(ensemble_dirs):
+    # same check as nnunetv2 ensemble_folders: all folders have to contain the same predictions
+    files_per_folder = [
+        set(subfiles(x, suffix=".npz", join=False)) for x in ensemble_dirs
+    ]
+    case_files = set().union(*files_per_folder)
+    for files in files_per_folder:
+        assert (
+            len(case_files.difference(files)) == 0
+        ), "Not all folders contain the same files for ensembling."
+    return sorted(case_files)
+
+
+def extract_probabilities(npz_path, target_npy_path):
+    """
+    Copies the probabilities array out of the (compressed) npz without decoding it in memory
+    and returns it memory-mapped.
+    """
+    with zipfile.ZipFile(npz_path) as npz_file:
+        with npz_file.open("probabilities.npy") as src, open(
+            target_npy_path, "wb"
+        ) as dst:
+            shutil.copyfileobj(src, dst, copy_buffer_size)
+    return np.load(target_npy_path, mmap_mode="r")
+
+
+def get_slabs(shape, axis):
+    for start in range(0, shape[axis], slab_size):
+        slab = [slice(None)] * len(shape)
+        slab[axis] = slice(start, min(start + slab_size, shape[axis]))
+        yield tuple(slab)
+
+
+def get_combination_sums(slabs, combinations):
+    """
+    Yields (combination index, sum of the slabs of the combination) for all combinations.
+
+    The combinations are visited in lexicographic order, so combinations with the same
+    prefix follow each other: every prefix sum is computed once and only the sums of the
+    current chain of prefixes (at most one per model) are kept.
+    """
+    chain = []
+    previous_combination = ()
+    for combination_index in sorted(
+        range(len(combinations)), key=lambda x: combinations[x]
+    ):
+        combination = combinations[combination_index]
+        common_length = 0
+        while (
+            common_length < min(len(chain), len(combination))
+            and previous_combination[common_length] == combination[common_length]
+        ):
+            common_length += 1
+        del chain[common_length:]
+        for model_index in combination[common_length:]:
+            chain.append(
+                slabs[model_index]
+                if len(chain) == 0
+                else chain[-1] + slabs[model_index]
+            )
+        previous_combination = combination
+        yield combination_index, chain[-1]
+
+
+def ensemble_case(
+    case_file,
+    ensemble_dirs,
+    combinations,
+    combination_output_dirs,
+    file_ending,
+    image_reader_writer,
+    label_manager,
+    tmp_dir,
+):
+    """
+    Writes the segmentation of every combination (tuples of indices into ensemble_dirs) for one case.
+    """
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as case_tmp_dir:
+        probabilities = [
+            extract_probabilities(
+                join(ensemble_dir, case_file), join(case_tmp_dir, f"{index}.npy")
+            )
+            for index, ensemble_dir in enumerate(ensemble_dirs)
+        ]
+        shape = probabilities[0].shape
+        assert all(x.shape == shape for x in probabilities)
+        # slabs along the slowest varying spatial axis
+        axis = len(shape) - 1 if np.isfortran(probabilities[0]) else 1
+
+        # argmax returns int64 -> keep the segmentations of all combinations compact
+        segmentation_dtype = (
+            np.uint8
+            if max(label_manager.all_labels) <= np.iinfo(np.uint8).max
+            else np.uint16
+        )
+        segmentations = [None] * len(combinations)
+        for slab in get_slabs(shape, axis):
+            # maybe increase precision to prevent rounding errors
+            slabs = [
+                np.asarray(probability[slab], dtype=np.float32)
+                for probability in probabilities
+            ]
+            for combination_index, combination_sum in get_combination_sums(
+                slabs, combinations
+            ):
+                average = combination_sum / len(combinations[combination_index])
+                segmentation = label_manager.convert_probabilities_to_segmentation(
+                    average
+                )
+                if segmentations[combination_index] is None:
+                    segmentations[combination_index] = np.zeros(
+                        shape[1:], dtype=segmentation_dtype
+                    )
+                segmentations[combination_index][slab[1:]] = segmentation
+            del slabs
+
+        del probabilities
+
+    for combination_index, combination in enumerate(combinations):
+        # properties of the first model of the combination (same as ensemble_folders)
+        properties = load_pickle(
+            join(ensemble_dirs[combination[0]], case_file[:-4] + ".pkl")
+        )
+        image_reader_writer.write_seg(
+            segmentations[combination_index],
+            join(
+                combination_output_dirs[combination_index], case_file[:-4] + file_ending
+            ),
+            properties,
+        )
+    return case_file
+
+
+def ensemble_combinations(
+    ensemble_dirs, model_combinations, combination_output_dirs, num_processes, tmp_dir
+):
+    """
+    Ensembles all model_combinations (lists of ensemble_dirs) into combination_output_dirs.
+    """
+    dataset_json = load_json(join(ensemble_dirs[0], "dataset.json"))
+    plans_manager = PlansManager(load_json(join(ensemble_dirs[0], "plans.json")))
+    image_reader_writer = plans_manager.image_reader_writer_class()
+    label_manager = plans_manager.get_label_manager(dataset_json)
+
+    combinations = [
+        tuple(ensemble_dirs.index(x) for x in model_combination)
+        for model_combination in model_combinations
+    ]
+    for combination_output_dir in combination_output_dirs:
+        os.makedirs(combination_output_dir, exist_ok=True)
+        save_json(
+            dataset_json, join(combination_output_dir, "dataset.json"), sort_keys=False
+        )
+
+    case_files = get_case_files(ensemble_dirs)
+    print(f"# Ensembling {len(case_files)} cases for {len(combinations)} combinations")
+    with multiprocessing.get_context("spawn").Pool(num_processes) as pool:
+        results = [
+            pool.apply_async(
+                ensemble_case,
+                (
+                    case_file,
+                    ensemble_dirs,
+                    combinations,
+                    combination_output_dirs,
+                    dataset_json["file_ending"],
+                    image_reader_writer,
+                    label_manager,
+                    tmp_dir,
+                ),
+            )
+            for case_file in case_files
+        ]
+        for result in results:
+            print(f"# {result.get()} DONE")
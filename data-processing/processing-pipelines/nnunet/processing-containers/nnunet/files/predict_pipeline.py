@@ -0,0 +1,190 @@
+import multiprocessing
+import os
+import threading
+from queue import Queue
+from time import time
+
+import numpy as np
+import torch
+from nnunetv2.inference.data_iterators import preprocessing_iterator_fromfiles
+from nnunetv2.inference.export_prediction import export_prediction_from_logits
+
+"""
+Documentation predict_pipeline.py:
+
+Batch-level prediction pipeline for an initialized nnUNetPredictor:
+
+preprocessing (worker processes) -> queue -> inference (main thread) -> bounded -> export (worker processes)
+
+All cases of all batch-elements are fed through one predictor, so reading/preprocessing of the next cases
+and the export of the previous cases overlap with the network forward passes.
+The busy time and throughput of every stage are reported to size the workers.
+"""
+
+end_of_queue = None
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+
+    def add(self, busy, waiting=0.0):
+        self.count += 1
+        self.busy += busy
+        self.waiting += waiting
+
+    def print(self, workers, wall_time, parallel=1):
+        # parallel: number of cases the busy time has been summed over concurrently
+        throughput = self.count / self.busy * parallel if self.busy > 0 else 0.0
+        utilization = self.busy / parallel / wall_time * 100 if wall_time > 0 else 0.0
+        print(
+            f"# {self.name:<14} cases: {self.count:4d}  workers: {workers:2d}  busy: {self.busy:9.1f} s  "
+            f"waiting: {self.waiting:9.1f} s  max throughput: {throughput:6.2f} cases/s  "
+            f"utilization: {utilization:5.1f} %"
+        )
+
+
+def timed_export(*args):
+    start_time = time()
+    export_prediction_from_logits(*args)
+    return time() - start_time
+
+
+def preprocessing_producer(data_iterator, queue, stats):
+    try:
+        start_time = time()
+        for preprocessed in data_iterator:
+            stats.add(busy=time() - start_time)
+            queue.put(preprocessed)
+            start_time = time()
+    except Exception as e:
+        queue.put(e)
+    finally:
+        queue.put(end_of_queue)
+
+
+def predict_pipelined(
+    predictor,
+    list_of_lists,
+    output_files_truncated,
+    save_probabilities=False,
+    num_processes_preprocessing=2,
+    num_processes_export=2,
+    queue_size=2,
+):
+    """
+    Predicts all cases (list of input files per case) and exports them to output_files_truncated.
+    At most queue_size preprocessed cases wait for the inference and at most
+    num_processes_export + queue_size predictions wait for or run the export.
+    """
+    preprocessing_stats = StageStats("preprocessing")
+    inference_stats = StageStats("inference")
+    export_stats = StageStats("export")
+    start_time = time()
+
+    # same iterator as nnUNetPredictor.predict_from_files (nnunetv2 v2.4.2, see base-nnunet-v2)
+    data_iterator = preprocessing_iterator_fromfiles(
+        list_of_lists,
+        [None] * len(list_of_lists),
+        output_files_truncated,
+        predictor.plans_manager,
+        predictor.dataset_json,
+        predictor.configuration_manager,
+        num_processes_preprocessing,
+        pin_memory=predictor.device.type == "cuda",
+        verbose=predictor.verbose_preprocessing,
+    )
+    preprocessed_queue = Queue(maxsize=queue_size)
+    producer = threading.Thread(
+        target=preprocessing_producer,
+        args=(data_iterator, preprocessed_queue, preprocessing_stats),
+        daemon=True,
+    )
+    producer.start()
+
+    export_slots = threading.BoundedSemaphore(num_processes_export + queue_size)
+    export_errors = []
+
+    def export_done(duration):
+        export_stats.add(busy=duration)
+        export_slots.release()
+
+    def export_failed(e):
+        export_errors.append(e)
+        export_slots.release()
+
+    with multiprocessing.get_context("spawn").Pool(num_processes_export) as export_pool:
+        results = []
+        while True:
+            wait_start = time()
+            preprocessed = preprocessed_queue.get()
+            waiting = time() - wait_start
+            if preprocessed is end_of_queue:
+                break
+            if isinstance(preprocessed, Exception):
+                raise preprocessed
+
+            data = preprocessed["data"]
+            if isinstance(data, str):
+                delfile = data
+                data = torch.from_numpy(np.load(data))
+                os.remove(delfile)
+            ofile = preprocessed["ofile"]
+
+            inference_start = time()
+            # convert to numpy to prevent memory alignment errors from multiprocessing serialization of torch tensors
+            prediction = (
+                predictor.predict_logits_from_preprocessed_data(data)
+                .cpu()
+                .detach()
+                .numpy()
+            )
+            inference_stats.add(busy=time() - inference_start, waiting=waiting)
+            print(f"# Predicted {os.path.basename(ofile)} -> export")
+
+            # backpressure: the export queue is bounded
+            wait_start = time()
+            export_slots.acquire()
+            export_stats.waiting += time() - wait_start
+            results.append(
+                export_pool.apply_async(
+                    timed_export,
+                    (
+                        prediction,
+                        preprocessed["data_properties"],
+                        predictor.configuration_manager,
+                        predictor.plans_manager,
+                        predictor.dataset_json,
+                        ofile,
+                        save_probabilities,
+                    ),
+                    callback=export_done,
+                    error_callback=export_failed,
+                )
+            )
+            del prediction, data
+
+        print("# Inference done -> waiting for the remaining exports ...")
+        for result in results:
+            result.wait()
+
+    producer.join()
+    if len(export_errors) > 0:
+        raise export_errors[0]
+
+    wall_time = time() - start_time
+    print("#")
+    print(f"# Pipeline: {len(results)} cases in {wall_time:.1f} s")
+    # preprocessing busy = time until the next case was delivered by all preprocessing workers
+    preprocessing_stats.print(num_processes_preprocessing, wall_time)
+    inference_stats.print(1, wall_time)
+    # export busy = summed duration of the export tasks
+    export_stats.print(num_processes_export, wall_time, parallel=num_processes_export)
+    print(
+        "# (inference waiting -> preprocessing bound, export waiting -> export bound)"
+    )
+    print("#")
+    return len(results)
@@ -1,5 +1,8 @@
 # nnUNet imports
 from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.utilities.utils import create_lists_from_splitted_dataset_folder
+from batchgenerators.utilities.file_and_folder_operations import save_json
+from predict_pipeline import predict_pipelined
 
 from pathlib import Path
 import os
@@ -399,8 +402,7 @@ def predict(
 
     Notes:
     ------
-    - Initializes the nnUNetPredictor with settings for tiling, mirroring, and device usage.
-    - Prepares the model by loading the specified checkpoint and folds.
+    - The initialized predictor is taken from `get_predictor` (cached per model, folds and checkpoint).
     - `predict_from_files` is called with configurations for saving probabilities, managing parallel processing,
       and specifying parts if applicable.
 
@@ -409,6 +411,57 @@ def predict(
     >>> predict("/path/to/input_data", "/path/to/output_dir", "/path/to/model", folds="all", enable_softmax="True")
     """
 
+    predictor = get_predictor(model, folds, checkpoint_name)
+    # give input and output folders
+    predictor.predict_from_files(
+        input_data_dir,
+        element_output_dir,
+        save_probabilities=enable_softmax,
+        overwrite=False,
+        num_processes_preprocessing=threads_preprocessing,
+        num_processes_segmentation_export=threads_nifiti,
+        folder_with_segs_from_prev_stage=None,
+        num_parts=1,
+        part_id=0,
+    )
+
+
+def get_device():
+    """
+    Returns the torch device for the prediction: INF_DEVICE=auto selects the first GPU if available and the CPU otherwise.
+    """
+    if inf_device == "auto":
+        device = (
+            torch.device("cuda", 0)
+            if torch.cuda.is_available()
+            else torch.device("cpu")
+        )
+    else:
+        device = torch.device(inf_device)
+
+    if device.type == "cpu":
+        torch.set_num_threads(available_cores)
+    return device
+
+
+def get_predictor(model, folds, checkpoint_name):
+    """
+    Returns an initialized nnUNetPredictor for the model.
+
+    Initialized predictors are cached per (model, folds, checkpoint_name), so the network architecture and the
+    checkpoints are only loaded once per process and reused for all batch-elements.
+    """
+    predictor_key = (
+        str(model),
+        tuple(folds) if isinstance(folds, (list, tuple)) else folds,
+        checkpoint_name,
+    )
+    if cache_predictors and predictor_key in predictors:
+        print(f"# Using cached predictor: {predictor_key}")
+        return predictors[predictor_key]
+
+    device = get_device()
+    print(f"# Initializing predictor on {device}: {predictor_key}")
     ### from nnU-Net V2 docs
     # source: https://github.com/MIC-DKFZ/nnUNet/tree/master/nnunetv2/inference#recommended-nnu-net-default-predict-from-source-files
     # instantiate the nnUNetPredictor
@@ -416,8 +469,8 @@ def predict(
         tile_step_size=0.5,
         use_gaussian=True,
         use_mirroring=True,
-        perform_everything_on_device=True,
-        device=torch.device("cuda", 0),
+        perform_everything_on_device=device.type == "cuda",
+        device=device,
         verbose=False,
         verbose_preprocessing=False,
         allow_tqdm=True,
@@ -428,18 +481,127 @@ def predict(
         use_folds=folds,
         checkpoint_name=checkpoint_name + ".pth",
     )
-    # give input and output folders
-    predictor.predict_from_files(
-        input_data_dir,
-        element_output_dir,
-        save_probabilities=enable_softmax,
-        overwrite=False,
-        num_processes_preprocessing=2,
-        num_processes_segmentation_export=2,
-        folder_with_segs_from_prev_stage=None,
-        num_parts=1,
-        part_id=0,
-    )
+    if cache_predictors:
+        predictors[predictor_key] = predictor
+    return predictor
+
+
+def predict_batch_elements_pipelined(batch_folders):
+    """
+    Predicts all batch-elements with one predictor per model by feeding the cases of all batch-elements through
+    the pipeline of `predict_pipeline.predict_pipelined` (preprocessing, inference and export overlap).
+
+    Parameters:
+    -----------
+    batch_folders : list
+        Batch-element directories.
+
+    Returns:
+    --------
+    int
+        Number of processed (batch-element, model) pairs.
+    """
+    global folds
+
+    jobs = {}
+    for batch_element_dir in batch_folders:
+        input_data_dir, input_count = create_dataset(search_dir=batch_element_dir)
+        if input_count == 0:
+            print("#")
+            print("##################################################")
+            print("#")
+            print("# No NIFTI files found on batch-element-level!")
+            print("#")
+            print("##################################################")
+            print("#")
+            break
+
+        element_output_dir = join(batch_element_dir, operator_out_dir)
+        model_paths = get_model_paths(batch_element_dir=batch_element_dir)
+        for model, checkpoint_name in model_paths:
+            if folds == None and "fold_all" in model or folds == "all":
+                folds = "all"
+                model = Path(model).parent
+            job_key = (str(model), str(folds), checkpoint_name)
+            if job_key not in jobs:
+                jobs[job_key] = {
+                    "model": (model, folds, checkpoint_name),
+                    "elements": [],
+                }
+            jobs[job_key]["elements"].append((input_data_dir, element_output_dir))
+
+    processed_count = 0
+    for job in jobs.values():
+        model, job_folds, checkpoint_name = job["model"]
+        print("#")
+        print("##################################################")
+        print("#                                                #")
+        print("# Start pipelined prediction....                 #")
+        print("#                                                #")
+        print("##################################################")
+        print("#")
+        print(f"# model: {model}")
+        print(f"# batch-elements: {len(job['elements'])}")
+        print("#")
+
+        predictor = get_predictor(model, job_folds, checkpoint_name)
+        file_ending = predictor.dataset_json["file_ending"]
+        list_of_lists = []
+        output_files_truncated = []
+        for input_data_dir, element_output_dir in job["elements"]:
+            Path(element_output_dir).mkdir(parents=True, exist_ok=True)
+            # same files as written by predict_from_files
+            save_json(
+                predictor.dataset_json,
+                join(element_output_dir, "dataset.json"),
+                sort_keys=False,
+            )
+            save_json(
+                predictor.plans_manager.plans,
+                join(element_output_dir, "plans.json"),
+                sort_keys=False,
+            )
+            for case_files in create_lists_from_splitted_dataset_folder(
+                input_data_dir, file_ending
+            ):
+                case_id = basename(case_files[0])[: -(len(file_ending) + 5)]
+                output_file_truncated = join(element_output_dir, case_id)
+                # overwrite=False -> skip already predicted cases
+                if exists(output_file_truncated + file_ending) and (
+                    not enable_softmax or exists(output_file_truncated + ".npz")
+                ):
+                    print(f"# {output_file_truncated} already predicted -> skipping")
+                    continue
+                list_of_lists.append(case_files)
+                output_files_truncated.append(output_file_truncated)
+
+        if len(list_of_lists) > 0:
+            predict_pipelined(
+                predictor,
+                list_of_lists,
+                output_files_truncated,
+                save_probabilities=enable_softmax,
+                num_processes_preprocessing=threads_preprocessing,
+                num_processes_export=threads_nifiti,
+                queue_size=inf_queue_size,
+            )
+
+        for _, element_output_dir in job["elements"]:
+            # write corresponding seg_info.json
+            write_seg_info(model, element_output_dir, dataset_info_dir=model)
+            processed_count += 1
+
+        print("#")
+        print("##################################################")
+        print("#                                                #")
+        print("#                 Prediction ok                  #")
+        print("#                                                #")
+        print("##################################################")
+        print("#                                                #")
+        print(f"# model: {model}")
+        print("#")
+
+    return processed_count
 
 
 folds = getenv("TRAIN_FOLD", "None")
@@ -465,12 +627,27 @@ mode = getenv("MODE", "None")
 mode = mode if mode.lower() != "none" else None
 models_dir = getenv("MODELS_DIR", "None")
 models_dir = models_dir if models_dir.lower() != "none" else "/models"
+# preprocessing and export workers default to the cores available to the container
+available_cores = len(os.sched_getaffinity(0))
+default_processes = max(1, min(8, available_cores // 2))
 threads_preprocessing = getenv("INF_THREADS_PREP", "None")
 threads_preprocessing = (
-    int(threads_preprocessing) if threads_preprocessing.lower() != "none" else 2
+    int(threads_preprocessing)
+    if threads_preprocessing.lower() != "none"
+    else default_processes
 )
 threads_nifiti = getenv("INF_THREADS_NIFTI", "None")
-threads_nifiti = int(threads_nifiti) if threads_nifiti.lower() != "none" else 2
+threads_nifiti = (
+    int(threads_nifiti) if threads_nifiti.lower() != "none" else default_processes
+)
+# auto -> cuda if available, otherwise cpu
+inf_device = getenv("INF_DEVICE", "auto").lower()
+cache_predictors = getenv("INF_CACHE_PREDICTORS", "True")
+cache_predictors = True if cache_predictors.lower() == "true" else False
+# pipelined prediction of all batch-elements (see predict_pipeline.py)
+inf_pipeline = getenv("INF_PIPELINE", "True")
+inf_pipeline = True if inf_pipeline.lower() == "true" else False
+inf_queue_size = int(getenv("INF_QUEUE_SIZE", "2"))
 batch_dataset = getenv("INF_BATCH_DATASET", "False")
 batch_dataset = True if batch_dataset.lower() == "true" else False
 input_modality_dirs = getenv("INPUT_MODALITY_DIRS", "None")
@@ -520,6 +697,9 @@ num_parts = 1
 
 copy_target_data = True
 
+# initialized nnUNetPredictors per (model, folds, checkpoint_name)
+predictors = {}
+
 if enable_softmax:
     inf_mode = "normal"
 
@@ -548,6 +728,11 @@ if __name__ == "__main__":
     print(f"# input_modality_dirs: {input_modality_dirs}")
     print(f"# threads_nifiti:      {threads_nifiti}")
     print(f"# threads_preprocessing: {threads_preprocessing}")
+    print(f"# available_cores:       {available_cores}")
+    print(f"# inf_device:            {inf_device}")
+    print(f"# cache_predictors:      {cache_predictors}")
+    print(f"# inf_pipeline:          {inf_pipeline}")
+    print(f"# inf_queue_size:        {inf_queue_size}")
     print(f"# model_arch:            {model_arch}")
     print(f"# train_network_trainer: {train_network_trainer}")
     print("#")
@@ -568,62 +753,66 @@ if __name__ == "__main__":
 
     processed_count = 0
     batch_folders = sorted([f for f in glob(join("/", workflow_dir, batch_name, "*"))])
-    for batch_element_dir in batch_folders:
-        input_data_dir, input_count = create_dataset(search_dir=batch_element_dir)
-        if input_count == 0:
-            print("#")
-            print("##################################################")
-            print("#")
-            print("# No NIFTI files found on batch-element-level!")
-            print("#")
-            print("##################################################")
-            print("#")
-            break
+    if inf_pipeline:
+        processed_count = predict_batch_elements_pipelined(batch_folders)
+        shutil.rmtree(join("/", workflow_dir, "nnunet-input-data"), ignore_errors=True)
+    else:
+        for batch_element_dir in batch_folders:
+            input_data_dir, input_count = create_dataset(search_dir=batch_element_dir)
+            if input_count == 0:
+                print("#")
+                print("##################################################")
+                print("#")
+                print("# No NIFTI files found on batch-element-level!")
+                print("#")
+                print("##################################################")
+                print("#")
+                break
 
-        # element_input_dir = join(batch_element_dir, operator_in_dir)
-        element_output_dir = join(batch_element_dir, operator_out_dir)
+            # element_input_dir = join(batch_element_dir, operator_in_dir)
+            element_output_dir = join(batch_element_dir, operator_out_dir)
 
-        # e.g.: /models/nnUNet/Dataset579_10.135.76.130_010824-0934/nnUNetTrainer__nnUNetResEncUNetMPlans__3d_lowres/fold_all
-        model_paths = get_model_paths(batch_element_dir=batch_element_dir)
-        for model, checkpoint_name in model_paths:
-            if folds == None and "fold_all" in model or folds == "all":
-                folds = "all"
-                model = Path(model).parent
-            print("#")
-            print("##################################################")
-            print("#                                                #")
-            print(f"# Start prediction....                           #")
-            print("#                                                #")
-            print("##################################################")
-            print("#")
-            print(f"# model: {model}")
-            print("#")
+            # e.g.: /models/nnUNet/Dataset579_10.135.76.130_010824-0934/nnUNetTrainer__nnUNetResEncUNetMPlans__3d_lowres/fold_all
+            model_paths = get_model_paths(batch_element_dir=batch_element_dir)
+            for model, checkpoint_name in model_paths:
+                if folds == None and "fold_all" in model or folds == "all":
+                    folds = "all"
+                    model = Path(model).parent
+                print("#")
+                print("##################################################")
+                print("#                                                #")
+                print(f"# Start prediction....                           #")
+                print("#                                                #")
+                print("##################################################")
+                print("#")
+                print(f"# model: {model}")
+                print("#")
 
-            # predict via nnU-Net's predict function
-            predict(
-                input_data_dir,
-                element_output_dir,
-                model,
-                folds,
-                checkpoint_name,
-                enable_softmax,
-            )
-            # write corresponding seg_info.json
-            write_seg_info(model, element_output_dir, dataset_info_dir=model)
+                # predict via nnU-Net's predict function
+                predict(
+                    input_data_dir,
+                    element_output_dir,
+                    model,
+                    folds,
+                    checkpoint_name,
+                    enable_softmax,
+                )
+                # write corresponding seg_info.json
+                write_seg_info(model, element_output_dir, dataset_info_dir=model)
 
-            processed_count += 1
-            print("#")
-            print("##################################################")
-            print("#                                                #")
-            print("#                 Prediction ok                  #")
-            print("#                                                #")
-            print("##################################################")
-            print("#                                                #")
-            print(f"# model: {model}")
-            print("#")
+                processed_count += 1
+                print("#")
+                print("##################################################")
+                print("#                                                #")
+                print("#                 Prediction ok                  #")
+                print("#                                                #")
+                print("##################################################")
+                print("#                                                #")
+                print(f"# model: {model}")
+                print("#")
 
-        input_data_dir = join("/", workflow_dir, "nnunet-input-data")
-        shutil.rmtree(input_data_dir, ignore_errors=True)
+            input_data_dir = join("/", workflow_dir, "nnunet-input-data")
+            shutil.rmtree(input_data_dir, ignore_errors=True)
 
     if processed_count == 0:
         print("##################################################")
@@ -6,6 +6,7 @@ from shutil import copy2, move, rmtree
 from pathlib import Path
 import shutil
 import nibabel as nib
+from nibabel.openers import Opener
 import numpy as np
 import json
 from pydicom.uid import generate_uid
@@ -340,15 +341,113 @@ def create_metadata_json(new_labels_dict):
     return metadata_dict
 
 
-def check_overlap(gt_map, new_map, seg_nifti):
-    global skipped_dict, max_overlap_percentage
+def get_label_dtype(max_label_int):
+    if max_label_int <= np.iinfo(np.uint8).max:
+        return np.uint8
+    elif max_label_int <= np.iinfo(np.uint16).max:
+        return np.uint16
+    return np.uint32
+
+
+def check_nifti_readable(nifti_path):
+    # Streams the (compressed) file instead of loading the volume -> constant memory
+    try:
+        with Opener(nifti_path, "rb") as f:
+            while f.read(64 * 1024 * 1024):
+                pass
+    except EOFError:
+        return False
+    return True
+
+
+def load_label_voxels(loaded_nib_nifti):
+    """
+    Returns {int_encoding: flat voxel indices (F-order)} for all non-zero encodings.
+    The NIFTI is read in its on-disk dtype -> no float64/int64 copy of the volume.
+    """
+    seg_numpy = np.asanyarray(loaded_nib_nifti.dataobj)
+    if not np.issubdtype(seg_numpy.dtype, np.integer):
+        # same truncation as the previous get_fdata().astype(int)
+        seg_numpy = seg_numpy.astype(np.int32)
+    seg_flat = seg_numpy.ravel(order="F")
+    voxel_indices = np.flatnonzero(seg_flat)
+    if len(voxel_indices) == 0:
+        return {}
+    encodings = seg_flat[voxel_indices]
+    if encodings.min() == encodings.max():
+        return {int(encodings[0]): voxel_indices}
+
+    sort_order = np.argsort(encodings, kind="stable")
+    encodings = encodings[sort_order]
+    voxel_indices = voxel_indices[sort_order]
+    split_indices = np.flatnonzero(np.diff(encodings)) + 1
+    return {
+        int(encodings[start]): label_voxel_indices
+        for start, label_voxel_indices in zip(
+            np.concatenate(([0], split_indices)),
+            np.split(voxel_indices, split_indices),
+        )
+    }
+
+
+class LabelAccumulator:
+    """
+    Label map of the merged segmentations of one base image.
+
+    Labels are added as flat voxel indices, so overlap checks and merges only touch
+    the voxels of the new label instead of the whole volume.
+    The map uses the smallest unsigned dtype that fits all label_ints.
+    """
+
+    def __init__(self, shape, max_label_int):
+        self.label_map = np.zeros(
+            shape, dtype=get_label_dtype(max_label_int), order="F"
+        )
+        self.voxel_count = 0
+        self.max_label_int = 0
+
+    @property
+    def size(self):
+        return self.label_map.size
+
+    def flat(self):
+        # view on the F-ordered label map
+        return self.label_map.reshape(-1, order="F")
 
-    gt_map = np.where(gt_map != 0, 1, gt_map)
-    new_map = np.where(new_map != 0, 1, new_map)
+    def get_overlap(self, voxel_indices):
+        if self.voxel_count == 0:
+            return voxel_indices[:0]
+        return voxel_indices[self.flat()[voxel_indices] != 0]
 
-    agg_arr = gt_map + new_map
-    max_value = int(np.amax(agg_arr))
-    if max_value > 1:
+    def get_labels(self, voxel_indices):
+        return np.unique(self.flat()[voxel_indices])
+
+    def add(self, voxel_indices, label_int):
+        if label_int > np.iinfo(self.label_map.dtype).max:
+            self.label_map = self.label_map.astype(
+                get_label_dtype(label_int), order="F"
+            )
+        label_map_flat = self.flat()
+        # np.maximum keeps the previous merge behaviour for tolerated overlaps
+        label_map_flat[voxel_indices] = np.maximum(
+            label_map_flat[voxel_indices], label_int
+        )
+        self.voxel_count += len(voxel_indices)
+        self.max_label_int = max(self.max_label_int, label_int)
+
+    def to_nifti(self, reference_nifti):
+        combined = nib.Nifti1Image(
+            self.label_map, reference_nifti.affine, reference_nifti.header
+        )
+        combined.set_data_dtype(self.label_map.dtype)
+        return combined
+
+
+def check_overlap(label_accumulator, voxel_indices, seg_nifti):
+    global skipped_dict, max_overlap_percentage
+
+    overlap_indices = label_accumulator.get_overlap(voxel_indices)
+    if len(overlap_indices) > 0:
         print("#")
         print("##################################################")
         print("#")
@@ -356,9 +455,10 @@ def check_overlap(gt_map, new_map, seg_nifti):
         print("#")
         print(f"# NIFTI: {seg_nifti}")
         print("#")
-        overlap_indices = agg_arr > 1
-        overlap_voxel_count = overlap_indices.sum()
-        overlap_percentage = 100 * float(overlap_voxel_count) / float(gt_map.size)
+        overlap_voxel_count = len(overlap_indices)
+        overlap_percentage = (
+            100 * float(overlap_voxel_count) / float(label_accumulator.size)
+        )
 
         print(f"# overlap_percentage: {overlap_percentage} / {max_overlap_percentage}")
         if overlap_percentage > max_overlap_percentage:
@@ -399,10 +499,12 @@ def merge_niftis(queue_dict):
     # start merging process by defining new_gt_map as shaped as base_image
     base_image_loaded = nib.load(base_image_path)
     base_image_dimensions = base_image_loaded.shape
-    try:
-        new_gt_map = np.zeros_like(base_image_loaded.get_fdata().astype(int))
-    except EOFError:
+    if not check_nifti_readable(base_image_path):
         return queue_dict, "false satori export"
+    new_gt_map = LabelAccumulator(
+        shape=base_image_dimensions,
+        max_label_int=max(global_labels_info.values(), default=0),
+    )
     # new_gt_map_int_encodings = list(np.unique(new_gt_map))
 
     local_labels_info = {"Clear Label": 0}
@@ -428,7 +530,10 @@ def merge_niftis(queue_dict):
             print(f"# Resetting local_labels_info...")
             print("#")
             print("##################################################")
-            new_gt_map = np.zeros_like(base_image_loaded.get_fdata().astype(int))
+            new_gt_map = LabelAccumulator(
+                shape=base_image_dimensions,
+                max_label_int=max(global_labels_info.values(), default=0),
+            )
             local_labels_info = {"Clear Label": 0}
         print(f"# Processing NIFTI: {seg_nifti}")
         print("#")
@@ -484,10 +589,9 @@ def merge_niftis(queue_dict):
                 print("# -> merging multiple files -> continue")
                 print("#")
 
-        loaded_seg_nifti_numpy = loaded_nib_nifti.get_fdata().astype(int)
+        label_voxels = load_label_voxels(loaded_nib_nifti)
         print("#")
-        nifti_int_encodings = list(np.unique(loaded_seg_nifti_numpy))
-        if len(nifti_int_encodings) == 1:
+        if len(label_voxels) == 0:
             print("##################################################### ")
             print("#")
             print("# No segmentation was found in result-NIFTI-file!")
@@ -496,17 +600,9 @@ def merge_niftis(queue_dict):
             print("##################################################### ")
             continue
 
-        for int_encoding in nifti_int_encodings:
-            int_encoding = int(int_encoding)
+        for int_encoding, label_voxel_indices in sorted(label_voxels.items()):
             print(f"# Loading encoding {int_encoding}")
-            if int_encoding == 0:
-                continue
 
-            # loaded_seg_nifti_label = loaded_seg_nifti_numpy
-            # loaded_seg_nifti_label = np.array(loaded_seg_nifti_numpy)
-            loaded_seg_nifti_label = np.where(
-                loaded_seg_nifti_numpy != int_encoding, 0, loaded_seg_nifti_numpy
-            )
             label_found = list(existing_configuration.keys())[
                 list(existing_configuration.values()).index(str(int_encoding))
             ]
@@ -518,11 +614,6 @@ def merge_niftis(queue_dict):
                 if kind == "change":
                     new_encoding = int(transformation["new_encoding"])
                     print(f"# change {label_found}: {int_encoding} -> {new_encoding}")
-                    loaded_seg_nifti_label = np.where(
-                        loaded_seg_nifti_label == int_encoding,
-                        new_encoding,
-                        loaded_seg_nifti_label,
-                    )
                     int_encoding = new_encoding
 
                 if kind == "delete":
@@ -546,10 +637,12 @@ def merge_niftis(queue_dict):
 
             print("# Check overlap ...")
             result_overlap, overlap_indices, overlap_percentage = check_overlap(
-                gt_map=new_gt_map, new_map=loaded_seg_nifti_label, seg_nifti=seg_nifti
+                label_accumulator=new_gt_map,
+                voxel_indices=label_voxel_indices,
+                seg_nifti=seg_nifti,
             )
             if result_overlap:
-                existing_overlap_labels = np.unique(new_gt_map[overlap_indices])
+                existing_overlap_labels = new_gt_map.get_labels(overlap_indices)
                 print("#")
                 print("##################################################")
                 print("#")
@@ -592,7 +685,7 @@ def merge_niftis(queue_dict):
             print(f"# Merging new_gt_map + loaded_seg_nifti_label: {int_encoding}")
             print("#")
             # print(f"# Old labels: {new_gt_map_int_encodings}")
-            new_gt_map = np.maximum(new_gt_map, loaded_seg_nifti_label)
+            new_gt_map.add(label_voxel_indices, int_encoding)
             # print(f"# Merging done.")
             # new_gt_map_int_encodings = list(np.unique(new_gt_map))
             # print(f"# New labels: {new_gt_map_int_encodings}")
@@ -600,9 +693,7 @@ def merge_niftis(queue_dict):
         if not merge_found_niftis:
             print("# No NIFTI merge -> saving adusted NIFTI ...")
             target_nifti_path = join(target_dir, basename(seg_nifti))
-            combined = nib.Nifti1Image(
-                new_gt_map, base_image_loaded.affine, base_image_loaded.header
-            )
+            combined = new_gt_map.to_nifti(reference_nifti=base_image_loaded)
             combined.to_filename(target_nifti_path)
             metadata_json = create_metadata_json(new_labels_dict=local_labels_info)
             metadata_json_path = join(target_dir, f"{seg_nifti_id}.json")
@@ -613,7 +704,7 @@ def merge_niftis(queue_dict):
 
     if merge_found_niftis:
         print("# Writing new merged file...")
-        if int(np.amax(new_gt_map)) == 0:
+        if new_gt_map.max_label_int == 0:
             print("#")
             print("#")
             print("#")
@@ -653,9 +744,7 @@ def merge_niftis(queue_dict):
         with open(metadata_json_path, "w", encoding="utf-8") as f:
             json.dump(metadata_json, f, indent=4, sort_keys=False)
         target_path_merged = join(target_dir, f"{generate_uid()}_merged.nii.gz")
-        combined = nib.Nifti1Image(
-            new_gt_map, base_image_loaded.affine, base_image_loaded.header
-        )
+        combined = new_gt_map.to_nifti(reference_nifti=base_image_loaded)
         combined.to_filename(target_path_merged)
         print("# Checking if resampling is needed...")
         merged_nifti_shape = nib.load(target_path_merged).shape
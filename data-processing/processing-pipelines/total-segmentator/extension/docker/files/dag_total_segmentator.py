@@ -11,7 +11,6 @@ from kaapana.operators.LocalWorkflowCleanerOperator import LocalWorkflowCleanerO
 from totalsegmentator.TotalSegmentatorOperator import TotalSegmentatorOperator
 from kaapana.operators.GetZenodoModelOperator import GetZenodoModelOperator
 from kaapana.operators.MinioOperator import MinioOperator
-from kaapana.operators.MergeMasksOperator import MergeMasksOperator
 from pyradiomics.PyRadiomicsOperator import PyRadiomicsOperator
 
 max_active_runs = 10
@@ -218,17 +217,12 @@ dcm2nifti = DcmConverterOperator(
 
 ta = "total"
 total_segmentator_0 = TotalSegmentatorOperator(
-    dag=dag, task=ta, input_operator=dcm2nifti
-)
-combine_masks_0 = MergeMasksOperator(
-    dag=dag,
-    input_operator=total_segmentator_0,
-    parallel_id=ta,
+    dag=dag, task=ta, multilabel=True, input_operator=dcm2nifti
 )
 nrrd2dcmSeg_multi_0 = Itk2DcmSegOperator(
     dag=dag,
     input_operator=get_input,
-    segmentation_operator=combine_masks_0,
+    segmentation_operator=total_segmentator_0,
     input_type="multi_label_seg",
     multi_label_seg_name=alg_name,
     multi_label_seg_info_json="seg_info.json",
@@ -259,19 +253,15 @@ get_total_segmentator_model_1 = GetZenodoModelOperator(
 total_segmentator_1 = TotalSegmentatorOperator(
     dag=dag,
     task=ta,
+    multilabel=True,
     input_operator=dcm2nifti,
     delete_output_on_start=False,
     parallel_id=ta,
 )
-combine_masks_1 = MergeMasksOperator(
-    dag=dag,
-    input_operator=total_segmentator_1,
-    parallel_id=ta,
-)
 nrrd2dcmSeg_multi_1 = Itk2DcmSegOperator(
     dag=dag,
     input_operator=get_input,
-    segmentation_operator=combine_masks_1,
+    segmentation_operator=total_segmentator_1,
     input_type="multi_label_seg",
     multi_label_seg_name=alg_name,
     multi_label_seg_info_json="seg_info.json",
@@ -301,19 +291,15 @@ get_total_segmentator_model_2 = GetZenodoModelOperator(
 total_segmentator_2 = TotalSegmentatorOperator(
     dag=dag,
     task=ta,
+    multilabel=True,
     input_operator=dcm2nifti,
     delete_output_on_start=False,
     parallel_id=ta,
 )
-combine_masks_2 = MergeMasksOperator(
-    dag=dag,
-    input_operator=total_segmentator_2,
-    parallel_id=ta,
-)
 nrrd2dcmSeg_multi_2 = Itk2DcmSegOperator(
     dag=dag,
     input_operator=get_input,
-    segmentation_operator=combine_masks_2,
+    segmentation_operator=total_segmentator_2,
     input_type="multi_label_seg",
     multi_label_seg_name=alg_name,
     multi_label_seg_info_json="seg_info.json",
@@ -343,19 +329,15 @@ get_total_segmentator_model_3 = GetZenodoModelOperator(
 total_segmentator_3 = TotalSegmentatorOperator(
     dag=dag,
     task=ta,
+    multilabel=True,
     input_operator=dcm2nifti,
     delete_output_on_start=False,
     parallel_id=ta,
 )
-combine_masks_3 = MergeMasksOperator(
-    dag=dag,
-    input_operator=total_segmentator_3,
-    parallel_id=ta,
-)
 nrrd2dcmSeg_multi_3 = Itk2DcmSegOperator(
     dag=dag,
     input_operator=get_input,
-    segmentation_operator=combine_masks_3,
+    segmentation_operator=total_segmentator_3,
     input_type="multi_label_seg",
     multi_label_seg_name=alg_name,
     multi_label_seg_info_json="seg_info.json",
@@ -385,19 +367,15 @@ get_total_segmentator_model_4 = GetZenodoModelOperator(
 total_segmentator_4 = TotalSegmentatorOperator(
     dag=dag,
     task=ta,
+    multilabel=True,
     input_operator=dcm2nifti,
     delete_output_on_start=False,
     parallel_id=ta,
 )
-combine_masks_4 = MergeMasksOperator(
-    dag=dag,
-    input_operator=total_segmentator_4,
-    parallel_id=ta,
-)
 nrrd2dcmSeg_multi_4 = Itk2DcmSegOperator(
     dag=dag,
     input_operator=get_input,
-    segmentation_operator=combine_masks_4,
+    segmentation_operator=total_segmentator_4,
     input_type="multi_label_seg",
     multi_label_seg_name=alg_name,
     multi_label_seg_info_json="seg_info.json",
@@ -427,19 +405,15 @@ get_total_segmentator_model_5 = GetZenodoModelOperator(
 total_segmentator_5 = TotalSegmentatorOperator(
     dag=dag,
     task=ta,
+    multilabel=True,
     input_operator=dcm2nifti,
     delete_output_on_start=False,
     parallel_id=ta,
 )
-combine_masks_5 = MergeMasksOperator(
-    dag=dag,
-    input_operator=total_segmentator_5,
-    parallel_id=ta,
-)
 nrrd2dcmSeg_multi_5 = Itk2DcmSegOperator(
     dag=dag,
     input_operator=get_input,
-    segmentation_operator=combine_masks_5,
+    segmentation_operator=total_segmentator_5,
     input_type="multi_label_seg",
     multi_label_seg_name=alg_name,
     multi_label_seg_info_json="seg_info.json",
@@ -469,19 +443,15 @@ get_total_segmentator_model_6 = GetZenodoModelOperator(
 total_segmentator_6 = TotalSegmentatorOperator(
     dag=dag,
     task=ta,
+    multilabel=True,
     input_operator=dcm2nifti,
     delete_output_on_start=False,
     parallel_id=ta,
 )
-combine_masks_6 = MergeMasksOperator(
-    dag=dag,
-    input_operator=total_segmentator_6,
-    parallel_id=ta,
-)
 nrrd2dcmSeg_multi_6 = Itk2DcmSegOperator(
     dag=dag,
     input_operator=get_input,
-    segmentation_operator=combine_masks_6,
+    segmentation_operator=total_segmentator_6,
     input_type="multi_label_seg",
     multi_label_seg_name=alg_name,
     multi_label_seg_info_json="seg_info.json",
@@ -529,7 +499,6 @@ get_total_segmentator_model_0 >> total_segmentator_0
     get_input
     >> dcm2nifti
     >> total_segmentator_0
-    >> combine_masks_0
     >> nrrd2dcmSeg_multi_0
     >> dcmseg_send_0
     >> clean
@@ -540,7 +509,6 @@ total_segmentator_0 >> pyradiomics_0 >> put_to_minio
     total_segmentator_0
     >> get_total_segmentator_model_1
     >> total_segmentator_1
-    >> combine_masks_1
     >> nrrd2dcmSeg_multi_1
     >> dcmseg_send_1
     >> clean
@@ -551,7 +519,6 @@ total_segmentator_1 >> pyradiomics_1 >> put_to_minio
     total_segmentator_0
     >> get_total_segmentator_model_2
     >> total_segmentator_2
-    >> combine_masks_2
     >> nrrd2dcmSeg_multi_2
     >> dcmseg_send_2
     >> clean
@@ -562,7 +529,6 @@ total_segmentator_2 >> pyradiomics_2 >> put_to_minio
     total_segmentator_0
     >> get_total_segmentator_model_3
     >> total_segmentator_3
-    >> combine_masks_3
     >> nrrd2dcmSeg_multi_3
     >> dcmseg_send_3
     >> clean
@@ -573,7 +539,6 @@ total_segmentator_3 >> pyradiomics_3 >> put_to_minio
     total_segmentator_0
     >> get_total_segmentator_model_4
     >> total_segmentator_4
-    >> combine_masks_4
     >> nrrd2dcmSeg_multi_4
     >> dcmseg_send_4
     >> clean
@@ -584,7 +549,6 @@ total_segmentator_4 >> pyradiomics_4 >> put_to_minio
     total_segmentator_0
     >> get_total_segmentator_model_5
     >> total_segmentator_5
-    >> combine_masks_5
     >> nrrd2dcmSeg_multi_5
     >> dcmseg_send_5
     >> clean
@@ -595,7 +559,6 @@ total_segmentator_5 >> pyradiomics_5 >> put_to_minio
     total_segmentator_0
     >> get_total_segmentator_model_6
     >> total_segmentator_6
-    >> combine_masks_6
     >> nrrd2dcmSeg_multi_6
     >> dcmseg_send_6
     >> clean
@@ -23,6 +23,11 @@ class TotalSegmentatorOperator(KaapanaBaseOperator):
 
     :param task: Task to execute. Currently, on 'total' is supported.
     :type task: str
+    :param multilabel: Store one multilabel nifti (<task>.nii.gz) and a seg_info.json with the found labels instead of one nifti per class.
+    :type multilabel: bool
+    :param tasks: Optional list of tasks executed in one container (multilabel). The input is decoded and cropped once for all tasks.
+        Results of 'total' are stored in the operator_out_dir, the results of the other tasks in <operator_out_dir>-<task>.
+    :type tasks: list
     """
 
     def __init__(
@@ -41,6 +46,7 @@ class TotalSegmentatorOperator(KaapanaBaseOperator):
         quiet=False,
         verbose=False,
         roi_subset=None,
+        tasks=None,
         nr_thr_resamp=1,
         nr_thr_saving=6,
         env_vars=None,
@@ -82,6 +88,7 @@ class TotalSegmentatorOperator(KaapanaBaseOperator):
             "QUIET": str(quiet),
             "VERBOSE": str(verbose),
             "ROI_SUBSET": "None" if not roi_subset else " ".join(roi_subset),
+            "TASKS": "None" if not tasks else ",".join(tasks),
             "NR_THR_RESAMP": str(nr_thr_resamp),
             "NR_THR_SAVING": str(nr_thr_saving),
         }
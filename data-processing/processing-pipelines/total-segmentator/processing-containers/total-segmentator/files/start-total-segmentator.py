@@ -4,11 +4,202 @@ from os.path import join, exists, dirname, basename
 from glob import glob
 from pathlib import Path
 from totalsegmentator.python_api import totalsegmentator
+from totalsegmentator.cropping import (
+    get_bbox_from_mask,
+    crop_to_bbox,
+    crop_to_bbox_nifti,
+)
 from logger_helper import get_logger
 import logging
 import torch
 import json
 import shutil
+import tempfile
+import numpy as np
+import nibabel as nib
+
+# classes of the total task TotalSegmentator combines to the crop-mask of a task
+crop_classes = {
+    "lung": [
+        "lung_upper_lobe_left",
+        "lung_lower_lobe_left",
+        "lung_upper_lobe_right",
+        "lung_middle_lobe_right",
+        "lung_lower_lobe_right",
+    ],
+    "heart": [
+        "heart_myocardium",
+        "heart_atrium_left",
+        "heart_ventricle_left",
+        "heart_atrium_right",
+        "heart_ventricle_right",
+    ],
+    "pelvis": ["femur_left", "femur_right", "hip_left", "hip_right"],
+    "brain": ["brain"],
+    "liver": ["liver"],
+}
+task_crop = {
+    "lung_vessels": "lung",
+    "covid": "lung",
+    "cerebral_bleed": "brain",
+    "hip_implant": "pelvis",
+    "coronary_arteries": "heart",
+    "pleural_pericard_effusion": "lung",
+    "liver_vessels": "liver",
+    "heartchambers_test": "heart",
+}
+# crop margin in mm of the tasks (TotalSegmentator default: 3 mm)
+task_crop_addon = {
+    "pleural_pericard_effusion": [50, 50, 50],
+    "liver_vessels": [20, 20, 20],
+    "heartchambers_test": [5, 5, 5],
+}
+# TotalSegmentator does not support --ml for these tasks (postprocessing of the class masks)
+tasks_without_ml = ["lung_vessels", "body"]
+
+
+def get_total_label_ints():
+    return {
+        x["label_name"]: int(x["label_int"])
+        for x in seg_info_lookup_dict["total"]["seg_info"]
+    }
+
+
+def write_crop_masks(total_nifti_path, crop, crop_dir):
+    # class masks of the total multilabel result needed to crop the input of the task
+    total_nifti = nib.load(total_nifti_path)
+    total_label_map = np.asanyarray(total_nifti.dataobj)
+    total_label_ints = get_total_label_ints()
+    for class_name in crop_classes[crop]:
+        mask = (total_label_map == total_label_ints[class_name]).astype(np.uint8)
+        nib.save(
+            nib.Nifti1Image(mask, total_nifti.affine),
+            join(crop_dir, f"{class_name}.nii.gz"),
+        )
+
+
+def write_shared_crop(input_nifti_path, total_nifti_path, crop_tasks, tmp_dir):
+    """
+    Crops the input once to the union of the crop regions of all crop_tasks and writes the
+    crop-masks of all tasks within it. TotalSegmentator crops every task to exactly the same
+    region within the shared crop, so the results are not changed.
+    """
+    input_nifti = nib.load(input_nifti_path)
+    total_label_map = np.asanyarray(nib.load(total_nifti_path).dataobj)
+    total_label_ints = get_total_label_ints()
+    # same as TotalSegmentator: crop_addon mm -> voxels of the input
+    zooms = nib.affines.voxel_sizes(input_nifti.affine)
+
+    bbox = None
+    for crop_task in crop_tasks:
+        crop_mask = np.isin(
+            total_label_map,
+            [total_label_ints[x] for x in crop_classes[task_crop[crop_task]]],
+        )
+        addon = (np.array(task_crop_addon.get(crop_task, [3, 3, 3])) / zooms).astype(
+            int
+        )
+        task_bbox = get_bbox_from_mask(crop_mask, outside_value=0, addon=addon)
+        if bbox is None:
+            bbox = task_bbox
+        else:
+            bbox = [[min(a[0], b[0]), max(a[1], b[1])] for a, b in zip(bbox, task_bbox)]
+    bbox = [[int(x[0]), int(x[1])] for x in bbox]
+    logger.info(
+        f"Shared crop of {len(crop_tasks)} tasks: {input_nifti.shape} -> {bbox}"
+    )
+
+    # TotalSegmentator crops with dtype int32 as well
+    cropped_input_nifti = crop_to_bbox_nifti(input_nifti, bbox, dtype=np.int32)
+    cropped_input_path = join(tmp_dir, "input_cropped.nii")
+    nib.save(cropped_input_nifti, cropped_input_path)
+
+    crop_path = join(tmp_dir, "crop")
+    Path(crop_path).mkdir()
+    for crop in set(task_crop[x] for x in crop_tasks):
+        for class_name in crop_classes[crop]:
+            mask = crop_to_bbox(total_label_map == total_label_ints[class_name], bbox)
+            nib.save(
+                nib.Nifti1Image(mask.astype(np.uint8), cropped_input_nifti.affine),
+                join(crop_path, f"{class_name}.nii.gz"),
+            )
+    return cropped_input_path, crop_path, bbox
+
+
+def undo_shared_crop(cropped_nifti_path, input_nifti, bbox, target_nifti_path):
+    cropped_label_map = np.asanyarray(nib.load(cropped_nifti_path).dataobj)
+    label_map = np.zeros(input_nifti.shape[:3], dtype=cropped_label_map.dtype)
+    label_map[
+        bbox[0][0] : bbox[0][1], bbox[1][0] : bbox[1][1], bbox[2][0] : bbox[2][1]
+    ] = cropped_label_map
+    nib.save(nib.Nifti1Image(label_map, input_nifti.affine), target_nifti_path)
+
+
+def combine_class_masks(class_dir, target_nifti_path, task_seg_info_dict):
+    label_map = None
+    for label in task_seg_info_dict["seg_info"]:
+        class_nifti_path = join(class_dir, f"{label['label_name']}.nii.gz")
+        assert exists(class_nifti_path)
+        class_nifti = nib.load(class_nifti_path)
+        if label_map is None:
+            label_map = np.zeros(class_nifti.shape, dtype=np.uint8)
+            affine = class_nifti.affine
+        label_map[np.asanyarray(class_nifti.dataobj) > 0] = int(label["label_int"])
+    nib.save(nib.Nifti1Image(label_map, affine), target_nifti_path)
+
+
+def write_seg_info(multilabel_nifti_path, seg_info_path, task_seg_info_dict):
+    # only labels present in the result -> no empty segments in the DICOM SEG
+    label_map = np.asanyarray(nib.load(multilabel_nifti_path).dataobj)
+    label_counts = np.bincount(label_map.ravel())
+    seg_info = [
+        label
+        for label in task_seg_info_dict["seg_info"]
+        if int(label["label_int"]) < len(label_counts)
+        and label_counts[int(label["label_int"])] > 0
+    ]
+    logger.info(
+        f"{len(seg_info)}/{len(task_seg_info_dict['seg_info'])} labels found in {basename(multilabel_nifti_path)}"
+    )
+    with open(seg_info_path, "w") as fp:
+        json.dump({**task_seg_info_dict, "seg_info": seg_info}, fp, indent=4)
+
+
+def run_task_multilabel(task_name, input_path, target_nifti_path, crop_path, tmp_dir):
+    # one multilabel NIfTI of task_name @target_nifti_path
+    ml = task_name not in tasks_without_ml
+    class_dir = join(tmp_dir, f"{task_name}-classes")
+    totalsegmentator(
+        input=input_path,
+        output=target_nifti_path if ml else class_dir,
+        ml=ml,
+        nr_thr_resamp=nr_thr_resamp,
+        nr_thr_saving=nr_thr_saving,
+        fast=fast,
+        nora_tag=nora_tag,
+        preview=preview,
+        task=task_name,
+        roi_subset=roi_subset,
+        statistics=statistics,
+        radiomics=radiomics,
+        crop_path=Path(crop_path) if crop_path is not None else None,
+        body_seg=body_seg,
+        force_split=force_split,
+        output_type=output_type,
+        quiet=quiet,
+        verbose=verbose,
+        test=0,
+    )
+    if not ml:
+        logger.info(f"Task: {task_name} -> combining class masks ...")
+        combine_class_masks(
+            class_dir, target_nifti_path, seg_info_lookup_dict[task_name]
+        )
+        if exists(join(class_dir, "statistics.json")):
+            shutil.move(
+                join(class_dir, "statistics.json"),
+                join(dirname(target_nifti_path), "statistics.json"),
+            )
 
 
 # Process each file
@@ -85,6 +276,149 @@ def process_input_file(input_path, output_path):
         return False, input_path
 
 
+# Process each file -> one multilabel NIfTI + seg_info.json for the DICOM SEG conversion
+def process_input_file_multilabel(input_path, output_path):
+    global processed_count
+    logger.info(f"{basename(input_path)}: start multilabel processing ...")
+    Path(output_path).mkdir(parents=True, exist_ok=True)
+    target_nifti_path = join(output_path, f"{task}.nii.gz")
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            crop_path = None
+            if task in task_crop:
+                total_output_path = join(dirname(output_path), "total-segmentator")
+                total_nifti_path = join(total_output_path, "total.nii.gz")
+                if exists(total_nifti_path):
+                    logger.info(
+                        f"Writing {task_crop[task]} crop-masks from {total_nifti_path}"
+                    )
+                    crop_path = join(tmp_dir, "crop")
+                    Path(crop_path).mkdir()
+                    write_crop_masks(total_nifti_path, task_crop[task], crop_path)
+                else:
+                    # class masks of a total run without multilabel
+                    crop_path = total_output_path
+
+            run_task_multilabel(task, input_path, target_nifti_path, crop_path, tmp_dir)
+
+        write_seg_info(
+            target_nifti_path, join(output_path, "seg_info.json"), seg_info_dict
+        )
+        processed_count += 1
+
+        logger.info(f"{basename(input_file)}: finished successully!")
+        return True, input_path
+
+    except Exception as e:
+        logger.error(f"{basename(input_file)}: something went wrong.!")
+        logger.error(e)
+        return False, input_path
+
+
+def get_task_output_path(output_path, task_name):
+    # same output-dirs as one TotalSegmentatorOperator per task (parallel_id=task)
+    return output_path if task_name == "total" else f"{output_path}-{task_name}"
+
+
+# Process each file with all tasks:
+# the input is decoded once and cropped once for all tasks with a crop-mask
+def process_input_file_multitask(input_path, output_path):
+    global processed_count
+    logger.info(f"{basename(input_path)}: start processing of tasks {tasks} ...")
+    success = True
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # all tasks read the uncompressed NIfTI
+        decoded_input_path = join(tmp_dir, "input.nii")
+        nib.save(nib.load(input_path), decoded_input_path)
+
+        total_nifti_path = join(
+            dirname(output_path), "total-segmentator", "total.nii.gz"
+        )
+        crop_tasks = [x for x in tasks if x in task_crop]
+        for task_name in tasks:
+            if task_name in crop_tasks:
+                continue
+            task_output_path = get_task_output_path(output_path, task_name)
+            Path(task_output_path).mkdir(parents=True, exist_ok=True)
+            target_nifti_path = join(task_output_path, f"{task_name}.nii.gz")
+            try:
+                logger.info(f"Task: {task_name} -> {target_nifti_path}")
+                run_task_multilabel(
+                    task_name, decoded_input_path, target_nifti_path, None, tmp_dir
+                )
+                write_seg_info(
+                    target_nifti_path,
+                    join(task_output_path, "seg_info.json"),
+                    seg_info_lookup_dict[task_name],
+                )
+                if task_name == "total":
+                    total_nifti_path = target_nifti_path
+            except Exception as e:
+                logger.error(f"{basename(input_path)}: task {task_name} went wrong.!")
+                logger.error(e)
+                success = False
+
+        if len(crop_tasks) > 0:
+            input_nifti = nib.load(decoded_input_path)
+            if exists(total_nifti_path):
+                cropped_input_path, crop_path, bbox = write_shared_crop(
+                    decoded_input_path, total_nifti_path, crop_tasks, tmp_dir
+                )
+            else:
+                # class masks of a total run without multilabel
+                cropped_input_path = decoded_input_path
+                crop_path = join(dirname(output_path), "total-segmentator")
+                bbox = None
+
+            for task_name in crop_tasks:
+                task_output_path = get_task_output_path(output_path, task_name)
+                Path(task_output_path).mkdir(parents=True, exist_ok=True)
+                target_nifti_path = join(task_output_path, f"{task_name}.nii.gz")
+                try:
+                    logger.info(f"Task: {task_name} -> {target_nifti_path}")
+                    if bbox is None:
+                        run_task_multilabel(
+                            task_name,
+                            cropped_input_path,
+                            target_nifti_path,
+                            crop_path,
+                            tmp_dir,
+                        )
+                    else:
+                        cropped_nifti_path = join(tmp_dir, f"{task_name}.nii.gz")
+                        run_task_multilabel(
+                            task_name,
+                            cropped_input_path,
+                            cropped_nifti_path,
+                            crop_path,
+                            tmp_dir,
+                        )
+                        undo_shared_crop(
+                            cropped_nifti_path, input_nifti, bbox, target_nifti_path
+                        )
+                        if exists(join(tmp_dir, "statistics.json")):
+                            shutil.move(
+                                join(tmp_dir, "statistics.json"),
+                                join(task_output_path, "statistics.json"),
+                            )
+                    write_seg_info(
+                        target_nifti_path,
+                        join(task_output_path, "seg_info.json"),
+                        seg_info_lookup_dict[task_name],
+                    )
+                except Exception as e:
+                    logger.error(
+                        f"{basename(input_path)}: task {task_name} went wrong.!"
+                    )
+                    logger.error(e)
+                    success = False
+
+    if success:
+        processed_count += 1
+        logger.info(f"{basename(input_path)}: finished successully!")
+    return success, input_path
+
+
 if __name__ == "__main__":
     log_level = getenv("LOG_LEVEL", "info").lower()
     log_level_int = None
@@ -144,6 +478,10 @@ if __name__ == "__main__":
     task = getenv("TASK", "None")
     task = task if task.lower() != "none" else None
 
+    # multi-task mode: comma-separated tasks executed in one process (e.g. "total,lung_vessels")
+    tasks = getenv("TASKS", "None")
+    tasks = [x.strip() for x in tasks.split(",")] if tasks.lower() != "none" else None
+
     # output_type: choices=["nifti", "dicom"] "Select if segmentations shall be saved as Nifti or as Dicom RT Struct image."
     output_type = getenv("OUTPUT_TYPE", "None")
     output_type = output_type if output_type.lower() != "none" else None
@@ -233,33 +571,50 @@ if __name__ == "__main__":
         "aortic_branches_test",
         "test",
     ]
-    assert task in tasks_available
-
-    if task == "lung_vessels" and not enable_lung_vessels:
-        logger.warning(f"# task: {task} disabled -> skipping")
-        exit(126)
-    elif task == "cerebral_bleed" and not enable_cerebral_bleed:
-        logger.warning(f"# task: {task} disabled -> skipping")
-        exit(126)
-    elif task == "hip_implant" and not enable_hip_implant:
-        logger.warning(f"# task: {task} disabled -> skipping")
-        exit(126)
-    elif task == "coronary_arteries" and not enable_coronary_arteries:
-        logger.warning(f"# task: {task} disabled -> skipping")
-        exit(126)
-    elif task == "body" and not enable_body:
-        logger.warning(f"# task: {task} disabled -> skipping")
-        exit(126)
-    elif task == "pleural_pericard_effusion" and not enable_pleural_pericard_effusion:
-        logger.warning(f"# task: {task} disabled -> skipping")
-        exit(126)
+    task_enabled = {
+        "lung_vessels": enable_lung_vessels,
+        "cerebral_bleed": enable_cerebral_bleed,
+        "hip_implant": enable_hip_implant,
+        "coronary_arteries": enable_coronary_arteries,
+        "body": enable_body,
+        "pleural_pericard_effusion": enable_pleural_pericard_effusion,
+    }
+    if tasks is None:
+        assert task in tasks_available
+        if not task_enabled.get(task, True):
+            logger.warning(f"# task: {task} disabled -> skipping")
+            exit(126)
+    else:
+        for task_name in tasks:
+            assert task_name in tasks_available
+            if not task_enabled.get(task_name, True):
+                logger.warning(f"# task: {task_name} disabled -> skipping")
+        # total first -> crop-masks for the other tasks
+        tasks = sorted(
+            [x for x in tasks if task_enabled.get(x, True)], key=lambda x: x != "total"
+        )
+        if len(tasks) == 0:
+            exit(126)
+        # every task is stored as multilabel NIfTI
+        multilabel = True
 
     json_path = "/kaapana/app/seg_info_lookup.json"
     with open(json_path, encoding="utf-8") as seg_info_lookup:
         seg_info_lookup_dict = json.load(seg_info_lookup)
 
-    assert task in seg_info_lookup_dict
-    seg_info_dict = seg_info_lookup_dict[task]
+    if tasks is None:
+        assert task in seg_info_lookup_dict
+        seg_info_dict = seg_info_lookup_dict[task]
+    else:
+        assert all(x in seg_info_lookup_dict for x in tasks)
+
+    # multilabel: one NIfTI per task consumed directly by the DICOM SEG conversion
+    if tasks is not None:
+        process = process_input_file_multitask
+    elif multilabel:
+        process = process_input_file_multilabel
+    else:
+        process = process_input_file
 
     # File-extension to search for in the input-dir
     input_file_extension = "*.nii.gz"
@@ -277,6 +632,7 @@ if __name__ == "__main__":
     logger.info("# Config:")
     logger.info("#")
     logger.info(f"# {task=}")
+    logger.info(f"# {tasks=}")
     logger.info(f"# {output_type=}")
     logger.info(f"# {multilabel=}")
     logger.info(f"# {fast=}")
@@ -314,10 +670,11 @@ if __name__ == "__main__":
             logger.info("#")
             continue
 
-        seg_info_path = join(element_output_dir, "seg_info.json")
-        Path(dirname(seg_info_path)).mkdir(parents=True, exist_ok=True)
-        with open(seg_info_path, "w") as fp:
-            json.dump(seg_info_dict, fp, indent=4)
+        if not multilabel:
+            seg_info_path = join(element_output_dir, "seg_info.json")
+            Path(dirname(seg_info_path)).mkdir(parents=True, exist_ok=True)
+            with open(seg_info_path, "w") as fp:
+                json.dump(seg_info_dict, fp, indent=4)
 
         # creating output dir
         input_files = glob(
@@ -326,7 +683,7 @@ if __name__ == "__main__":
         logger.info(f"# Found {len(input_files)} input-files -> start processing ...")
 
         for input_file in input_files:
-            success, input_file = process_input_file(
+            success, input_file = process(
                 input_path=input_file, output_path=element_output_dir
             )
             if not success:
@@ -361,10 +718,11 @@ if __name__ == "__main__":
             logger.info("#")
         else:
             # creating output dir
-            seg_info_path = join(batch_output_dir, "seg_info.json")
-            assert not exists(seg_info_path)
-            with open(seg_info_path, "w") as fp:
-                json.dump(seg_info_dict, fp, indent=4)
+            if not multilabel:
+                seg_info_path = join(batch_output_dir, "seg_info.json")
+                assert not exists(seg_info_path)
+                with open(seg_info_path, "w") as fp:
+                    json.dump(seg_info_dict, fp, indent=4)
 
             # creating output dir
             input_files = glob(
@@ -375,7 +733,7 @@ if __name__ == "__main__":
             # Single process:
             # Loop for every input-file found with extension 'input_file_extension'
             for input_file in input_files:
-                success, input_file = process_input_file(
+                success, input_file = process(
                     input_path=input_file, output_path=batch_output_dir
                 )
                 if not success: